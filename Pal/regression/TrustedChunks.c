@@ -0,0 +1,33 @@
+#include "pal.h"
+#include "pal_debug.h"
+
+/* trusted_chunks.dat is signed with per-chunk hashes (see the Makefile); it has 3 full chunks of
+ * TRUSTED_STUB_SIZE bytes and a partial one */
+#define CHUNK_SIZE (16 * 1024)
+#define NUM_CHUNKS 4
+
+char buffer[CHUNK_SIZE];
+
+int main(int argc, char** argv, char** envp) {
+    PAL_HANDLE file = DkStreamOpen("file:trusted_chunks.dat", PAL_ACCESS_RDONLY, 0, 0, 0);
+    if (!file) {
+        pal_printf("Open of trusted file failed\n");
+        return 0;
+    }
+    pal_printf("Open of trusted file OK\n");
+
+    for (int i = 0; i < NUM_CHUNKS; i++) {
+        /* the first read is checked against the hash of the chunk, the second one against the
+         * stub computed on the first read */
+        PAL_NUM bytes1 = DkStreamRead(file, i * CHUNK_SIZE, CHUNK_SIZE, buffer, NULL, 0);
+        PAL_NUM bytes2 = DkStreamRead(file, i * CHUNK_SIZE + 1, CHUNK_SIZE - 1, buffer, NULL, 0);
+        if (bytes1 && bytes2) {
+            pal_printf("Read of chunk %d OK\n", i);
+        } else {
+            pal_printf("Read of chunk %d failed\n", i);
+        }
+    }
+
+    DkObjectClose(file);
+    return 0;
+}
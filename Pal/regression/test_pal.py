@@ -2,7 +2,9 @@
 
 import ast
 import collections
+import contextlib
 import mmap
+import os
 import pathlib
 import random
 import shutil
@@ -634,6 +636,72 @@ class TC_23_SendHandle(RegressionTestCase):
         # Send File Handle
         self.assertEqual(counter['Receive File Handle: Hello World'], 1)
 
+@unittest.skipUnless(HAS_SGX, 'This test is only meaningful on SGX PAL')
+class TC_40_TrustedChunks(RegressionTestCase):
+    # see TrustedChunks.c and the Makefile
+    DATA = 'trusted_chunks.dat'
+    CHUNK_HASHES = 'TrustedChunks.trusted-chunks/data'
+    CHUNK_SIZE = 16 * 1024
+    # magic, chunk size, file size and file checksum, followed by the SHA256 of every chunk
+    CHUNK_HASHES_HEADER_SIZE = 8 + 8 + 8 + 32
+
+    @contextlib.contextmanager
+    def modified(self, path, offset=None):
+        '''Flip one byte of `path` at `offset` (or append one if None) while in the context.'''
+        stat = os.stat(path)
+        with open(path, 'r+b') as file:
+            if offset is None:
+                file.seek(0, os.SEEK_END)
+                file.write(b'\0')
+            else:
+                file.seek(offset)
+                orig = file.read(1)
+                file.seek(offset)
+                file.write(bytes([orig[0] ^ 0xff]))
+        try:
+            yield
+        finally:
+            with open(path, 'r+b') as file:
+                if offset is None:
+                    file.truncate(stat.st_size)
+                else:
+                    file.seek(offset)
+                    file.write(orig)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    def test_000_intact(self):
+        _, stderr = self.run_binary(['TrustedChunks'])
+        self.assertIn('Open of trusted file OK', stderr)
+        for i in range(4):
+            self.assertIn('Read of chunk {} OK'.format(i), stderr)
+
+    def test_010_modified_chunk(self):
+        with self.modified(self.DATA, 2 * self.CHUNK_SIZE + 123):
+            _, stderr = self.run_binary(['TrustedChunks'])
+        # only the modified chunk is rejected, and only when it is read
+        self.assertIn('Open of trusted file OK', stderr)
+        self.assertIn('Read of chunk 0 OK', stderr)
+        self.assertIn('Read of chunk 1 OK', stderr)
+        self.assertIn('Read of chunk 2 failed', stderr)
+        self.assertIn('Read of chunk 3 OK', stderr)
+
+    def test_020_modified_chunk_hashes(self):
+        with self.modified(self.CHUNK_HASHES, self.CHUNK_HASHES_HEADER_SIZE + 32 + 5):
+            _, stderr = self.run_binary(['TrustedChunks'])
+        self.assertIn('Open of trusted file failed', stderr)
+
+    def test_021_modified_chunk_hashes_header(self):
+        # the file size in the header
+        with self.modified(self.CHUNK_HASHES, 8 + 8):
+            _, stderr = self.run_binary(['TrustedChunks'])
+        self.assertIn('Open of trusted file failed', stderr)
+
+    def test_022_chunk_hashes_wrong_size(self):
+        with self.modified(self.CHUNK_HASHES):
+            _, stderr = self.run_binary(['TrustedChunks'])
+        self.assertIn('Open of trusted file failed', stderr)
+
+
 @unittest.skipUnless(HAS_SGX, 'This test is only meaningful on SGX PAL')
 class TC_50_Attestation(RegressionTestCase):
     def test_000_attestation_report(self):
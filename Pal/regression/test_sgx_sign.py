@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import unittest
+
+# same search path as Pal/src/host/Linux-SGX/signer/pal-sgx-sign
+PROJECT_ROOT = pathlib.Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, os.fspath(PROJECT_ROOT / 'Pal/src/host/Linux-SGX'))
+sys.path.insert(0, os.fspath(PROJECT_ROOT / 'python'))
+
+# pylint: disable=wrong-import-position
+from graphenelibos import sgx_sign
+
+
+class TC_00_ParseValue(unittest.TestCase):
+    def test_000_basic_string(self):
+        self.assertEqual(sgx_sign.parse_value('"file:/lib"'), 'file:/lib')
+        self.assertEqual(sgx_sign.parse_value('""'), '')
+
+    def test_001_literal_string(self):
+        # no escapes in literal strings
+        self.assertEqual(sgx_sign.parse_value(r"'C:\dir\n'"), r'C:\dir\n')
+        self.assertEqual(sgx_sign.parse_value("'say \"hi\"'"), 'say "hi"')
+
+    def test_002_escapes(self):
+        self.assertEqual(sgx_sign.parse_value(r'"a\tb\nc"'), 'a\tb\nc')
+        self.assertEqual(sgx_sign.parse_value(r'"say \"hi\""'), 'say "hi"')
+        self.assertEqual(sgx_sign.parse_value(r'"back\\slash"'), 'back\\slash')
+        self.assertEqual(sgx_sign.parse_value(r'"\u00e9\U0001F600"'), '\u00e9\U0001F600')
+        # an escaped backslash does not start another escape
+        self.assertEqual(sgx_sign.parse_value(r'"\\n"'), '\\n')
+
+    def test_003_invalid_escapes(self):
+        for raw in [r'"\x41"', r'"\u12"', r'"trailing\"', r'"\\\q"']:
+            with self.subTest(raw=raw):
+                with self.assertRaises(ValueError):
+                    sgx_sign.parse_value(raw)
+
+    def test_004_integers_and_booleans(self):
+        self.assertEqual(sgx_sign.parse_value('16'), 16)
+        self.assertEqual(sgx_sign.parse_value('-1'), -1)
+        self.assertEqual(sgx_sign.parse_value('1_000'), 1000)
+        self.assertEqual(sgx_sign.parse_value('0x10'), 16)
+        self.assertEqual(sgx_sign.parse_value('0o17'), 15)
+        self.assertEqual(sgx_sign.parse_value('0b101'), 5)
+        self.assertIs(sgx_sign.parse_value('true'), True)
+        self.assertIs(sgx_sign.parse_value('false'), False)
+
+    def test_005_unquoted_strings(self):
+        for raw in ['file:/lib', '4G', 'True', '1__000', '1_', '_1', '"unterminated', '"']:
+            with self.subTest(raw=raw):
+                with self.assertRaises(ValueError):
+                    sgx_sign.parse_value(raw)
+
+    def test_006_invalid_integers(self):
+        # only decimal integers may have a sign, no leading zeros or stray underscores
+        for raw in ['+0x10', '-0x10', '+0o17', '-0b101', '0x_10', '0x10_', '0b', '007', '+_1',
+                    '0X10']:
+            with self.subTest(raw=raw):
+                with self.assertRaises(ValueError):
+                    sgx_sign.parse_value(raw)
+        self.assertEqual(sgx_sign.parse_value('+0'), 0)
+        self.assertEqual(sgx_sign.parse_value('-0'), 0)
+        self.assertEqual(sgx_sign.parse_value('0xdead_beef'), 0xdeadbeef)
+
+    def test_007_format_roundtrip(self):
+        for value in ['plain', 'quote " and \\ backslash', 'tab\tnewline\n', '\u00e9', 0, -7,
+                      True, False]:
+            with self.subTest(value=value):
+                self.assertEqual(sgx_sign.parse_value(sgx_sign.format_value(value)), value)
+
+
+class TC_01_TrustedFilePatterns(unittest.TestCase):
+    FILES = [
+        'a.so',
+        'lib/x.so',
+        'lib/.hidden.so',
+        'lib/readme.txt',
+        'lib/sub/y.so',
+        'lib/sub/deep/z.so',
+    ]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for name in self.FILES:
+            path = pathlib.Path(self.root, name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+        # directories are never returned, only the files in them
+        pathlib.Path(self.root, 'lib/empty.so').mkdir()
+
+    def expand(self, pattern):
+        paths = sgx_sign.expand_trusted_file_pattern('file:' + self.root + '/' + pattern)
+        return [os.path.relpath(path, self.root) for path in paths]
+
+    def test_000_single_star(self):
+        regex = sgx_sign.glob_to_regex('*.so')
+        self.assertTrue(regex.match('a.so'))
+        self.assertTrue(regex.match('.hidden.so'))
+        self.assertFalse(regex.match('lib/x.so'))
+        self.assertFalse(sgx_sign.glob_to_regex('lib?x.so').match('lib/x.so'))
+
+    def test_001_double_star(self):
+        regex = sgx_sign.glob_to_regex('**/*.so')
+        self.assertTrue(regex.match('a.so'))
+        self.assertTrue(regex.match('lib/sub/deep/z.so'))
+        self.assertFalse(regex.match('lib/readme.txt'))
+
+        regex = sgx_sign.glob_to_regex('lib/**/z.so')
+        self.assertTrue(regex.match('lib/z.so'))
+        self.assertTrue(regex.match('lib/sub/deep/z.so'))
+        self.assertFalse(regex.match('libz.so'))
+        self.assertFalse(regex.match('lib/sub/xz.so'))
+
+        regex = sgx_sign.glob_to_regex('lib/**')
+        self.assertTrue(regex.match('lib/x.so'))
+        self.assertTrue(regex.match('lib/sub/deep/z.so'))
+        self.assertFalse(regex.match('a.so'))
+
+    def test_002_brackets(self):
+        regex = sgx_sign.glob_to_regex('[!a].so')
+        self.assertTrue(regex.match('x.so'))
+        self.assertFalse(regex.match('a.so'))
+        self.assertFalse(regex.match('/.so'))
+        self.assertTrue(sgx_sign.glob_to_regex('[xy].so').match('y.so'))
+
+    def test_010_expand_double_star(self):
+        self.assertEqual(self.expand('**/*.so'), [
+            'a.so',
+            'lib/.hidden.so',
+            'lib/sub/deep/z.so',
+            'lib/sub/y.so',
+            'lib/x.so',
+        ])
+        self.assertEqual(self.expand('lib/**/z.so'), ['lib/sub/deep/z.so'])
+
+    def test_011_expand_single_level(self):
+        self.assertEqual(self.expand('lib/*.so'), ['lib/.hidden.so', 'lib/x.so'])
+        self.assertEqual(self.expand('lib/*/y.so'), ['lib/sub/y.so'])
+
+    def test_012_expand_directory(self):
+        self.assertEqual(self.expand('lib/sub/'), ['lib/sub/deep/z.so', 'lib/sub/y.so'])
+
+    def test_013_expand_missing_directory(self):
+        self.assertEqual(self.expand('nonexistent/**'), [])
+
+
+class TC_02_ChunkHashes(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.target = os.path.join(self.root, 'data')
+        self.sidecar = os.path.join(self.root, 'chunks', 'data')
+        with open(self.target, 'wb') as file:
+            file.write(os.urandom(3 * sgx_sign.offs.TRUSTED_STUB_SIZE + 100))
+        self.checksum = sgx_sign.get_checksum(self.target)
+
+    def write(self):
+        return sgx_sign.write_chunk_hashes(self.sidecar, self.target, self.checksum)
+
+    def test_000_layout(self):
+        checksum = self.write()
+        with open(self.sidecar, 'rb') as file:
+            data = file.read()
+        self.assertEqual(checksum, sgx_sign.get_checksum(self.sidecar))
+        self.assertEqual(len(data), sgx_sign.TRUSTED_CHUNKS_HEADER.size + 4 * 32)
+        self.assertEqual(sgx_sign.TRUSTED_CHUNKS_HEADER.unpack_from(data), (
+            sgx_sign.TRUSTED_CHUNKS_MAGIC, sgx_sign.offs.TRUSTED_STUB_SIZE,
+            os.path.getsize(self.target), self.checksum))
+
+    def test_010_unchanged_sidecar_is_kept(self):
+        self.write()
+        os.utime(self.sidecar, ns=(0, 0))
+        self.write()
+        self.assertEqual(os.stat(self.sidecar).st_mtime_ns, 0)
+
+    def test_020_modified_chunk_hash_is_rewritten(self):
+        checksum = self.write()
+        with open(self.sidecar, 'r+b') as file:
+            file.seek(sgx_sign.TRUSTED_CHUNKS_HEADER.size + 32 + 5)
+            byte = file.read(1)
+            file.seek(-1, os.SEEK_CUR)
+            file.write(bytes([byte[0] ^ 0xff]))
+        self.assertNotEqual(sgx_sign.get_checksum(self.sidecar), checksum)
+
+        self.assertEqual(self.write(), checksum)
+        self.assertEqual(sgx_sign.get_checksum(self.sidecar), checksum)
+
+
+class TC_03_Flags(unittest.TestCase):
+    @staticmethod
+    def manifest(**values):
+        manifest = sgx_sign.Manifest()
+        for key, value in values.items():
+            manifest['sgx.' + key] = value
+        return manifest
+
+    def test_000_integer_flags(self):
+        (flags, _, misc_select) = sgx_sign.get_enclave_attributes(
+            self.manifest(debug='0', support_exinfo='1'))
+        self.assertFalse(int.from_bytes(flags, 'little') & sgx_sign.offs.SGX_FLAGS_DEBUG)
+        self.assertTrue(int.from_bytes(misc_select, 'little')
+                        & sgx_sign.offs.SGX_MISCSELECT_EXINFO)
+
+    def test_001_boolean_flags_are_rejected(self):
+        # the PAL reads these keys as integers and rejects booleans, so the signer does too
+        for key in ['debug', 'require_avx', 'support_exinfo']:
+            for value in ['true', 'false']:
+                with self.subTest(key=key, value=value):
+                    with self.assertRaises(Exception):
+                        sgx_sign.get_enclave_attributes(self.manifest(**{key: value}))
+
+        manifest = self.manifest(enclave_size='"256M"', static_address='true')
+        attr = sgx_sign.get_attributes(manifest)
+        with self.assertRaises(Exception):
+            sgx_sign.get_enclave_base(manifest, attr, [])
@@ -1,3 +1,5 @@
+#include <asm/fcntl.h>
+#include <asm/stat.h>
 #include <stdbool.h>
 
 #include "api.h"
@@ -19,7 +21,9 @@ __sgx_mem_aligned struct pal_enclave_state g_pal_enclave_state;
 void* g_enclave_base;
 void* g_enclave_top;
 
-static int register_trusted_file(const char* uri, const char* checksum_str, bool check_duplicates);
+static int register_trusted_file(const char* uri, const char* checksum_str,
+                                 const char* chunks_uri, const char* chunks_checksum_str,
+                                 bool check_duplicates);
 
 bool sgx_is_completely_within_enclave(const void* addr, size_t size) {
     if ((uintptr_t)addr > UINTPTR_MAX - size) {
@@ -238,21 +242,56 @@ int init_enclave_key(void) {
  * hashes are stored as "stubs" for each file. For a performance reason,
  * each per-chunk hash is a 128-bit AES-CMAC hash value, using a secret
  * key generated at the beginning of the enclave.
+ *
+ * For large files, hashing the whole file on the first open is expensive. The signer can
+ * therefore produce a sidecar file with a SHA256 hash of every chunk (listed in the manifest as
+ * "sgx.trusted_chunks.xxx", with its own checksum in "sgx.trusted_chunks_checksum.xxx"). If such
+ * a sidecar is present, it is verified and loaded on the first open instead of hashing the file,
+ * and each chunk is checked against its SHA256 hash the first time it is read; only then is its
+ * AES-CMAC stub computed and used for all subsequent reads.
  */
 
+#define TRUSTED_CHUNKS_MAGIC "GSGXCHNK"
+
+/* Header of the sidecar file, followed by one SHA256 hash per chunk of TRUSTED_STUB_SIZE bytes.
+ * All integers are little-endian. */
+struct trusted_chunks_header {
+    char magic[8];
+    uint64_t chunk_size;
+    uint64_t file_size;
+    sgx_checksum_t file_checksum;
+};
+
+static_assert(sizeof(struct trusted_chunks_header) == 8 + 8 + 8 + sizeof(sgx_checksum_t),
+              "unexpected padding in struct trusted_chunks_header");
+
+/* Users of trusted files only see `stubs`; the rest is recovered via container_of() */
+struct trusted_file_stubs {
+    sgx_checksum_t* chunk_hashes; /* NULL if the whole file was hashed on open */
+    uint8_t* chunk_verified;      /* non-zero once the stub of the chunk is valid */
+    sgx_stub_t stubs[];
+};
+
 DEFINE_LIST(trusted_file);
 struct trusted_file {
     LIST_TYPE(trusted_file) list;
+    UT_hash_handle hh;
     uint64_t size;
     bool allowed;
     sgx_checksum_t checksum;
+    char* chunks_uri; /* sidecar with per-chunk hashes, or NULL */
+    sgx_checksum_t chunks_checksum;
     sgx_stub_t* stubs;
     size_t uri_len;
     char uri[]; /* must be NULL-terminated */
 };
 
+/* Trusted files (with checksums) are looked up by exact URI, so they are kept in a hash table;
+ * allowed files match all paths below them, so they are kept in a list which is searched in the
+ * order of registration. Trusted files take precedence, as they are registered first. */
 DEFINE_LISTP(trusted_file);
-static LISTP_TYPE(trusted_file) g_trusted_file_list = LISTP_INIT;
+static struct trusted_file* g_trusted_file_map = NULL;
+static LISTP_TYPE(trusted_file) g_allowed_file_list = LISTP_INIT;
 static spinlock_t g_trusted_file_lock = INIT_SPINLOCK_UNLOCKED;
 static int g_file_check_policy = FILE_CHECK_POLICY_STRICT;
 
@@ -279,6 +318,183 @@ static bool path_is_equal_or_subpath(const struct trusted_file* tf, const char*
     return false;
 }
 
+/* Must be called with g_trusted_file_lock held */
+static struct trusted_file* find_registered_file(const char* uri, size_t uri_len) {
+    struct trusted_file* tf = NULL;
+    HASH_FIND(hh, g_trusted_file_map, uri, uri_len, tf);
+    if (tf)
+        return tf;
+
+    LISTP_FOR_EACH_ENTRY(tf, &g_allowed_file_list, list) {
+        if (tf->uri_len == uri_len && !memcmp(tf->uri, uri, uri_len))
+            return tf;
+    }
+    return NULL;
+}
+
+static void free_trusted_file_stubs(struct trusted_file_stubs* container) {
+    if (!container)
+        return;
+    free(container->chunk_hashes);
+    free(container->chunk_verified);
+    free(container);
+}
+
+/*
+ * Load the per-chunk SHA256 hashes of `tf` from its sidecar file. The sidecar is copied into the
+ * enclave before it is hashed and checked against `tf->chunks_checksum`, and its header must
+ * describe exactly the file listed in the manifest.
+ */
+static int load_chunk_hashes(struct trusted_file* tf, size_t nchunks,
+                             sgx_checksum_t** chunk_hashes_ptr) {
+    struct trusted_chunks_header header;
+    sgx_checksum_t* chunk_hashes = NULL;
+    void* umem = NULL;
+    size_t hashes_size = nchunks * sizeof(sgx_checksum_t);
+    size_t total_size = sizeof(header) + hashes_size;
+    int ret;
+
+    int fd = ocall_open(tf->chunks_uri + URI_PREFIX_FILE_LEN, O_RDONLY | O_CLOEXEC, 0);
+    if (IS_ERR(fd)) {
+        SGX_DBG(DBG_E, "Cannot open chunk hashes of %s: %s\n", tf->uri, tf->chunks_uri);
+        return unix_to_pal_error(ERRNO(fd));
+    }
+
+    struct stat st;
+    ret = ocall_fstat(fd, &st);
+    if (IS_ERR(ret)) {
+        ret = unix_to_pal_error(ERRNO(ret));
+        goto out;
+    }
+    if ((uint64_t)st.st_size != total_size) {
+        ret = -PAL_ERROR_DENIED;
+        goto out;
+    }
+
+    ret = ocall_mmap_untrusted(fd, 0, total_size, PROT_READ, &umem);
+    if (IS_ERR(ret)) {
+        umem = NULL;
+        ret = unix_to_pal_error(ERRNO(ret));
+        goto out;
+    }
+
+    chunk_hashes = malloc(hashes_size ?: 1);
+    if (!chunk_hashes) {
+        ret = -PAL_ERROR_NOMEM;
+        goto out;
+    }
+
+    /* copy into the enclave first, so that the host cannot change the contents after checking */
+    memcpy(&header, umem, sizeof(header));
+    memcpy(chunk_hashes, umem + sizeof(header), hashes_size);
+
+    LIB_SHA256_CONTEXT sha;
+    sgx_checksum_t hash;
+    ret = lib_SHA256Init(&sha);
+    if (ret < 0)
+        goto out;
+    ret = lib_SHA256Update(&sha, (uint8_t*)&header, sizeof(header));
+    if (ret < 0)
+        goto out;
+    ret = lib_SHA256Update(&sha, (uint8_t*)chunk_hashes, hashes_size);
+    if (ret < 0)
+        goto out;
+    ret = lib_SHA256Final(&sha, (uint8_t*)hash.bytes);
+    if (ret < 0)
+        goto out;
+
+    if (memcmp(&hash, &tf->chunks_checksum, sizeof(hash))
+            || memcmp(header.magic, TRUSTED_CHUNKS_MAGIC, sizeof(header.magic))
+            || header.chunk_size != TRUSTED_STUB_SIZE
+            || header.file_size != tf->size
+            || memcmp(&header.file_checksum, &tf->checksum, sizeof(tf->checksum))) {
+        SGX_DBG(DBG_E, "Chunk hashes of %s do not match the manifest\n", tf->uri);
+        ret = -PAL_ERROR_DENIED;
+        goto out;
+    }
+
+    *chunk_hashes_ptr = chunk_hashes;
+    chunk_hashes = NULL;
+    ret = 0;
+out:
+    if (umem)
+        ocall_munmap_untrusted(umem, total_size);
+    ocall_close(fd);
+    free(chunk_hashes);
+    return ret;
+}
+
+/*
+ * To prevent TOCTOU attack when generating the file checksum, we
+ * need to copy the file content into the enclave before hashing.
+ * For optimization, we use a relatively small buffer (1024 byte) to
+ * store the data for checksum generation.
+ */
+#define FILE_CHUNK_SIZE 1024UL
+
+/* Hash the whole file, check it against the manifest and generate the stubs of all chunks */
+static int compute_trusted_file_stubs(struct trusted_file* tf, const void* umem,
+                                      sgx_stub_t* stubs) {
+    sgx_stub_t* s = stubs; /* stubs is an array of 128bit values */
+    uint64_t offset = 0;
+    LIB_SHA256_CONTEXT sha;
+    int ret;
+
+    ret = lib_SHA256Init(&sha);
+    if (ret < 0)
+        return ret;
+
+    for (; offset < tf->size; offset += TRUSTED_STUB_SIZE, s++) {
+        /* For each stub, generate a 128bit hash of a file chunk with
+         * AES-CMAC, and then update the SHA256 digest. */
+        uint64_t mapping_size = MIN(tf->size - offset, TRUSTED_STUB_SIZE);
+        LIB_AESCMAC_CONTEXT aes_cmac;
+        ret = lib_AESCMACInit(&aes_cmac, (uint8_t*)&g_enclave_key, sizeof(g_enclave_key));
+        if (ret < 0)
+            return ret;
+
+        uint8_t small_chunk[FILE_CHUNK_SIZE]; /* Buffer for hashing */
+        size_t chunk_offset = 0;
+
+        for (; chunk_offset < mapping_size; chunk_offset += FILE_CHUNK_SIZE) {
+            uint64_t chunk_size = MIN(mapping_size - chunk_offset, FILE_CHUNK_SIZE);
+
+            /* Any file content needs to be copied into the enclave before
+             * checking and re-hashing */
+            memcpy(small_chunk, umem + offset + chunk_offset, chunk_size);
+
+            /* Update the file checksum */
+            ret = lib_SHA256Update(&sha, small_chunk, chunk_size);
+            if (ret < 0)
+                return ret;
+
+            /* Update the checksum for the file chunk */
+            ret = lib_AESCMACUpdate(&aes_cmac, small_chunk, chunk_size);
+            if (ret < 0)
+                return ret;
+        }
+
+        /* Store the checksum for one file chunk for checking */
+        ret = lib_AESCMACFinish(&aes_cmac, (uint8_t*)s, sizeof(*s));
+        if (ret < 0)
+            return ret;
+    }
+
+    sgx_checksum_t hash;
+
+    /* Finalize and checking if the checksum of the whole file matches
+     * with record given in the manifest. */
+
+    ret = lib_SHA256Final(&sha, (uint8_t*)hash.bytes);
+    if (ret < 0)
+        return ret;
+
+    if (memcmp(&hash, &tf->checksum, sizeof(sgx_checksum_t)))
+        return -PAL_ERROR_DENIED;
+
+    return 0;
+}
+
 /*
  * 'load_trusted_file' checks if the file to be opened is trusted
  * or allowed for unauthenticated access, according to the manifest.
@@ -312,7 +528,7 @@ int load_trusted_file(PAL_HANDLE file, sgx_stub_t** stubptr, uint64_t* sizeptr,
 
     /* always allow creating files */
     if (create) {
-        register_trusted_file(uri, NULL, /*check_duplicates=*/true);
+        register_trusted_file(uri, NULL, NULL, NULL, /*check_duplicates=*/true);
         return 0;
     }
 
@@ -334,15 +550,12 @@ int load_trusted_file(PAL_HANDLE file, sgx_stub_t** stubptr, uint64_t* sizeptr,
 
     spinlock_lock(&g_trusted_file_lock);
 
-    LISTP_FOR_EACH_ENTRY(tmp, &g_trusted_file_list, list) {
-        if (tmp->stubs) {
-            /* trusted files: must be exactly the same URI */
-            if (tmp->uri_len == len && !memcmp(tmp->uri, normpath, len + 1)) {
-                tf = tmp;
-                break;
-            }
-        } else {
-            /* allowed files: must be a subfolder or file */
+    /* trusted files: must be exactly the same URI */
+    HASH_FIND(hh, g_trusted_file_map, normpath, len, tf);
+
+    if (!tf) {
+        /* allowed files: must be a subfolder or file */
+        LISTP_FOR_EACH_ENTRY(tmp, &g_allowed_file_list, list) {
             if (path_is_equal_or_subpath(tmp, normpath, len)) {
                 tf = tmp;
                 break;
@@ -376,7 +589,7 @@ int load_trusted_file(PAL_HANDLE file, sgx_stub_t** stubptr, uint64_t* sizeptr,
     if (!file->file.seekable)
         return -PAL_ERROR_DENIED;
 
-    sgx_stub_t* stubs = NULL;
+    struct trusted_file_stubs* container = NULL;
     /* mmap the whole trusted file in untrusted memory for future reads/writes; it is
      * caller's responsibility to unmap those areas after use */
     *sizeptr = tf->size;
@@ -397,90 +610,43 @@ int load_trusted_file(PAL_HANDLE file, sgx_stub_t** stubptr, uint64_t* sizeptr,
     }
     spinlock_unlock(&g_trusted_file_lock);
 
-    int nstubs = tf->size / TRUSTED_STUB_SIZE +
-                (tf->size % TRUSTED_STUB_SIZE ? 1 : 0);
+    size_t nstubs = tf->size / TRUSTED_STUB_SIZE +
+                   (tf->size % TRUSTED_STUB_SIZE ? 1 : 0);
 
-    stubs = malloc(sizeof(sgx_stub_t) * nstubs);
-    if (!stubs) {
+    container = malloc(sizeof(*container) + sizeof(sgx_stub_t) * nstubs);
+    if (!container) {
         ret = -PAL_ERROR_NOMEM;
         goto failed;
     }
+    container->chunk_hashes   = NULL;
+    container->chunk_verified = NULL;
 
-    sgx_stub_t* s = stubs; /* stubs is an array of 128bit values */
-    uint64_t offset = 0;
-    LIB_SHA256_CONTEXT sha;
-
-    ret = lib_SHA256Init(&sha);
-    if (ret < 0)
-        goto failed;
-
-    for (; offset < tf->size; offset += TRUSTED_STUB_SIZE, s++) {
-        /* For each stub, generate a 128bit hash of a file chunk with
-         * AES-CMAC, and then update the SHA256 digest. */
-        uint64_t mapping_size = MIN(tf->size - offset, TRUSTED_STUB_SIZE);
-        LIB_AESCMAC_CONTEXT aes_cmac;
-        ret = lib_AESCMACInit(&aes_cmac, (uint8_t*)&g_enclave_key, sizeof(g_enclave_key));
+    if (tf->chunks_uri) {
+        /* chunks are verified lazily against their precomputed hashes, see
+         * copy_and_verify_trusted_file() */
+        ret = load_chunk_hashes(tf, nstubs, &container->chunk_hashes);
         if (ret < 0)
             goto failed;
 
-        /*
-         * To prevent TOCTOU attack when generating the file checksum, we
-         * need to copy the file content into the enclave before hashing.
-         * For optimization, we use a relatively small buffer (1024 byte) to
-         * store the data for checksum generation.
-         */
-
-#define FILE_CHUNK_SIZE 1024UL
-
-        uint8_t small_chunk[FILE_CHUNK_SIZE]; /* Buffer for hashing */
-        size_t chunk_offset = 0;
-
-        for (; chunk_offset < mapping_size; chunk_offset += FILE_CHUNK_SIZE) {
-            uint64_t chunk_size = MIN(mapping_size - chunk_offset, FILE_CHUNK_SIZE);
-
-            /* Any file content needs to be copied into the enclave before
-             * checking and re-hashing */
-            memcpy(small_chunk, *umem + offset + chunk_offset, chunk_size);
-
-            /* Update the file checksum */
-            ret = lib_SHA256Update(&sha, small_chunk, chunk_size);
-            if (ret < 0)
-                goto failed;
-
-            /* Update the checksum for the file chunk */
-            ret = lib_AESCMACUpdate(&aes_cmac, small_chunk, chunk_size);
-            if (ret < 0)
-                goto failed;
+        container->chunk_verified = calloc(nstubs ?: 1, sizeof(*container->chunk_verified));
+        if (!container->chunk_verified) {
+            ret = -PAL_ERROR_NOMEM;
+            goto failed;
         }
-
-        /* Store the checksum for one file chunk for checking */
-        ret = lib_AESCMACFinish(&aes_cmac, (uint8_t*)s, sizeof(*s));
+    } else {
+        ret = compute_trusted_file_stubs(tf, *umem, container->stubs);
         if (ret < 0)
             goto failed;
     }
 
-    sgx_checksum_t hash;
-
-    /* Finalize and checking if the checksum of the whole file matches
-     * with record given in the manifest. */
-
-    ret = lib_SHA256Final(&sha, (uint8_t*)hash.bytes);
-    if (ret < 0)
-        goto failed;
-
-    if (memcmp(&hash, &tf->checksum, sizeof(sgx_checksum_t))) {
-        ret = -PAL_ERROR_DENIED;
-        goto failed;
-    }
-
     spinlock_lock(&g_trusted_file_lock);
     if (tf->stubs) {
         *stubptr = tf->stubs;
         spinlock_unlock(&g_trusted_file_lock);
-        free(stubs);
+        free_trusted_file_stubs(container);
         return 0;
     }
-    *stubptr = tf->stubs = stubs;
+    *stubptr = tf->stubs = container->stubs;
     spinlock_unlock(&g_trusted_file_lock);
     return 0;
 
@@ -489,7 +655,7 @@ failed:
         assert(*sizeptr > 0);
         ocall_munmap_untrusted(*umem, *sizeptr);
     }
-    free(stubs);
+    free_trusted_file_stubs(container);
 
     return ret;
 }
@@ -530,7 +696,9 @@ static void set_file_check_policy(int policy) {
  * either aligned, or equal to 'total_size'. 'buffer' is the in-enclave
  * buffer for copying the file content. 'offset' is the offset within the file
  * for copying into the buffer. 'size' is the size of the in-enclave buffer.
- * 'stubs' contain the checksums of all the chunks in a file.
+ * 'stubs' contain the checksums of all the chunks in a file. If the file came with
+ * precomputed chunk hashes, a chunk that is read for the first time is checked against its
+ * SHA256 hash instead, and its stub is filled in for later reads.
  */
 int copy_and_verify_trusted_file(const char* path, const void* umem, uint64_t umem_start,
                                  uint64_t umem_end, void* buffer, uint64_t offset, uint64_t size,
@@ -548,14 +716,27 @@ int copy_and_verify_trusted_file(const char* path, const void* umem, uint64_t um
      * from the beginning of the file. 's' points to the stub that needs to
      * be checked for the current offset. */
     sgx_stub_t* s = stubs + checking / TRUSTED_STUB_SIZE;
+    struct trusted_file_stubs* container = container_of(stubs, struct trusted_file_stubs, stubs);
     int ret = 0;
 
     for (; checking < umem_end; checking += TRUSTED_STUB_SIZE, s++) {
         /* Check one chunk at a time. */
         uint64_t checking_size = MIN(total_size - checking, TRUSTED_STUB_SIZE);
         uint64_t checking_end = checking + checking_size;
+        size_t chunk_idx = s - stubs;
         sgx_checksum_t hash;
 
+        /* The stub of a chunk is only valid once the chunk was checked against its hash; pairs
+         * with the release store below */
+        bool first_read = container->chunk_hashes &&
+                          !__atomic_load_n(&container->chunk_verified[chunk_idx], __ATOMIC_ACQUIRE);
+        LIB_SHA256_CONTEXT sha;
+        if (first_read) {
+            ret = lib_SHA256Init(&sha);
+            if (ret < 0)
+                goto failed;
+        }
+
         if (checking >= offset && checking_end <= offset + size) {
             /* If the checking chunk completely overlaps with the region
              * needed for copying into the buffer, simplying use the buffer
@@ -566,6 +747,8 @@ int copy_and_verify_trusted_file(const char* path, const void* umem, uint64_t um
             ret = lib_AESCMAC((uint8_t*)&g_enclave_key, sizeof(g_enclave_key),
                               buffer + checking - offset, checking_size, (uint8_t*)&hash,
                               sizeof(hash));
+            if (ret >= 0 && first_read)
+                ret = lib_SHA256Update(&sha, buffer + checking - offset, checking_size);
         } else {
             /* If the checking chunk only partially overlaps with the region,
              * read the file content in smaller chunks and only copy the part
@@ -589,6 +772,12 @@ int copy_and_verify_trusted_file(const char* path, const void* umem, uint64_t um
                 if (ret < 0)
                     goto failed;
 
+                if (first_read) {
+                    ret = lib_SHA256Update(&sha, small_chunk, chunk_size);
+                    if (ret < 0)
+                        goto failed;
+                }
+
                 /* Determine if the part just copied and checked is needed
                  * by the caller. If so, copy it into the user buffer. */
                 uint64_t copy_start = chunk_offset;
@@ -612,6 +801,26 @@ int copy_and_verify_trusted_file(const char* path, const void* umem, uint64_t um
         if (ret < 0)
             goto failed;
 
+        if (first_read) {
+            sgx_checksum_t chunk_hash;
+            ret = lib_SHA256Final(&sha, (uint8_t*)chunk_hash.bytes);
+            if (ret < 0)
+                goto failed;
+
+            if (memcmp(&chunk_hash, &container->chunk_hashes[chunk_idx], sizeof(chunk_hash))) {
+                SGX_DBG(DBG_E,
+                        "Accesing file:%s is denied. Does not match with hash at chunk starting "
+                        "at %lu-%lu.\n",
+                        path, checking, checking_end);
+                return -PAL_ERROR_DENIED;
+            }
+
+            /* Concurrent readers of the same chunk store the same stub */
+            memcpy(s, &hash, sizeof(*s));
+            __atomic_store_n(&container->chunk_verified[chunk_idx], 1, __ATOMIC_RELEASE);
+            continue;
+        }
+
         /*
          * Check if the hash matches with the checksum of current chunk.
          * If not, return with access denied. Note: some file content may
@@ -636,7 +845,23 @@ failed:
     return -PAL_ERROR_DENIED;
 }
 
-static int register_trusted_file(const char* uri, const char* checksum_str, bool check_duplicates) {
+static int parse_checksum(const char* checksum_str, sgx_checksum_t* checksum) {
+    assert(strlen(checksum_str) >= sizeof(sgx_checksum_t) * 2);
+    for (size_t i = 0; i < sizeof(sgx_checksum_t); i++) {
+        int8_t byte1 = hex2dec(checksum_str[i * 2]);
+        int8_t byte2 = hex2dec(checksum_str[i * 2 + 1]);
+
+        if (byte1 < 0 || byte2 < 0)
+            return -PAL_ERROR_INVAL;
+
+        checksum->bytes[i] = byte1 * 16 + byte2;
+    }
+    return 0;
+}
+
+static int register_trusted_file(const char* uri, const char* checksum_str,
+                                 const char* chunks_uri, const char* chunks_checksum_str,
+                                 bool check_duplicates) {
     int ret;
 
     size_t uri_len = strlen(uri);
@@ -650,25 +875,26 @@ static int register_trusted_file(const char* uri, const char* checksum_str, bool
          * initialization (because manifest is assumed to have no duplicates); skipping this check
          * significantly improves startup time */
         spinlock_lock(&g_trusted_file_lock);
-        struct trusted_file* tf;
-        LISTP_FOR_EACH_ENTRY(tf, &g_trusted_file_list, list) {
-            if (tf->uri_len == uri_len && !memcmp(tf->uri, uri, uri_len)) {
-                spinlock_unlock(&g_trusted_file_lock);
-                return 0;
-            }
+        if (find_registered_file(uri, uri_len)) {
+            spinlock_unlock(&g_trusted_file_lock);
+            return 0;
         }
         spinlock_unlock(&g_trusted_file_lock);
     }
 
-    struct trusted_file* new = malloc(sizeof(*new) + uri_len + 1);
+    /* the URI of the chunk hashes (if any) is stored right after the URI of the file */
+    size_t chunks_uri_len = chunks_uri ? strlen(chunks_uri) : 0;
+    struct trusted_file* new = malloc(sizeof(*new) + uri_len + 1 +
+                                      (chunks_uri ? chunks_uri_len + 1 : 0));
     if (!new)
         return -PAL_ERROR_NOMEM;
 
     INIT_LIST_HEAD(new, list);
-    new->size    = 0;
-    new->stubs   = NULL;
-    new->allowed = false;
-    new->uri_len = uri_len;
+    new->size       = 0;
+    new->stubs      = NULL;
+    new->chunks_uri = NULL;
+    new->allowed    = false;
+    new->uri_len    = uri_len;
     memcpy(new->uri, uri, uri_len + 1);
 
     if (checksum_str) {
@@ -681,18 +907,22 @@ static int register_trusted_file(const char* uri, const char* checksum_str, bool
         }
         new->size = attr.pending_size;
 
-        assert(strlen(checksum_str) >= sizeof(sgx_checksum_t) * 2);
-        for (size_t i = 0; i < sizeof(sgx_checksum_t); i++) {
-            int8_t byte1 = hex2dec(checksum_str[i * 2]);
-            int8_t byte2 = hex2dec(checksum_str[i * 2 + 1]);
+        ret = parse_checksum(checksum_str, &new->checksum);
+        if (ret < 0) {
+            SGX_DBG(DBG_E, "Could not parse checksum of file: %s\n", uri);
+            free(new);
+            return ret;
+        }
 
-            if (byte1 < 0 || byte2 < 0) {
-                SGX_DBG(DBG_E, "Could not parse checksum of file: %s\n", uri);
+        if (chunks_uri) {
+            ret = parse_checksum(chunks_checksum_str, &new->chunks_checksum);
+            if (ret < 0) {
+                SGX_DBG(DBG_E, "Could not parse checksum of chunk hashes: %s\n", chunks_uri);
                 free(new);
-                return -PAL_ERROR_INVAL;
+                return ret;
             }
-
-            new->checksum.bytes[i] = byte1 * 16 + byte2;
+            new->chunks_uri = new->uri + uri_len + 1;
+            memcpy(new->chunks_uri, chunks_uri, chunks_uri_len + 1);
         }
 
         SGX_DBG(DBG_S, "trusted: %s\n", new->uri);
@@ -707,17 +937,26 @@ static int register_trusted_file(const char* uri, const char* checksum_str, bool
     if (check_duplicates) {
         /* this check is only done during runtime and not needed during initialization (see above);
          * we check again because same file could have been added by another thread in meantime */
-        struct trusted_file* tf;
-        LISTP_FOR_EACH_ENTRY(tf, &g_trusted_file_list, list) {
-            if (tf->uri_len == uri_len && !memcmp(tf->uri, uri, uri_len)) {
-                spinlock_unlock(&g_trusted_file_lock);
-                free(new);
-                return 0;
-            }
+        if (find_registered_file(uri, uri_len)) {
+            spinlock_unlock(&g_trusted_file_lock);
+            free(new);
+            return 0;
         }
     }
 
-    LISTP_ADD_TAIL(new, &g_trusted_file_list, list);
+    if (new->allowed) {
+        LISTP_ADD_TAIL(new, &g_allowed_file_list, list);
+    } else {
+        struct trusted_file* tf = NULL;
+        HASH_FIND(hh, g_trusted_file_map, new->uri, uri_len, tf);
+        if (tf) {
+            /* same file listed under several keys: the first one wins */
+            spinlock_unlock(&g_trusted_file_lock);
+            free(new);
+            return 0;
+        }
+        HASH_ADD_KEYPTR(hh, g_trusted_file_map, new->uri, uri_len, new);
+    }
     spinlock_unlock(&g_trusted_file_lock);
 
     return 0;
@@ -733,6 +972,10 @@ static int init_trusted_file(const char* key, const char* uri) {
         return -PAL_ERROR_NOMEM;
 
     char* trusted_checksum = NULL;
+    char* chunks_key = NULL;
+    char* chunks_checksum_key = NULL;
+    char* chunks_uri = NULL;
+    char* chunks_checksum = NULL;
     ret = toml_string_in(g_pal_state.manifest_root, fullkey, &trusted_checksum);
     if (ret < 0) {
         SGX_DBG(DBG_E, "Cannot parse \'%s\' (the value must be put in double quotes!)\n", fullkey);
@@ -740,6 +983,39 @@ static int init_trusted_file(const char* key, const char* uri) {
         goto out;
     }
 
+    /* read optional sgx.trusted_chunks.<key> and sgx.trusted_chunks_checksum.<key> entries */
+    chunks_key = alloc_concat("sgx.trusted_chunks.", static_strlen("sgx.trusted_chunks."), key,
+                              strlen(key));
+    chunks_checksum_key = alloc_concat("sgx.trusted_chunks_checksum.",
+                                       static_strlen("sgx.trusted_chunks_checksum."), key,
+                                       strlen(key));
+    if (!chunks_key || !chunks_checksum_key) {
+        ret = -PAL_ERROR_NOMEM;
+        goto out;
+    }
+
+    ret = toml_string_in(g_pal_state.manifest_root, chunks_key, &chunks_uri);
+    if (ret < 0) {
+        SGX_DBG(DBG_E, "Cannot parse \'%s\' (the value must be put in double quotes!)\n",
+                chunks_key);
+        ret = -PAL_ERROR_INVAL;
+        goto out;
+    }
+    ret = toml_string_in(g_pal_state.manifest_root, chunks_checksum_key, &chunks_checksum);
+    if (ret < 0) {
+        SGX_DBG(DBG_E, "Cannot parse \'%s\' (the value must be put in double quotes!)\n",
+                chunks_checksum_key);
+        ret = -PAL_ERROR_INVAL;
+        goto out;
+    }
+    if (chunks_uri && (!trusted_checksum || !chunks_checksum
+                       || !strstartswith(chunks_uri, URI_PREFIX_FILE))) {
+        SGX_DBG(DBG_E, "Invalid \'%s\': it must be a 'file:' URI and come with \'%s\'\n",
+                chunks_key, chunks_checksum_key);
+        ret = -PAL_ERROR_INVAL;
+        goto out;
+    }
+
     /* Normalize the uri */
     char normpath[URI_MAX] = URI_PREFIX_FILE;
     if (!strstartswith(uri, URI_PREFIX_FILE)) {
@@ -755,8 +1031,13 @@ static int init_trusted_file(const char* key, const char* uri) {
         goto out;
     }
 
-    ret = register_trusted_file(normpath, trusted_checksum, /*check_duplicates=*/false);
+    ret = register_trusted_file(normpath, trusted_checksum, chunks_uri, chunks_checksum,
+                                /*check_duplicates=*/false);
 out:
+    free(chunks_checksum);
+    free(chunks_uri);
+    free(chunks_checksum_key);
+    free(chunks_key);
     free(trusted_checksum);
     free(fullkey);
     return ret;
@@ -889,7 +1170,7 @@ no_trusted:
             return ret;
         }
 
-        register_trusted_file(norm_path, NULL, /*check_duplicates=*/false);
+        register_trusted_file(norm_path, NULL, NULL, NULL, /*check_duplicates=*/false);
     }
 
 no_allowed:
@@ -151,6 +151,7 @@ __attribute__((__used__)) static void dummy(void) {
     DEFINE(ENCLAVE_SIG_STACK_SIZE, ENCLAVE_SIG_STACK_SIZE);
     DEFINE(DEFAULT_ENCLAVE_BASE, DEFAULT_ENCLAVE_BASE);
     DEFINE(MMAP_MIN_ADDR, MMAP_MIN_ADDR);
+    DEFINE(TRUSTED_STUB_SIZE, TRUSTED_STUB_SIZE);
 
     /* pal_linux.h */
     DEFINE(PAGESIZE, PRESET_PAGESIZE);
@@ -5,16 +5,57 @@
 
 
 import argparse
+import concurrent.futures
+import hashlib
+import json
 import os
 import re
+import shutil
+import struct
 import subprocess
 import sys
+import time
 import jinja2
 
-def is_ascii(chars):
-    return all(ord(c) < 128 for c in chars)
+# Tells sign_manifests.py that the manifests hold checksums of trusted files from image layers
+LAYER_CHECKSUMS_USED_FILE = 'layer_checksums_used'
 
-def generate_trusted_files(root_dir):
+# The manifest syntax does not support other encodings (e.g., UTF-8), so trusted files must have
+# ascii-only names.
+non_ascii_re = re.compile(r'[^\x00-\x7f]')
+
+def scan_directory(path, exclude_re, script_file):
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                filename = os.path.join(path, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    # Exclusions are prefix patterns, so a matching directory excludes its subtree
+                    if not exclude_re.match(filename + '/'):
+                        subdirs.append(filename)
+                elif (entry.is_file()
+                      and not exclude_re.match(filename)
+                      and not non_ascii_re.search(filename)
+                      and filename != script_file):
+                    files.append(filename)
+    except OSError:
+        pass
+    return files, subdirs
+
+def walk_tree(path, exclude_re, script_file):
+    start = time.monotonic()
+    files = []
+    # Depth-first with files before subdirectories, i.e. the same order as os.walk()
+    stack = [path]
+    while stack:
+        dir_files, subdirs = scan_directory(stack.pop(), exclude_re, script_file)
+        files.extend(dir_files)
+        stack.extend(reversed(subdirs))
+    return files, time.monotonic() - start
+
+def generate_trusted_files(root_dir, jobs=None):
     cwd = os.getcwd() if os.getcwd() != '/' else ''
     # Exclude files and paths from list of trusted files
     excluded_paths_regex = (r'^/('
@@ -27,28 +68,328 @@ def generate_trusted_files(root_dir):
                                 r'|var/.*)'
                             f'|^{cwd}/('
                                 r'.*\.manifest'
+                                r'|build_start_marker'
                                 r'|finalize_manifests\.py'
+                                r'|layer_checksums\.json'
                                 r'|sign_manifests\.py)$')
     exclude_re = re.compile(excluded_paths_regex)
-    num_trusted = 0
-    trusted_files = ''
     script_file = os.path.basename(__file__)
 
-    for root, _, files in os.walk(root_dir, followlinks=False):
-        for file in files:
-            filename = os.path.join(root, file)
-            if  (not exclude_re.match(filename)
-                # The check for ascii-only characters is required, since the manifest syntax does
-                # not support other encodings (e.g., UTF-8).
-                and is_ascii(filename)
-                and os.path.isfile(filename)
-                and filename != script_file):
-                trusted_files += f'sgx.trusted_files.file{num_trusted} = "file:{filename}"\n'
-                num_trusted += 1
+    start = time.monotonic()
+    root_files, top_dirs = scan_directory(root_dir, exclude_re, script_file)
+
+    # Every subtree below the top-level directories is walked by a separate worker; the results
+    # are put back together in walk order, so the numbering of trusted files is stable.
+    subtrees = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for top_dir in top_dirs:
+            top_start = time.monotonic()
+            files, subdirs = scan_directory(top_dir, exclude_re, script_file)
+            futures = [executor.submit(walk_tree, subdir, exclude_re, script_file)
+                       for subdir in subdirs]
+            subtrees.append((top_dir, files, time.monotonic() - top_start, futures))
+
+        trusted = list(root_files)
+        stats = []
+        for top_dir, files, elapsed, futures in subtrees:
+            trusted.extend(files)
+            num_files = len(files)
+            for future in futures:
+                subdir_files, subdir_elapsed = future.result()
+                trusted.extend(subdir_files)
+                num_files += len(subdir_files)
+                elapsed += subdir_elapsed
+            stats.append((top_dir, num_files, elapsed))
+
+    for top_dir, num_files, elapsed in stats:
+        if num_files:
+            print(f'\t{top_dir}: {num_files} files ({elapsed:.2f}s)')
+    print(f'Found {len(trusted)} files in \'{root_dir}\' ({time.monotonic() - start:.2f}s).')
+
+    return trusted
+
+def format_trusted_files(trusted, checksums=None):
+    lines = []
+    for i, filename in enumerate(trusted):
+        lines.append(f'sgx.trusted_files.file{i} = "file:{filename}"\n')
+        if checksums is not None and checksums[i] is not None:
+            lines.append(f'sgx.trusted_checksum.file{i} = "{checksums[i]}"\n')
+    return ''.join(lines)
+
+# Checksums from image layers
+#
+# gsc hashes the files of every layer of the base image once and caches the result by the layer
+# digest (see get_layer_checksums() in gsc.py). The merged checksums of the base image are passed
+# in as {path: [size, mtime, sha256]}; only files that were added or modified on top of the base
+# image (e.g. the Graphene runtime and packages installed by GSC) are hashed here. The signer
+# takes over the checksums with `--keep-checksums`.
+#
+# Size and mtime alone do not prove that a file is unchanged: package managers and `cp -p` restore
+# the mtime of the files they write. Any change of a file sets its ctime to the current time,
+# though, so a checksum is only reused for files whose ctime is older than the marker file
+# created by the first step of the build.
+
+def get_checksum(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_trusted_checksums(trusted, layer_checksums_file, build_start_marker, jobs=None):
+    start = time.monotonic()
+    with open(layer_checksums_file, 'r') as file:
+        layer_checksums = json.load(file)
+    build_start = os.stat(build_start_marker).st_mtime_ns
+
+    checksums = [None] * len(trusted)
+    to_hash = []
+    reused = 0
+    for i, filename in enumerate(trusted):
+        realpath = os.path.realpath(filename)
+        try:
+            stat = os.stat(realpath)
+        except OSError:
+            continue
+        entry = layer_checksums.get(realpath)
+        # Docker restores the (whole-second) mtime of files from the layer
+        if (entry is not None and entry[0] == stat.st_size and entry[1] == int(stat.st_mtime)
+                and stat.st_ctime_ns < build_start):
+            checksums[i] = entry[2]
+            reused += 1
+        else:
+            to_hash.append(i)
+
+    # hashlib releases the GIL while hashing, so threads are enough
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for i, checksum in zip(to_hash, executor.map(get_checksum,
+                                                     [trusted[i] for i in to_hash])):
+            checksums[i] = checksum
+
+    print(f'Checksums of trusted files: {reused} from image layers, '
+          f'{len(to_hash)} hashed ({time.monotonic() - start:.2f}s).')
+
+    return checksums
+
+# Pruning of trusted files
+#
+# Instead of trusting every file of the image, only keep the files the entrypoint binaries can
+# load: the closure of their ELF interpreters and DT_NEEDED libraries (resolved the way the
+# dynamic loader does), the interpreters of scripts, and everything listed in traces of a
+# Graphene run with `sgx.file_check_policy = "allow_all_but_log"`.
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+DEFAULT_LIBRARY_DIRS = ('/lib64', '/usr/lib64', '/lib', '/usr/lib')
+
+# Graphene's runtime (glibc, libsysdb.so) is always needed
+ALWAYS_TRUSTED_PREFIXES = ('/graphene/Runtime/',)
+
+TRACE_LINE_RE = re.compile(r'file_check_policy settings: file:(.*)$')
+
+def read_cstring(file, offset):
+    file.seek(offset)
+    data = b''
+    while b'\0' not in data:
+        chunk = file.read(256)
+        if not chunk:
+            break
+        data += chunk
+    return os.fsdecode(data.split(b'\0', 1)[0])
+
+# Returns (interpreter, needed libraries, rpath, runpath) of an x86-64 ELF file, None otherwise.
+def read_elf_dependencies(path):
+    # pylint: disable=too-many-locals
+    try:
+        with open(path, 'rb') as file:
+            ehdr = file.read(64)
+            # 64-bit, little-endian
+            if len(ehdr) < 64 or ehdr[:4] != b'\x7fELF' or ehdr[4] != 2 or ehdr[5] != 1:
+                return None
+            phoff, = struct.unpack_from('<Q', ehdr, 32)
+            phentsize, phnum = struct.unpack_from('<HH', ehdr, 54)
+            file.seek(phoff)
+            phdrs = file.read(phentsize * phnum)
+
+            loads = []
+            dynamic = None
+            interp = None
+            for i in range(min(phnum, len(phdrs) // phentsize)):
+                p_type, _, p_offset, p_vaddr, _, p_filesz, _, _ = struct.unpack_from(
+                    '<IIQQQQQQ', phdrs, i * phentsize)
+                if p_type == PT_LOAD:
+                    loads.append((p_vaddr, p_offset, p_filesz))
+                elif p_type == PT_DYNAMIC:
+                    dynamic = (p_offset, p_filesz)
+                elif p_type == PT_INTERP:
+                    interp = read_cstring(file, p_offset)
 
-    print(f'Found {num_trusted} files in \'{root_dir}\'.')
+            if dynamic is None:
+                return interp, [], [], []
 
-    return trusted_files
+            file.seek(dynamic[0])
+            data = file.read(dynamic[1])
+            entries = {DT_NEEDED: [], DT_RPATH: [], DT_RUNPATH: []}
+            strtab = None
+            for d_tag, d_val in struct.iter_unpack('<qQ', data[:len(data) // 16 * 16]):
+                if d_tag == DT_NULL:
+                    break
+                if d_tag == DT_STRTAB:
+                    strtab = d_val
+                elif d_tag in entries:
+                    entries[d_tag].append(d_val)
+
+            # DT_STRTAB is a virtual address, translate it into a file offset
+            strtab_offset = None
+            for vaddr, offset, filesz in loads:
+                if strtab is not None and vaddr <= strtab < vaddr + filesz:
+                    strtab_offset = strtab - vaddr + offset
+            if strtab_offset is None:
+                return interp, [], [], []
+
+            def strings(tag):
+                return [read_cstring(file, strtab_offset + val) for val in entries[tag]]
+
+            return interp, strings(DT_NEEDED), strings(DT_RPATH), strings(DT_RUNPATH)
+    except (OSError, struct.error):
+        return None
+
+# Returns the interpreter(s) of a `#!` script
+def read_script_interpreters(path):
+    try:
+        with open(path, 'rb') as file:
+            line = file.readline(256)
+    except OSError:
+        return []
+    if not line.startswith(b'#!'):
+        return []
+    tokens = os.fsdecode(line[2:]).split()
+    if not tokens:
+        return []
+    interpreters = [tokens[0]]
+    # `#!/usr/bin/env python3`
+    if os.path.basename(tokens[0]) == 'env' and len(tokens) > 1:
+        interpreter = shutil.which(tokens[1])
+        if interpreter is not None:
+            interpreters.append(interpreter)
+    return interpreters
+
+def expand_search_path(paths, origin):
+    dirs = []
+    for path in paths:
+        for directory in path.split(':'):
+            if directory:
+                dirs.append(directory.replace('${ORIGIN}', origin).replace('$ORIGIN', origin))
+    return dirs
+
+def resolve_library(name, search_dirs):
+    if '/' in name:
+        return name if os.path.isfile(name) else None
+    for directory in search_dirs:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+# Computes the set of files the given binaries can load through ELF dependencies and script
+# interpreters. Returns it together with the libraries that could not be resolved.
+def get_dependency_closure(binaries, library_dirs):
+    closure = set()
+    unresolved = set()
+    pending = list(binaries)
+    while pending:
+        path = os.path.normpath(pending.pop())
+        if path in closure:
+            continue
+        # Keep the name the file is opened with, the same name in the canonical directory (e.g.
+        # /lib may be a symlink to /usr/lib) and the target of a symlink
+        realpath = os.path.realpath(path)
+        closure.update((path, realpath,
+                        os.path.join(os.path.realpath(os.path.dirname(path)),
+                                     os.path.basename(path))))
+
+        deps = read_elf_dependencies(path)
+        if deps is None:
+            pending.extend(read_script_interpreters(path))
+            continue
+
+        interp, needed, rpath, runpath = deps
+        if interp:
+            pending.append(interp)
+        origin = os.path.dirname(realpath)
+        # DT_RPATH is ignored if DT_RUNPATH is present
+        search_dirs = (expand_search_path(rpath if not runpath else [], origin)
+                       + library_dirs
+                       + expand_search_path(runpath, origin)
+                       + list(DEFAULT_LIBRARY_DIRS))
+        for name in needed:
+            library = resolve_library(name, search_dirs)
+            if library is None:
+                unresolved.add(name)
+            else:
+                pending.append(library)
+
+    return closure, unresolved
+
+# Reads the files accessed during a traced Graphene run. Besides Graphene's log, plain lists of
+# paths (or `file:` URIs) are accepted, and a listed directory allows everything below it.
+def read_trace(path):
+    files = set()
+    with open(path, 'r') as trace:
+        for line in trace:
+            line = line.rstrip('\n')
+            match = TRACE_LINE_RE.search(line)
+            if match:
+                line = match.group(1)
+            elif line.startswith('file:'):
+                line = line[len('file:'):]
+            elif not line.startswith('/'):
+                continue
+            files.add(os.path.normpath(os.path.join(os.getcwd(), line)))
+    return files
+
+def prune_trusted_files(trusted, binaries, library_paths, traces, report):
+    start = time.monotonic()
+    # library_paths is ldconfig's output squashed into one string, only keep actual directories
+    library_dirs = ['/graphene/Runtime']
+    for directory in re.findall(r'/[^:\s()]*', library_paths):
+        if directory not in library_dirs and os.path.isdir(directory):
+            library_dirs.append(directory)
+
+    traced = set()
+    for trace in traces:
+        traced |= read_trace(trace)
+    traced_prefixes = tuple(path.rstrip('/') + '/' for path in traced if os.path.isdir(path))
+
+    closure, unresolved = get_dependency_closure(binaries + sorted(traced), library_dirs)
+    for name in sorted(unresolved):
+        print(f'\tWarning: could not resolve library {name}.')
+
+    keep_prefixes = ALWAYS_TRUSTED_PREFIXES + traced_prefixes
+    kept = []
+    dropped = []
+    for filename in trusted:
+        if filename in closure or filename in traced or filename.startswith(keep_prefixes):
+            kept.append(filename)
+        else:
+            dropped.append(filename)
+
+    with open(report, 'w') as report_file:
+        for filename in dropped:
+            print(filename, file=report_file)
+
+    print(f'Pruned trusted files: kept {len(kept)}, dropped {len(dropped)} (listed in '
+          f'\'{report}\') ({time.monotonic() - start:.2f}s).')
+
+    return kept
 
 def generate_library_paths():
     ld_paths = subprocess.check_output('ldconfig -v',
@@ -76,17 +417,53 @@ argparser.add_argument('manifests',
     help='Application-specific manifest files. The first manifest will be used for the entry '
          'point of the docker image. If file does not exist, manifest will be generated '
          'without application-specific values.')
+argparser.add_argument('--prune', action='store_true',
+    help='Only trust the files the executables can load (ELF dependencies, script interpreters '
+         'and files from --trace) instead of every file found in the directory tree.')
+argparser.add_argument('--trace', action='append', default=[],
+    help='Log of a Graphene run with sgx.file_check_policy = "allow_all_but_log" (or a list of '
+         'paths) whose files are kept by --prune. Can be specified multiple times.')
+argparser.add_argument('--prune-report', default='pruned_trusted_files.txt',
+    help='File listing the trusted files dropped by --prune. '
+         'Default: pruned_trusted_files.txt')
+argparser.add_argument('--layer-checksums',
+    help='Checksums of the files of the base image layers (generated by gsc). Files which did '
+         'not change are not hashed again, and the checksums are written to the manifests. '
+         'Requires --build-start-marker.')
+argparser.add_argument('--build-start-marker',
+    help='File created by the first step of the build. Checksums from --layer-checksums are only '
+         'used for files which were not changed (ctime) after it.')
+
+def get_executable(manifest):
+    return manifest[:manifest.rfind('.manifest')] if (
+        manifest.rfind('.manifest') != -1) else manifest
 
 def main(args=None):
     args = argparser.parse_args(args[1:])
 
     if not os.path.isdir(args.directory):
         argparser.error(f'Could not find directory {args.directory}.')
+    if args.trace and not args.prune:
+        argparser.error('--trace requires --prune.')
+    if args.layer_checksums and not args.build_start_marker:
+        argparser.error('--layer-checksums requires --build-start-marker.')
 
-    trusted_files = generate_trusted_files(args.directory)
+    trusted = generate_trusted_files(args.directory)
     library_paths = generate_library_paths()
     env_path = os.getenv('PATH')
 
+    if args.prune:
+        binaries = [get_binary_path(get_executable(manifest)) for manifest in args.manifests]
+        trusted = prune_trusted_files(trusted, binaries, library_paths, args.trace,
+                                      args.prune_report)
+
+    checksums = None
+    if args.layer_checksums:
+        checksums = get_trusted_checksums(trusted, args.layer_checksums,
+                                          args.build_start_marker)
+
+    trusted_files = format_trusted_files(trusted, checksums)
+
     print(f'LD_LIBRARY_PATH = \'{library_paths}\'\nPATH = \'{env_path}\'.')
 
     env = jinja2.Environment(loader=jinja2.FileSystemLoader('.'))
@@ -104,8 +481,7 @@ def main(args=None):
     for manifest in reversed(args.manifests):
         print(f'{manifest}:')
 
-        executable = manifest[:manifest.rfind('.manifest')] if (
-            manifest.rfind('.manifest') != -1) else manifest
+        executable = get_executable(manifest)
 
         print(f'\tSetting exec file to \'{executable}\'.')
 
@@ -129,5 +505,8 @@ def main(args=None):
         with open('signing_order.txt', 'a+') as sig_order:
             print(executable, file=sig_order)
 
+    if checksums is not None:
+        open(LAYER_CHECKSUMS_USED_FILE, 'w').close()
+
 if __name__ == '__main__':
     main(sys.argv)
@@ -4,12 +4,17 @@
 #                    Anjo Vahldiek-Oberwagner <anjo.lucas.vahldiek-oberwagner@intel.com>
 
 import argparse
+import codecs
+import hashlib
+import io
 import os
 import json
 import re
 import pathlib
 import shutil
 import sys
+import tarfile
+import time
 import jinja2
 import docker  # pylint: disable=import-error
 import yaml    # pylint: disable=import-error
@@ -57,7 +62,10 @@ def generate_build_dockerfile(image, env, binary):
         dockerfile.write(env.get_template(
             f'Dockerfile.{env.globals["Distro"]}.build.template').render(binary=binary))
 
-def prepare_build_context(image, user_manifests, env, binary):
+def trusted_files_trace_name(index):
+    return f'trusted_files_trace{index}.log'
+
+def prepare_build_context(image, user_manifests, env, binary, traces):
     gsc_image = gsc_image_name(image)
     # create directory for image specific files
     os.makedirs(gsc_image, exist_ok=True)
@@ -80,6 +88,196 @@ def prepare_build_context(image, user_manifests, env, binary):
     sm_path = (pathlib.Path(gsc_image) / 'sign_manifests').with_suffix('.py')
     shutil.copyfile('sign_manifests.py', sm_path)
 
+    for i, trace in enumerate(traces):
+        shutil.copyfile(trace, pathlib.Path(gsc_image) / trusted_files_trace_name(i))
+
+# Checksums of the files in the layers of the base image
+#
+# Hashing all files of an image for the trusted files of the manifest is expensive, but most
+# rebuilds only change the topmost layers of an image. The files of every layer are therefore
+# hashed once, straight from `docker save`, and recorded in a per-layer checksum manifest keyed by
+# the digest of the layer (the `RootFS.Layers` of the image). For a build, the checksum manifests
+# of all layers are merged into the checksums of the base image, which finalize_manifests.py uses
+# for every file that was not modified on top of it.
+
+LAYER_CHECKSUMS_FILE = 'layer_checksums.json'
+LAYER_CACHE_VERSION = 1
+
+def get_layer_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'gsc', 'layers')
+
+def get_layer_cache_path(cache_dir, diff_id):
+    return os.path.join(cache_dir, diff_id.replace(':', '-') + '.json')
+
+def load_cached_layer(cache_dir, diff_id):
+    try:
+        with open(get_layer_cache_path(cache_dir, diff_id), 'r') as file:
+            layer = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if layer.get('version') != LAYER_CACHE_VERSION:
+        return None
+    return layer
+
+def store_cached_layer(cache_dir, diff_id, layer):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = get_layer_cache_path(cache_dir, diff_id)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(layer, file)
+    os.replace(path + '.tmp', path)
+
+# File-like object over the chunks returned by the Docker API
+class ChunkReader(io.RawIOBase):
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+# Computes the SHA256 of everything read through it, i.e. the diff ID of a layer
+class HashingReader(io.RawIOBase):
+    def __init__(self, file):
+        super().__init__()
+        self._file = file
+        self.sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._file.read(len(b))
+        self.sha256.update(data)
+        b[:len(data)] = data
+        return len(data)
+
+def layer_path(name):
+    if name.startswith('./'):
+        name = name[2:]
+    return '/' + name.rstrip('/')
+
+# Reads the tar archive of one layer. Returns its diff ID and the checksum manifest: size, mtime
+# and SHA256 of all regular files, plus the whiteouts (files deleted from lower layers) and opaque
+# directories (whose lower contents are hidden).
+def hash_layer(file):
+    reader = HashingReader(file)
+    layer = {'version': LAYER_CACHE_VERSION, 'files': {}, 'whiteouts': [], 'opaque': []}
+    with tarfile.open(fileobj=io.BufferedReader(reader, 1 << 20), mode='r|') as tar:
+        for member in tar:
+            path = layer_path(member.name)
+            name = os.path.basename(path)
+            if name == '.wh..wh..opq':
+                layer['opaque'].append(os.path.dirname(path))
+            elif name.startswith('.wh.'):
+                layer['whiteouts'].append(os.path.join(os.path.dirname(path), name[len('.wh.'):]))
+            elif member.isreg():
+                sha256 = hashlib.sha256()
+                content = tar.extractfile(member)
+                for chunk in iter(lambda: content.read(1 << 20), b''):
+                    sha256.update(chunk)
+                layer['files'][path] = [member.size, int(member.mtime), sha256.hexdigest()]
+            elif member.islnk():
+                target = layer['files'].get(layer_path(member.linkname))
+                if target is not None:
+                    layer['files'][path] = target
+    # the end of the archive may be followed by padding, which is part of the diff ID
+    while reader.read(1 << 20):
+        pass
+    return 'sha256:' + reader.sha256.hexdigest(), layer
+
+# Hashes the layers in `missing` (a set of diff IDs) from the `docker save` stream of the image
+def hash_image_layers(docker_image, missing, cache_dir):
+    with tarfile.open(fileobj=io.BufferedReader(ChunkReader(docker_image.save()), 1 << 20),
+                      mode='r|') as image_tar:
+        for member in image_tar:
+            if not missing:
+                break
+            if not member.isreg():
+                continue
+            if member.name.startswith('blobs/sha256/'):
+                # OCI layout, the name of a blob is its digest
+                if 'sha256:' + os.path.basename(member.name) not in missing:
+                    continue
+            elif not member.name.endswith('/layer.tar'):
+                continue
+
+            try:
+                diff_id, layer = hash_layer(image_tar.extractfile(member))
+            except tarfile.ReadError:
+                # not a layer (e.g. the image configuration)
+                continue
+            if diff_id in missing:
+                store_cached_layer(cache_dir, diff_id, layer)
+                missing.remove(diff_id)
+
+def is_hidden(path, hidden, opaque):
+    if path in hidden:
+        return True
+    while path != '/':
+        path = os.path.dirname(path)
+        if path in hidden or path in opaque:
+            return True
+    return False
+
+# Merges the checksum manifests of the layers (bottom to top) into {path: [size, mtime, sha256]}
+# of the files in the image
+def merge_layers(layers):
+    merged = {}
+    # paths deleted or replaced by upper layers hide the same path and everything below it in
+    # lower layers, opaque directories everything below them
+    hidden = set()
+    opaque = set()
+    for layer in reversed(layers):
+        for path, entry in layer['files'].items():
+            if path not in merged and not is_hidden(path, hidden, opaque):
+                merged[path] = entry
+        hidden.update(layer['files'])
+        hidden.update(layer['whiteouts'])
+        opaque.update(layer['opaque'])
+    return merged
+
+# Writes the checksums of the files in the base image to the build context. Returns whether
+# they are available.
+def generate_layer_checksums(image, docker_image, cache_dir):
+    diff_ids = docker_image.attrs['RootFS']['Layers']
+    layers = {diff_id: load_cached_layer(cache_dir, diff_id) for diff_id in diff_ids}
+    missing = {diff_id for diff_id, layer in layers.items() if layer is None}
+
+    if missing:
+        print(f'Hashing {len(missing)} of {len(diff_ids)} layers of the base image '
+              f'({len(diff_ids) - len(missing)} cached)')
+        try:
+            hash_image_layers(docker_image, missing, cache_dir)
+        except (OSError, tarfile.TarError, docker.errors.APIError) as error:
+            print(f'Warning: could not hash the layers of the base image ({error}), all trusted '
+                  f'files will be hashed during the build.')
+            return False
+        if missing:
+            print(f'Warning: could not find the layers {", ".join(sorted(missing))} of the base '
+                  f'image, all trusted files will be hashed during the build.')
+            return False
+        layers = {diff_id: load_cached_layer(cache_dir, diff_id) for diff_id in diff_ids}
+    else:
+        print(f'Using cached checksums of all {len(diff_ids)} layers of the base image')
+
+    os.makedirs(image, exist_ok=True)
+    with open(pathlib.Path(image) / LAYER_CHECKSUMS_FILE, 'w') as file:
+        json.dump(merge_layers([layers[diff_id] for diff_id in diff_ids]), file)
+    return True
+
 def extract_binary_cmd_from_image_config(config):
     entrypoint = config['Entrypoint'] or []
     num_starting_entrypoint_items = len(entrypoint)
@@ -146,7 +344,9 @@ def prepare_env(base_image, image, args, user_manifests):
             'cmd': cmd,
             'working_dir': working_dir,
             'user_manifests': ' '.join([os.path.basename(manifest)
-                                       for manifest in user_manifests[1:]])
+                                       for manifest in user_manifests[1:]]),
+            'trusted_files_traces': [trusted_files_trace_name(i)
+                                     for i in range(len(args.trusted_files_trace))]
             })
 
     return env, binary
@@ -159,21 +359,156 @@ def get_docker_image(docker_socket, image):
     except (docker.errors.ImageNotFound, docker.errors.APIError):
         return None
 
-def build_docker_image(path, name, dockerfile, **kwargs):
+# Docker build output
+#
+# The build output is a stream of JSON messages. BuildMonitor decodes them as they arrive, prints
+# the output (or writes it to a log file and only prints the build steps), measures the duration
+# of every Dockerfile step and stops at the first error reported by Docker.
+
+BUILD_STEP_RE = re.compile(r'^Step (\d+)/(\d+) : (.*)$')
+
+# Phases of the GSC builds, recognized by the instruction of a step
+BUILD_PHASES = (
+    ('apt-get', 'install packages'),
+    ('make ', 'compile Graphene'),
+    ('git ', 'fetch sources'),
+    ('argv_serializer', 'generate trusted arguments'),
+    ('python3 -B finalize_manifests.py', 'finalize manifests'),
+    ('python3 -B sign_manifests.py', 'sign manifests'),
+)
+
+class BuildError(Exception):
+    pass
+
+class BuildMonitor:
+    def __init__(self, log_file=None):
+        self.log_file = log_file
+        self.start = time.monotonic()
+        self.steps = []
+        self.image_id = None
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._line = ''
+
+    def output(self, line):
+        match = BUILD_STEP_RE.match(line)
+        if match:
+            self.start_step(int(match.group(1)), int(match.group(2)), match.group(3))
+        elif line.strip() == '---> Using cache' and self.steps:
+            self.steps[-1]['cached'] = True
+
+        if self.log_file is not None:
+            print(line, file=self.log_file)
+            if match:
+                print(line if len(line) <= 100 else line[:97] + '...')
+        else:
+            print(line)
+
+    def start_step(self, step, total, instruction):
+        self.end_step()
+        phase = next((name for keyword, name in BUILD_PHASES if keyword in instruction), None)
+        self.steps.append({'step': step, 'total': total, 'instruction': instruction,
+                           'phase': phase, 'cached': False, 'start': time.monotonic()})
+
+    def end_step(self):
+        if self.steps and 'duration' not in self.steps[-1]:
+            self.steps[-1]['duration'] = time.monotonic() - self.steps[-1].pop('start')
+
+    def handle(self, message):
+        if 'errorDetail' in message or 'error' in message:
+            error = message.get('errorDetail', {}).get('message') or message.get('error')
+            raise BuildError(error)
+        if 'stream' in message:
+            # a message may end in the middle of a line
+            lines = (self._line + message['stream']).split('\n')
+            self._line = lines.pop()
+            for line in lines:
+                self.output(line.rstrip('\r'))
+        if 'aux' in message and 'ID' in message['aux']:
+            self.image_id = message['aux']['ID']
+
+    # Decodes all complete JSON messages in `chunk`, keeping incomplete ones for the next chunk
+    def feed(self, chunk):
+        self._buffer += chunk
+        while True:
+            data = self._buffer.lstrip()
+            if not data:
+                self._buffer = ''
+                return
+            try:
+                message, end = self._decoder.raw_decode(data)
+            except ValueError:
+                self._buffer = data
+                return
+            self._buffer = data[end:]
+            self.handle(message)
+
+    def finish(self):
+        if self._line:
+            self.output(self._line)
+            self._line = ''
+        self.end_step()
+
+    def report(self, name, dockerfile, error):
+        phases = {}
+        for step in self.steps:
+            if step['phase'] is not None:
+                phases[step['phase']] = phases.get(step['phase'], 0) + step.get('duration', 0)
+        return {
+            'image': name,
+            'dockerfile': dockerfile,
+            'success': error is None,
+            'error': error,
+            'image_id': self.image_id,
+            'duration': time.monotonic() - self.start,
+            'phases': phases,
+            'steps': self.steps,
+        }
+
+# Builds a Docker image and returns whether the build succeeded. The output of the build is
+# printed or, if `log_file` is given, written to this file. With `timing_report`, the durations
+# of the build steps are written to this file as JSON.
+def build_docker_image(path, name, dockerfile, log_file=None, timing_report=None, **kwargs):
     docker_api = docker.APIClient(base_url='unix://var/run/docker.sock')
-    # Docker build returns stream of json output
-    stream = docker_api.build(path=path,
-                              tag=name,
-                              dockerfile=dockerfile,
-                              **kwargs)
-
-    # Print continuously the stream of output by docker build
-    for chunk in stream:
-        json_output = json.loads(chunk.decode(sys.stdout.encoding
-                                    if sys.stdout.encoding is not None else 'UTF-8'))
-        if 'stream' in json_output:
-            for line in json_output['stream'].splitlines():
-                print(line)
+    encoding = sys.stdout.encoding if sys.stdout.encoding is not None else 'UTF-8'
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+
+    log = open(log_file, 'a') if log_file is not None else None
+    monitor = BuildMonitor(log)
+    error = None
+    try:
+        # Docker build returns stream of json output
+        stream = docker_api.build(path=path,
+                                  tag=name,
+                                  dockerfile=dockerfile,
+                                  **kwargs)
+        try:
+            for chunk in stream:
+                monitor.feed(decoder.decode(chunk))
+        finally:
+            # stop reading the build output on errors
+            if hasattr(stream, 'close'):
+                stream.close()
+    except BuildError as build_error:
+        error = str(build_error)
+    except docker.errors.APIError as api_error:
+        error = str(api_error)
+    finally:
+        monitor.finish()
+        if log is not None:
+            log.close()
+
+    if error is not None:
+        print(f'Docker build failed: {error}')
+        if log_file is not None:
+            print(f'See {log_file} for the build output.')
+
+    if timing_report is not None:
+        with open(timing_report, 'w') as report:
+            json.dump(monitor.report(name, dockerfile, error), report, indent=4)
+            report.write('\n')
+
+    return error is None
 
 def extract_build_args(args):
     buildargs_dict = {}
@@ -198,6 +533,10 @@ def gsc_build(args):
     image = args.image
     user_manifests = args.manifests
 
+    if args.trusted_files_trace and not args.prune_trusted_files:
+        print('--trusted-files-trace requires --prune-trusted-files.')
+        sys.exit(1)
+
     docker_socket = docker.from_env()
 
     if get_docker_image(docker_socket, gsc_image_name(image)) is not None:
@@ -213,15 +552,22 @@ def gsc_build(args):
 
     env, binary = prepare_env(base_image, image, args, user_manifests)
 
-    prepare_build_context(image, user_manifests, env, binary)
+    env.globals['layer_checksums'] = False
+    if not args.no_layer_cache:
+        env.globals['layer_checksums'] = generate_layer_checksums(
+            gsc_image_name(image), base_image, get_layer_cache_dir())
+
+    prepare_build_context(image, user_manifests, env, binary, args.trusted_files_trace)
 
     buildargs_dict = extract_build_args(args)
 
-    build_docker_image(gsc_image_name(image), gsc_unsigned_image_name(image), 'Dockerfile.build',
-                       rm=args.rm, nocache=args.no_cache, buildargs=buildargs_dict)
+    built = build_docker_image(gsc_image_name(image), gsc_unsigned_image_name(image),
+                               'Dockerfile.build', log_file=args.log_file,
+                               timing_report=args.timing_report,
+                               rm=args.rm, nocache=args.no_cache, buildargs=buildargs_dict)
 
     # Check if docker build failed
-    if get_docker_image(docker_socket, gsc_unsigned_image_name(image)) is None:
+    if not built or get_docker_image(docker_socket, gsc_unsigned_image_name(image)) is None:
         print(f'Failed to build graphenized image for {image}')
         sys.exit(1)
 
@@ -269,11 +615,12 @@ def gsc_build_graphene(args):
     else:
         buildargs_dict = extract_build_args(args)
 
-        build_docker_image(image, image, 'Dockerfile.compile',
-                       rm=args.rm, nocache=args.no_cache, buildargs=buildargs_dict)
+        built = build_docker_image(image, image, 'Dockerfile.compile', log_file=args.log_file,
+                                   timing_report=args.timing_report,
+                                   rm=args.rm, nocache=args.no_cache, buildargs=buildargs_dict)
 
         # Check if docker build failed
-        if get_docker_image(docker_socket, image) is None:
+        if not built or get_docker_image(docker_socket, image) is None:
             print(f'Failed to build graphenized image for {image}')
             sys.exit(1)
 
@@ -311,18 +658,20 @@ def gsc_sign_image(args):
     fk_path = (pathlib.Path(gsc_image_name(image)) / 'gsc-signer-key').with_suffix('.pem')
     shutil.copyfile(os.path.abspath(key), fk_path)
 
+    built = False
     try:
         # We force the removal of intermediate Docker images to not leave the signing
         # key in a Docker container.
-        build_docker_image(gsc_image_name(image), gsc_image_name(image),
-                           'Dockerfile.sign_manifests', forcerm=True)
+        built = build_docker_image(gsc_image_name(image), gsc_image_name(image),
+                                   'Dockerfile.sign_manifests', log_file=args.log_file,
+                                   timing_report=args.timing_report, forcerm=True)
 
     finally:
         # Remove key file from the temporary folder
         os.remove(fk_path)
 
         # Check if docker build failed
-        if get_docker_image(docker_socket, gsc_image_name(image)) is None:
+        if not built or get_docker_image(docker_socket, gsc_image_name(image)) is None:
             print(f'Failed to sign graphenized image for {image}')
             sys.exit(1)
 
@@ -347,6 +696,20 @@ sub_build.add_argument('--rm', action='store_true',
     help='Remove intermediate Docker images when build is successful.')
 sub_build.add_argument('--build-arg', action='append', default=[],
     help='Set build-time variables (same as "docker build --build-arg").')
+sub_build.add_argument('--no-layer-cache', action='store_true',
+    help='Do not use checksums of the files of the base image layers, hash all trusted files '
+         'during the build.')
+sub_build.add_argument('--prune-trusted-files', action='store_true',
+    help='Only trust the files the entrypoint binaries can load (ELF dependencies and script '
+         'interpreters) plus the files from --trusted-files-trace, instead of all files in '
+         'the image.')
+sub_build.add_argument('--trusted-files-trace', action='append', default=[],
+    help='Log of a Graphene run with sgx.file_check_policy = "allow_all_but_log" (or a list of '
+         'paths). Files accessed during this run are kept by --prune-trusted-files.')
+sub_build.add_argument('--log-file',
+    help='Write the output of the Docker build to this file instead of the terminal.')
+sub_build.add_argument('--timing-report',
+    help='Write the duration of every Dockerfile step of the Docker build to this file (JSON).')
 sub_build.add_argument('-c', '--config_file', type=argparse.FileType('r', encoding='UTF-8'),
     default='config.yaml', help='Specify configuration file.')
 sub_build.add_argument('image',
@@ -369,6 +732,10 @@ sub_build_graphene.add_argument('--rm', action='store_true',
     help='Remove intermediate Docker images when build is successful.')
 sub_build_graphene.add_argument('--build-arg', action='append', default=[],
     help='Set build-time variables (same as "docker build --build-arg").')
+sub_build_graphene.add_argument('--log-file',
+    help='Write the output of the Docker build to this file instead of the terminal.')
+sub_build_graphene.add_argument('--timing-report',
+    help='Write the duration of every Dockerfile step of the Docker build to this file (JSON).')
 sub_build_graphene.add_argument('-c', '--config_file',
     type=argparse.FileType('r', encoding='UTF-8'),
     default='config.yaml', help='Specify configuration file.')
@@ -379,6 +746,10 @@ sub_build_graphene.add_argument('image',
 
 sub_sign = subcommands.add_parser('sign-image', help="Sign graphenized Docker image")
 sub_sign.set_defaults(command=gsc_sign_image)
+sub_sign.add_argument('--log-file',
+    help='Write the output of the Docker build to this file instead of the terminal.')
+sub_sign.add_argument('--timing-report',
+    help='Write the duration of every Dockerfile step of the Docker build to this file (JSON).')
 sub_sign.add_argument('-c', '--config_file', type=argparse.FileType('r', encoding='UTF-8'),
     default='config.yaml', help='Specify configuration file.')
 sub_sign.add_argument('image',
@@ -3,32 +3,71 @@
 # Copyright (C) 2020 Intel Corp.
 #                    Anjo Vahldiek-Oberwagner <anjo.lucas.vahldiek-oberwagner@intel.com>
 
+import argparse
+import concurrent.futures
 import os
-import sys
+import re
 import subprocess
-import argparse
+import sys
+
+# graphene-sgx-sign prints the attributes of the enclave, including its size in bytes
+ENCLAVE_SIZE_RE = re.compile(r'^\s+size:\s+(\d+)$', re.MULTILINE)
+
+class SigningError(Exception):
+    def __init__(self, executable, reason, output=''):
+        super().__init__(f'{executable}: {reason}')
+        self.executable = executable
+        self.reason = reason
+        self.output = output
+
+SIGNER = '/graphene/python/graphene-sgx-sign'
+
+# Written by finalize_manifests.py if it added checksums of trusted files from image layers
+LAYER_CHECKSUMS_USED_FILE = 'layer_checksums_used'
 
-def generate_signature(exec_):
+# Checks whether the Graphene version in the image supports an option of graphene-sgx-sign
+def signer_supports(option):
+    try:
+        result = subprocess.run([SIGNER, '--help'], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'))
+    except OSError:
+        return False
+    return re.search(re.escape(option) + r'\b', result.stdout.decode()) is not None
+
+def generate_signature(exec_, options=()):
     sign_process = subprocess.Popen([
-        '/graphene/python/graphene-sgx-sign',
+        SIGNER,
         '-exec', exec_,
         '-libpal', '/graphene/Runtime/libpal-Linux-SGX.so',
         '-key', '/gsc-signer-key.pem',
         '-output', f'{exec_}.manifest.sgx',
         '-manifest', f'{exec_}.manifest',
+        *options,
         ],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        env=os.environ.update({'PYTHONDONTWRITEBYTECODE':'1'}))
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'))
 
-    _, err = sign_process.communicate()
+    out, err = sign_process.communicate()
 
-    if (sign_process.returncode != 0
-        or not os.path.exists(os.path.join('./', exec_ + '.manifest.sgx'))
+    if sign_process.returncode != 0:
+        raise SigningError(exec_, f'graphene-sgx-sign exited with {sign_process.returncode}',
+                           err.decode())
+    if (not os.path.exists(os.path.join('./', exec_ + '.manifest.sgx'))
         or not os.path.exists(os.path.join('./', exec_ + '.sig'))):
-        print(err.decode())
-        print('Finalize manifests failed due to graphene-sgx-sign failure.')
-        sys.exit(1)
+        raise SigningError(exec_, 'graphene-sgx-sign did not generate the signature',
+                           err.decode())
+
+    match = ENCLAVE_SIZE_RE.search(out.decode())
+    if match:
+        return int(match.group(1))
+    return extract_enclave_size(exec_ + '.manifest.sgx')
+
+def parse_size(value):
+    value = value.strip().strip('"')
+    scale = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}.get(value[-1:].upper(), 1)
+    return int(value[:-1] if scale != 1 else value, 0) * scale
 
 # Iterate over manifest file to find enclave size definition and return it
 def extract_enclave_size(manifest):
@@ -40,14 +79,96 @@ def extract_enclave_size(manifest):
             tokens = line.split('=')
             if len(tokens) != 2:
                 continue
-            return tokens[1].strip()
+            return parse_size(tokens[1])
 
-    return '0M'
+    return 0
+
+# Returns the executables whose signatures the manifest of `executable` includes as trusted
+# children
+def extract_trusted_children(executable):
+    children = []
+    with open(f'{executable}.manifest', 'r') as file:
+        for line in file:
+            line = line.strip()
+            if not line.startswith('sgx.trusted_children.'):
+                continue
+
+            tokens = line.split('=', 1)
+            if len(tokens) != 2:
+                continue
+            uri = tokens[1].split('#', 1)[0].strip().strip('"')
+            if uri.startswith('file:'):
+                uri = uri[len('file:'):]
+            if uri.endswith('.sig'):
+                children.append(os.path.normpath(uri[:-len('.sig')]))
+
+    return children
+
+# A manifest includes the signatures of its trusted children, so children have to be signed
+# before their parents. Executables without dependencies between them are signed concurrently.
+# On the first failure no further signing is started.
+def sign_executables(executables, jobs, options=()):
+    # pylint: disable=too-many-locals
+    nodes = {os.path.normpath(executable): executable for executable in executables}
+    children = {executable: {nodes[child] for child in extract_trusted_children(executable)
+                             if child in nodes}
+                for executable in executables}
+
+    pending = list(executables)
+    running = {}
+    signed = {}
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while running or (pending and not errors):
+            if not errors:
+                for executable in [e for e in pending if children[e].issubset(signed)]:
+                    pending.remove(executable)
+                    future = executor.submit(generate_signature, executable, options)
+                    running[future] = executable
+
+            if not running:
+                errors.append(SigningError(', '.join(pending),
+                                           'trusted children form a cycle'))
+                break
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                executable = running.pop(future)
+                try:
+                    signed[executable] = future.result()
+                    print(f'\t{executable}')
+                except SigningError as error:
+                    errors.append(error)
+                except OSError as error:
+                    errors.append(SigningError(executable, str(error)))
+
+    return signed, errors
+
+def print_error_summary(executables, signed, errors):
+    failed = {error.executable: error for error in errors}
+    print('Signing summary:')
+    for executable in executables:
+        if executable in signed:
+            status = 'signed'
+        elif executable in failed:
+            status = f'FAILED ({failed[executable].reason})'
+        else:
+            status = 'skipped'
+        print(f'\t{executable}: {status}')
+
+    for error in errors:
+        if error.executable not in executables:
+            print(f'\t{error.executable}: FAILED ({error.reason})')
+        if error.output:
+            print(f'{error.executable}:\n{error.output}')
 
 argparser = argparse.ArgumentParser()
 argparser.add_argument('signing_order', default='signing_order.txt',
     help='File specifying the order in which executables should be signed. '
          'Default: signing_order.txt')
+argparser.add_argument('-j', '--jobs', type=int, default=None,
+    help='Maximum number of executables signed concurrently. Default: number of CPUs')
 
 def main(args=None):
     args = argparser.parse_args(args[1:])
@@ -57,26 +178,36 @@ def main(args=None):
     sig_order_file = args.signing_order
     if not os.path.exists(sig_order_file):
         print(f'Failed to generate signatures, since image misses {sig_order_file}.')
+        sys.exit(1)
 
-    # To deal with multi-process applications, we sign the application manifests in the order
-    # specified by finalize_manifests.py. The order is stored in a temporary file called
-    # signature_order.txt.
+    # To deal with multi-process applications, finalize_manifests.py lists the application
+    # manifests in a temporary file called signing_order.txt. The actual order is derived from
+    # the trusted children of each manifest.
     with open(sig_order_file, 'r') as sig_order:
-        executables = sig_order.read().splitlines()
+        executables = list(dict.fromkeys(sig_order.read().splitlines()))
+
+    # Keep the checksums of trusted files only if finalize_manifests.py took them from cached
+    # image layers (not with `gsc build --no-layer-cache`), otherwise the signer hashes all files
+    options = []
+    if os.path.exists(LAYER_CHECKSUMS_USED_FILE) and signer_supports('--keep-checksums'):
+        options.append('--keep-checksums')
+
+    signed, errors = sign_executables(executables, args.jobs, options)
+    if errors:
+        print_error_summary(executables, signed, errors)
+        print('Signing manifests failed.')
+        sys.exit(1)
+
+    # In case multiple manifest files were generated, ensure that their enclave sizes are
+    # compatible
+    if len(executables) > 1:
+        main_encl_size = signed[executables[0]]
         for executable in executables:
-            generate_signature(executable)
-
-            print(f'\t{executable}')
-
-        # In case multiple manifest files were generated, ensure that their enclave sizes are
-        # compatible
-        if len(executables) > 1:
-            main_encl_size = extract_enclave_size(executables[0] + '.manifest.sgx')
-            for executable in executables:
-                if main_encl_size != extract_enclave_size(executable + '.manifest.sgx'):
-                    print('Error: Detected a child manifest with an enclave size different than '
-                          'its parent.')
-                    sys.exit(1)
+            if main_encl_size != signed[executable]:
+                print('Error: Detected a child manifest with an enclave size different than '
+                      f'its parent ({executable}: {signed[executable]:#x}, '
+                      f'{executables[0]}: {main_encl_size:#x}).')
+                sys.exit(1)
 
 if __name__ == '__main__':
     main(sys.argv)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.fspath(pathlib.Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+import finalize_manifests
+
+
+class TC_00_TrustedChecksums(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.layer_checksums = {}
+
+    def path(self, name):
+        return os.path.join(os.path.realpath(self.tmpdir), name)
+
+    def add_layer_file(self, name, content):
+        with open(self.path(name), 'wb') as file:
+            file.write(content)
+        os.utime(self.path(name), (1000, 1000))
+        # the checksum in the layer deliberately differs from the content, to tell them apart
+        self.layer_checksums[self.path(name)] = [len(content), 1000, 'layer-' + name]
+
+    def start_build(self):
+        with open(self.path('layer_checksums.json'), 'w') as file:
+            json.dump(self.layer_checksums, file)
+        # make sure the ctime of the marker is newer than the ctime of the layer files, even on
+        # file systems with coarse timestamps
+        time.sleep(0.01)
+        pathlib.Path(self.path('build_start_marker')).touch()
+        time.sleep(0.01)
+
+    def get_checksums(self, names):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return finalize_manifests.get_trusted_checksums(
+                [self.path(name) for name in names], self.path('layer_checksums.json'),
+                self.path('build_start_marker'))
+
+    def test_000_unchanged_files_are_reused(self):
+        self.add_layer_file('a', b'a')
+        self.add_layer_file('b', b'bb')
+        self.start_build()
+
+        self.assertEqual(self.get_checksums(['a', 'b']), ['layer-a', 'layer-b'])
+
+    def test_010_changed_size_or_mtime_is_hashed(self):
+        self.add_layer_file('a', b'a')
+        self.add_layer_file('b', b'b')
+        self.start_build()
+        with open(self.path('a'), 'ab') as file:
+            file.write(b'a')
+        os.utime(self.path('a'), (1000, 1000))
+        os.utime(self.path('b'), (2000, 2000))
+
+        self.assertEqual(self.get_checksums(['a', 'b']), [
+            hashlib.sha256(b'aa').hexdigest(),
+            hashlib.sha256(b'b').hexdigest(),
+        ])
+
+    def test_020_restored_mtime_is_hashed(self):
+        self.add_layer_file('a', b'a')
+        self.add_layer_file('b', b'b')
+        self.start_build()
+        # same size and mtime as in the layer, e.g. a package manager which restores the mtime
+        with open(self.path('a'), 'wb') as file:
+            file.write(b'x')
+        os.utime(self.path('a'), (1000, 1000))
+
+        self.assertEqual(self.get_checksums(['a', 'b']),
+                         [hashlib.sha256(b'x').hexdigest(), 'layer-b'])
+
+    def test_030_files_not_in_layers_are_hashed(self):
+        self.start_build()
+        with open(self.path('new'), 'wb') as file:
+            file.write(b'new')
+
+        self.assertEqual(self.get_checksums(['new']), [hashlib.sha256(b'new').hexdigest()])
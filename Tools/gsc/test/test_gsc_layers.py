@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import hashlib
+import io
+import os
+import pathlib
+import sys
+import tarfile
+import unittest
+
+sys.path.insert(0, os.fspath(pathlib.Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+import gsc
+
+
+def make_layer(entries):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        for name, content in entries:
+            member = tarfile.TarInfo(name)
+            member.mtime = 1000
+            if content is None:
+                member.type = tarfile.DIRTYPE
+                tar.addfile(member)
+            elif isinstance(content, tuple):
+                member.type, member.linkname = content
+                tar.addfile(member)
+            else:
+                member.size = len(content)
+                tar.addfile(member, io.BytesIO(content))
+    return data.getvalue()
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class TC_00_HashLayer(unittest.TestCase):
+    def test_000_files(self):
+        data = make_layer([
+            ('usr/', None),
+            ('usr/bin/', None),
+            ('usr/bin/app', b'app'),
+            ('./etc/conf', b'conf'),
+            ('usr/bin/link', (tarfile.SYMTYPE, 'app')),
+        ])
+        diff_id, layer = gsc.hash_layer(io.BytesIO(data))
+
+        # the diff ID covers the whole archive, including the padding after the end marker
+        self.assertEqual(diff_id, 'sha256:' + sha256(data))
+        self.assertEqual(layer['files'], {
+            '/usr/bin/app': [3, 1000, sha256(b'app')],
+            '/etc/conf': [4, 1000, sha256(b'conf')],
+        })
+        self.assertEqual(layer['whiteouts'], [])
+        self.assertEqual(layer['opaque'], [])
+
+    def test_001_hardlink(self):
+        data = make_layer([
+            ('usr/lib/libfoo.so.1', b'foo'),
+            ('usr/lib/libfoo.so', (tarfile.LNKTYPE, 'usr/lib/libfoo.so.1')),
+        ])
+        _, layer = gsc.hash_layer(io.BytesIO(data))
+        self.assertEqual(layer['files']['/usr/lib/libfoo.so'], [3, 1000, sha256(b'foo')])
+
+    def test_010_whiteouts(self):
+        data = make_layer([
+            ('usr/bin/.wh.app', b''),
+            ('./etc/.wh.conf.d', b''),
+            ('opt/x/.wh..wh..opq', b''),
+            ('opt/x/new', b'new'),
+        ])
+        _, layer = gsc.hash_layer(io.BytesIO(data))
+
+        self.assertEqual(sorted(layer['whiteouts']), ['/etc/conf.d', '/usr/bin/app'])
+        self.assertEqual(layer['opaque'], ['/opt/x'])
+        # whiteout markers are not files of the image
+        self.assertEqual(list(layer['files']), ['/opt/x/new'])
+
+
+class TC_01_MergeLayers(unittest.TestCase):
+    @staticmethod
+    def layer(files=(), whiteouts=(), opaque=()):
+        return {
+            'version': gsc.LAYER_CACHE_VERSION,
+            'files': {path: [len(path), 1000, sha256(path.encode())] for path in files},
+            'whiteouts': list(whiteouts),
+            'opaque': list(opaque),
+        }
+
+    def test_000_upper_layer_wins(self):
+        lower = self.layer(['/etc/conf', '/usr/bin/app'])
+        upper = self.layer(['/etc/conf'])
+        upper['files']['/etc/conf'][2] = 'upper'
+
+        merged = gsc.merge_layers([lower, upper])
+        self.assertEqual(sorted(merged), ['/etc/conf', '/usr/bin/app'])
+        self.assertEqual(merged['/etc/conf'][2], 'upper')
+
+    def test_010_whiteout_file(self):
+        merged = gsc.merge_layers([
+            self.layer(['/usr/bin/app', '/usr/bin/other']),
+            self.layer(whiteouts=['/usr/bin/app']),
+        ])
+        self.assertEqual(sorted(merged), ['/usr/bin/other'])
+
+    def test_011_whiteout_directory(self):
+        merged = gsc.merge_layers([
+            self.layer(['/opt/x/a', '/opt/x/sub/b', '/opt/xy']),
+            self.layer(whiteouts=['/opt/x']),
+        ])
+        self.assertEqual(sorted(merged), ['/opt/xy'])
+
+    def test_012_readded_after_whiteout(self):
+        merged = gsc.merge_layers([
+            self.layer(['/usr/bin/app', '/usr/bin/old']),
+            self.layer(whiteouts=['/usr/bin']),
+            self.layer(['/usr/bin/app']),
+        ])
+        self.assertEqual(sorted(merged), ['/usr/bin/app'])
+
+    def test_020_opaque_directory(self):
+        merged = gsc.merge_layers([
+            self.layer(['/opt/x/a', '/opt/x/sub/b', '/opt/y']),
+            self.layer(['/opt/x/c'], opaque=['/opt/x']),
+        ])
+        # the opaque directory hides the lower contents, but not its own
+        self.assertEqual(sorted(merged), ['/opt/x/c', '/opt/y'])
+
+    def test_021_opaque_directory_in_middle_layer(self):
+        merged = gsc.merge_layers([
+            self.layer(['/opt/x/a']),
+            self.layer(['/opt/x/b'], opaque=['/opt/x']),
+            self.layer(['/opt/x/c']),
+        ])
+        self.assertEqual(sorted(merged), ['/opt/x/b', '/opt/x/c'])
+
+    def test_030_hashed_layers(self):
+        lower = make_layer([('usr/bin/app', b'app'), ('usr/bin/tool', b'tool'),
+                            ('opt/x/a', b'a')])
+        upper = make_layer([('usr/bin/.wh.tool', b''), ('opt/x/.wh..wh..opq', b''),
+                            ('opt/x/b', b'b')])
+        merged = gsc.merge_layers([gsc.hash_layer(io.BytesIO(data))[1]
+                                   for data in [lower, upper]])
+        self.assertEqual(merged, {
+            '/usr/bin/app': [3, 1000, sha256(b'app')],
+            '/opt/x/b': [1, 1000, sha256(b'b')],
+        })
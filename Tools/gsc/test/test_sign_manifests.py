@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.fspath(pathlib.Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+import sign_manifests
+
+
+class TC_00_SignExecutables(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.signing_order = []
+        self.failing = set()
+        self.lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def write_manifest(self, name, children=()):
+        with open(self.path(name) + '.manifest', 'w') as file:
+            file.write('sgx.enclave_size = "256M"\n')
+            for child in children:
+                file.write(f'sgx.trusted_children.{child} = "file:{self.path(child)}.sig"\n')
+
+    def generate_signature(self, executable, options=()):
+        with self.lock:
+            self.signing_order.append(os.path.basename(executable))
+        if os.path.basename(executable) in self.failing:
+            raise sign_manifests.SigningError(executable, 'exited with 1', 'error output')
+        return 256 << 20
+
+    def sign(self, names, jobs=None):
+        executables = [self.path(name) for name in names]
+        output = io.StringIO()
+        with mock.patch.object(sign_manifests, 'generate_signature', self.generate_signature), \
+                contextlib.redirect_stdout(output):
+            signed, errors = sign_manifests.sign_executables(executables, jobs)
+            sign_manifests.print_error_summary(executables, signed, errors)
+        return ({os.path.basename(executable) for executable in signed}, errors,
+                output.getvalue())
+
+    def test_000_children_first(self):
+        self.write_manifest('app', ['child1', 'child2'])
+        self.write_manifest('child1', ['grandchild'])
+        self.write_manifest('child2')
+        self.write_manifest('grandchild')
+
+        signed, errors, _ = self.sign(['app', 'child1', 'child2', 'grandchild'], jobs=4)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(signed, {'app', 'child1', 'child2', 'grandchild'})
+        order = self.signing_order
+        self.assertLess(order.index('grandchild'), order.index('child1'))
+        self.assertLess(order.index('child1'), order.index('app'))
+        self.assertLess(order.index('child2'), order.index('app'))
+
+    def test_010_failed_child_skips_parent(self):
+        self.write_manifest('app', ['child'])
+        self.write_manifest('child')
+        self.failing.add('child')
+
+        signed, errors, output = self.sign(['app', 'child'])
+
+        self.assertEqual(signed, set())
+        self.assertEqual([error.executable for error in errors], [self.path('child')])
+        self.assertNotIn('app', self.signing_order)
+        self.assertIn(f'{self.path("app")}: skipped', output)
+        self.assertIn(f'{self.path("child")}: FAILED (exited with 1)', output)
+        self.assertIn('error output', output)
+
+    def test_020_cycle(self):
+        self.write_manifest('app', ['child'])
+        self.write_manifest('child', ['app'])
+        self.write_manifest('other')
+
+        signed, errors, output = self.sign(['app', 'child', 'other'])
+
+        # independent executables are still signed, the cycle is reported once
+        self.assertEqual(signed, {'other'})
+        self.assertEqual(self.signing_order, ['other'])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].reason, 'trusted children form a cycle')
+        self.assertIn(self.path('app'), errors[0].executable)
+        self.assertIn(self.path('child'), errors[0].executable)
+        self.assertIn(f'{self.path("app")}: skipped', output)
+        self.assertIn(f'{self.path("other")}: signed', output)
+
+    def test_021_self_cycle(self):
+        self.write_manifest('app', ['app'])
+
+        signed, errors, _ = self.sign(['app'])
+
+        self.assertEqual(signed, set())
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].reason, 'trusted children form a cycle')
+
+
+class TC_01_KeepChecksums(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmpdir)
+        with open('app.manifest', 'w') as file:
+            file.write('sgx.enclave_size = "256M"\n')
+        with open('signing_order.txt', 'w') as file:
+            file.write('app\n')
+        self.options = []
+
+    def generate_signature(self, executable, options=()):
+        self.options.append(list(options))
+        return 256 << 20
+
+    def sign(self):
+        with mock.patch.object(sign_manifests, 'generate_signature', self.generate_signature), \
+                mock.patch.object(sign_manifests, 'signer_supports', lambda option: True), \
+                contextlib.redirect_stdout(io.StringIO()):
+            sign_manifests.main(['sign_manifests.py', 'signing_order.txt'])
+
+    def test_000_no_layer_checksums(self):
+        # e.g. `gsc build --no-layer-cache`: checksums in the manifests must not be trusted
+        self.sign()
+        self.assertEqual(self.options, [[]])
+
+    def test_010_layer_checksums(self):
+        open(sign_manifests.LAYER_CHECKSUMS_USED_FILE, 'w').close()
+        self.sign()
+        self.assertEqual(self.options, [['--keep-checksums']])
@@ -3,7 +3,10 @@
 
 import argparse
 import array
+import functools
 import hashlib
+import json
+import os
 import socket
 import struct
 import sys
@@ -19,25 +22,83 @@ except ImportError:
 
 # pylint: enable=invalid-name
 
-def set_optional_sgx_features(attr):
-    """Set optional SGX features if they are available on this machine."""
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+CPU_FEATURES_CACHE_VERSION = 1
+
+
+def get_cpu_features_cache_path():
+    """Default cache file of CPU features (next to the caches of the signer)."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'graphene', 'cpu-features.json')
+
+
+def get_boot_id():
+    try:
+        with open(BOOT_ID_PATH, "r") as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def read_cpu_features():
+    """Parse the CPU flags of the first processor listed in /proc/cpuinfo."""
+    with open("/proc/cpuinfo", "r") as file:
+        for line in file:
+            if line.startswith("flags"):
+                return frozenset(line.split(":")[1].split())
+    raise Exception("Failed to parse CPU flags")
+
+
+@functools.lru_cache(maxsize=None)
+def get_cpu_features(cache_path=None):
+    """Return the CPU flags of this machine (as in /proc/cpuinfo) as a frozenset.
+
+    CPU flags cannot change without a reboot, so they are cached in `cache_path` together with
+    the boot ID of the kernel, and /proc/cpuinfo is parsed at most once per boot.
+    """
+    if cache_path is None:
+        cache_path = get_cpu_features_cache_path()
+
+    boot_id = get_boot_id()
+    if boot_id is not None:
+        try:
+            with open(cache_path, "r") as file:
+                cached = json.load(file)
+            if (cached.get('version') == CPU_FEATURES_CACHE_VERSION and
+                    cached.get('boot_id') == boot_id):
+                return frozenset(cached['flags'])
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    features = read_cpu_features()
+
+    if boot_id is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+            with open(tmp_path, "w") as file:
+                json.dump({
+                    'version': CPU_FEATURES_CACHE_VERSION,
+                    'boot_id': boot_id,
+                    'flags': sorted(features),
+                }, file)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass  # the cache is only an optimization
+
+    return features
+
+
+def get_optional_xfrms(xfrms, xfrm_mask, cpu_features=None):
+    """Return XFRM (as int) with the optional SGX features available on this machine enabled."""
     optional_sgx_features = {
         offs.SGX_XFRM_AVX:      "avx",
         offs.SGX_XFRM_AVX512:   "avx512f",
         offs.SGX_XFRM_MPX:      "mpx",
     }
 
-    cpu_features = ""
-    with open("/proc/cpuinfo", "r") as file:
-        for line in file:
-            if line.startswith("flags"):
-                cpu_features = line.split(":")[1].strip().split()
-                break
-        else:
-            raise Exception("Failed to parse CPU flags")
-
-    xfrms = int.from_bytes(attr['xfrms'], byteorder='little')
-    xfrmmask = int.from_bytes(attr['xfrm_mask'], byteorder='little')
+    if cpu_features is None:
+        cpu_features = get_cpu_features()
 
     new_xfrms = 0
     for (bits, feature) in optional_sgx_features.items():
@@ -46,9 +107,18 @@ def set_optional_sgx_features(attr):
         # we can set the remaining bits if the feature is available.
         # If the xfrmmask includes all the required xfrm bits, then these bits cannot be
         # changed in xfrm (need to stay the same as signed).
-        if xfrms & (bits & xfrmmask) == (bits & xfrmmask) and feature in cpu_features:
+        if xfrms & (bits & xfrm_mask) == (bits & xfrm_mask) and feature in cpu_features:
             new_xfrms |= xfrms | bits
 
+    return new_xfrms
+
+
+def set_optional_sgx_features(attr, cpu_features=None):
+    """Set optional SGX features if they are available on this machine."""
+    xfrms = int.from_bytes(attr['xfrms'], byteorder='little')
+    xfrmmask = int.from_bytes(attr['xfrm_mask'], byteorder='little')
+
+    new_xfrms = get_optional_xfrms(xfrms, xfrmmask, cpu_features)
     attr['xfrms'] = new_xfrms.to_bytes(length=8, byteorder='little')
 
 
@@ -85,46 +155,149 @@ def is_dcap():
     """ Check if we're dealing with DCAP driver."""
     return hasattr(offs, 'SGX_DCAP')
 
-def connect_aesmd(attr):
-    """Connect with AESMD."""
-
-    req_msg = aesm_pb2.GetTokenReq()
-    req_msg.req.signature = attr['enclave_hash']
-    req_msg.req.key = attr['modulus']
-    req_msg.req.attributes = attr['flags'] + attr['xfrms']
-    req_msg.req.timeout = 10000
-
-    req_msg_raw = req_msg.SerializeToString()
+# Sockets exposed by the AESM service, tried in this order
+AESM_SOCKETS = (
+    "/var/run/aesmd/aesm.socket",         # named socket (for PSW 1.8+)
+    "\0sgx_aesm_socket_base" + "\0" * 87  # unnamed socket (for PSW 1.6/1.7)
+)
+
+
+class AesmClient:
+    """Connection to the AESM service, kept open for any number of requests.
+
+    Every message (in both directions) is a protobuf message of aesm.proto, preceded by its size
+    as a 32-bit little-endian integer. If AESM closes the connection, it is reopened once per
+    request.
+    """
+
+    def __init__(self, sockets=AESM_SOCKETS, timeout=None):
+        self.sockets = sockets
+        self.timeout = timeout
+        self._sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        for conn in self.sockets:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(conn)
+            except socket.error:
+                sock.close()
+                continue
+            self._sock = sock
+            return
+        raise socket.error("Cannot connect to the AESMD service")
 
-    aesm_service = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _recv_exactly(self, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = 0
+        while received < size:
+            length = self._sock.recv_into(view[received:])
+            if not length:
+                raise ConnectionResetError("AESMD closed the connection")
+            received += length
+        return bytes(buf)
+
+    def _transact(self, req_msg_raw):
+        if self._sock is None:
+            self.connect()
+        self._sock.sendall(struct.pack("<I", len(req_msg_raw)) + req_msg_raw)
+        (ret_msg_size,) = struct.unpack("<I", self._recv_exactly(4))
+        return self._recv_exactly(ret_msg_size)
+
+    def request(self, req_msg, ret_msg):
+        """Send `req_msg` and parse the response into `ret_msg`."""
+        req_msg_raw = req_msg.SerializeToString()
+        try:
+            ret_msg_raw = self._transact(req_msg_raw)
+        except (ConnectionError, BrokenPipeError):
+            # AESMD may close connections, e.g. if it was restarted; retry on a new one
+            self.close()
+            ret_msg_raw = self._transact(req_msg_raw)
+        ret_msg.ParseFromString(ret_msg_raw)
+        return ret_msg
 
-    # Try to connect to all possible interfaces exposed by aesm service
-    connections = (
-        "/var/run/aesmd/aesm.socket",         # named socket (for PSW 1.8+)
-        "\0sgx_aesm_socket_base" + "\0" * 87  # unnamed socket (for PSW 1.6/1.7)
-    )
+    def get_token(self, attr):
+        """Get the EINITTOKEN for the enclave described by SIGSTRUCT attributes `attr`."""
+        req_msg = aesm_pb2.GetTokenReq()
+        req_msg.req.signature = attr['enclave_hash']
+        req_msg.req.key = attr['modulus']
+        req_msg.req.attributes = attr['flags'] + attr['xfrms']
+        req_msg.req.timeout = 10000
 
-    for conn in connections:
-        try:
-            aesm_service.connect(conn)
-        except socket.error:
-            continue
-        break
-    else:
-        raise socket.error("Cannot connect to the AESMD service")
+        ret_msg = self.request(req_msg, aesm_pb2.GetTokenRet())
+        if ret_msg.ret.error != 0:
+            raise Exception("Failed. (Error Code = %d)" % (ret_msg.ret.error))
 
-    aesm_service.send(struct.pack("<I", len(req_msg_raw)))
-    aesm_service.send(req_msg_raw)
+        return ret_msg.ret.token
 
-    ret_msg_size = struct.unpack("<I", aesm_service.recv(4))[0]
-    ret_msg = aesm_pb2.GetTokenRet()
-    ret_msg_raw = aesm_service.recv(ret_msg_size)
-    ret_msg.ParseFromString(ret_msg_raw)
 
-    if ret_msg.ret.error != 0:
-        raise Exception("Failed. (Error Code = %d)" % (ret_msg.ret.error))
+def connect_aesmd(attr):
+    """Connect with AESMD."""
+    with AesmClient() as client:
+        return client.get_token(attr)
+
+
+class TokenCache:
+    """EINITTOKENs of previously seen enclaves, stored as files in a directory.
+
+    A token depends only on the identity of the enclave (MRENCLAVE and MRSIGNER) and on the
+    attributes it is launched with (including the XFRM chosen for this CPU), which are used as
+    the key. Tokens are bound to the CPU and its microcode, so only those obtained since the
+    last boot are used.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+            path = os.path.join(cache_home, 'graphene', 'tokens')
+        self.path = path
+        self.boot_id = (get_boot_id() or '').encode()
+
+    @staticmethod
+    def get_key(attr):
+        identity = hashlib.sha256()
+        for field in (attr['enclave_hash'], hashlib.sha256(attr['modulus']).digest(),
+                      attr['flags'], attr['xfrms'], attr['misc_select']):
+            identity.update(field)
+        return identity.hexdigest()
+
+    def lookup(self, attr):
+        try:
+            with open(os.path.join(self.path, self.get_key(attr)), 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        (boot_id, _, token) = data.partition(b'\n')
+        if not self.boot_id or boot_id != self.boot_id:
+            return None
+        return token
+
+    def store(self, attr, token):
+        if not self.boot_id:
+            return
+        filename = os.path.join(self.path, self.get_key(attr))
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp_filename, 'wb') as file:
+                file.write(self.boot_id + b'\n' + token)
+            os.replace(tmp_filename, filename)
+        except OSError:
+            pass  # the cache is only an optimization
 
-    return ret_msg.ret.token
 
 def create_dummy_token(attr):
     """ Create dummy token with a few fields initialized with real values
@@ -164,20 +337,23 @@ def create_dummy_token(attr):
 
 argparser = argparse.ArgumentParser()
 argparser.add_argument('--sig', '-sig', metavar='SIGNATURE',
-                       type=argparse.FileType('rb'), required=True,
-                       help='Input .sig file (contains SIGSTRUCT)')
+                       type=argparse.FileType('rb'), required=True, action='append',
+                       help='Input .sig file (contains SIGSTRUCT); can be given several times '
+                            'to get the tokens of many enclaves over one AESMD connection')
 argparser.add_argument('--output', '-output', metavar='OUTPUT',
-                       type=argparse.FileType('wb'), required=False,
-                       help='Output .token file (contains EINITTOKEN)')
-
-
-def main(args=None):
-    """Main Program."""
-    args = argparser.parse_args(args)
-
-    attr = read_sigstruct(args.sig.read())
-    set_optional_sgx_features(attr)
-
+                       type=argparse.FileType('wb'), required=False, action='append',
+                       help='Output .token file (contains EINITTOKEN), once per --sig')
+argparser.add_argument('--no-token-cache', '-no-token-cache',
+                       action='store_true', required=False,
+                       help='Always get the tokens from AESMD instead of reusing the ones '
+                            'obtained for the same enclaves since boot (stored under '
+                            '$XDG_CACHE_HOME/graphene)')
+argparser.add_argument('--aesm-socket', '-aesm-socket', metavar='PATH',
+                       type=str, required=False,
+                       help='Path of the AESMD socket (default: try the standard ones)')
+
+
+def print_attributes(attr):
     # calculate MRSIGNER as sha256 hash over RSA public key's modulus
     mrsigner = hashlib.sha256()
     mrsigner.update(attr['modulus'])
@@ -196,13 +372,49 @@ def main(args=None):
     print("    signature:   %s..." % attr['signature'].hex()[:32])
     print("    date:        %d-%02d-%02d" % (attr['year'], attr['month'], attr['day']))
 
-    if is_dcap():
-        token = create_dummy_token(attr)
-    else:
-        token = connect_aesmd(attr)
+
+def get_tokens(sigs, client=None, token_cache=None):
+    """Return the EINITTOKENs of the enclaves with SIGSTRUCTs `sigs` (bytes), in that order.
+
+    Tokens found in `token_cache` (if given) are reused; all others are obtained from AESMD
+    through `client`, which is connected on first use.
+    """
+    tokens = []
+    for sig in sigs:
+        attr = read_sigstruct(sig)
+        set_optional_sgx_features(attr)
+        print_attributes(attr)
+
+        if is_dcap():
+            tokens.append(create_dummy_token(attr))
+            continue
+
+        token = token_cache.lookup(attr) if token_cache is not None else None
+        if token is None:
+            token = client.get_token(attr)
+            if token_cache is not None:
+                token_cache.store(attr, token)
+        else:
+            print("    (token reused from %s)" % token_cache.path)
+        tokens.append(token)
+    return tokens
+
+
+def main(args=None):
+    """Main Program."""
+    args = argparser.parse_args(args)
+    if args.output is not None and len(args.output) != len(args.sig):
+        argparser.error("--output must be given once per --sig")
+
+    sockets = (args.aesm_socket,) if args.aesm_socket is not None else AESM_SOCKETS
+    token_cache = TokenCache() if not args.no_token_cache else None
+
+    with AesmClient(sockets) as client:
+        tokens = get_tokens([sig.read() for sig in args.sig], client, token_cache)
 
     if args.output:
-        args.output.write(token)
+        for output, token in zip(args.output, tokens):
+            output.write(token)
     return 0
 
 
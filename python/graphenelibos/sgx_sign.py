@@ -1,13 +1,29 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import bisect
+import concurrent.futures
+import contextlib
+import copy
+import ctypes
 import datetime
 import functools
 import hashlib
+import io
+import json
+import mmap
+import multiprocessing
 import os
+import re
+import select
+import shlex
+import sqlite3
 import struct
 import subprocess
 import sys
+import time
+import traceback
 
 try:
     from . import _offsets as offs # pylint: disable=import-error
@@ -16,6 +32,15 @@ except ImportError:
     # so we can import as follows
     import generated_offsets as offs # pylint: disable=import-error
 
+try:
+    from cryptography.hazmat.backends import default_backend as crypto_default_backend
+    from cryptography.hazmat.primitives import hashes as crypto_hashes
+    from cryptography.hazmat.primitives import serialization as crypto_serialization
+    from cryptography.hazmat.primitives.asymmetric import padding as crypto_padding
+except ImportError:
+    # signing falls back to the openssl command line tool
+    crypto_serialization = None
+
 # pylint: enable=invalid-name
 
 # Default / Architectural Options
@@ -27,6 +52,8 @@ SSAFRAMESIZE = offs.PAGESIZE
 DEFAULT_ENCLAVE_SIZE = '"256M"'
 DEFAULT_THREAD_NUM = 4
 
+DEFAULT_CHECKSUM_CACHE_ENTRIES = 100000
+
 # Utilities
 
 ZERO_PAGE = bytes(offs.PAGESIZE)
@@ -44,9 +71,8 @@ def rounddown(addr):
 
 
 def parse_size(value):
-    if len(value) < 2 or not value.startswith('"') or not value.endswith('"'):
-        raise Exception('Cannot parse size `' + value + '` (must be put in double quotes).')
-    value = value[1:-1]
+    if not isinstance(value, str):
+        raise Exception('Cannot parse size `' + str(value) + '` (must be put in double quotes).')
 
     scale = 1
     if value.endswith("K"):
@@ -60,35 +86,164 @@ def parse_size(value):
     return int(value, 0) * scale
 
 
+def parse_int(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise Exception('Cannot parse integer `' + str(value) + '`.')
+    return value
+
+
 # Reading / Writing Manifests
 
+# Values are TOML scalars (see Pal/lib/toml.c)
+# only decimal integers may have a sign, underscores must be between digits
+TOML_INTEGER = re.compile(r'([+-]?(0|[1-9](_?[0-9])*)|0x[0-9a-fA-F](_?[0-9a-fA-F])*'
+                          r'|0o[0-7](_?[0-7])*|0b[01](_?[01])*)\Z')
+TOML_ESCAPE = re.compile(r'\\(?:([btnfr"\\])|u([0-9a-fA-F]{4})|U([0-9a-fA-F]{8}))')
+TOML_ESCAPES = {'b': '\b', 't': '\t', 'n': '\n', 'f': '\f', 'r': '\r', '"': '"', '\\': '\\'}
+
+
+def _unescape(match):
+    (char, short, long_) = match.groups()
+    if char is not None:
+        return TOML_ESCAPES[char]
+    return chr(int(short or long_, 16))
+
+
+def parse_value(raw):
+    '''Parse the text of a TOML value into a str, int or bool, or raise ValueError.'''
+    if len(raw) >= 2 and raw[0] == '"' and raw[-1] == '"':
+        value = raw[1:-1]
+        if '\\' in value:
+            if '\\' in TOML_ESCAPE.sub('', value):
+                raise ValueError('Invalid escape sequence in ' + raw)
+            value = TOML_ESCAPE.sub(_unescape, value)
+        return value
+    if len(raw) >= 2 and raw[0] == "'" and raw[-1] == "'":
+        return raw[1:-1]
+    if raw == 'true':
+        return True
+    if raw == 'false':
+        return False
+    if TOML_INTEGER.match(raw):
+        return int(raw, 0)
+    raise ValueError('Cannot parse value ' + raw)
+
+
+def format_value(value):
+    '''Format a str, int or bool as a TOML value.'''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return str(value)
+    # JSON strings are valid TOML basic strings
+    return json.dumps(value)
+
+class Manifest:
+    '''Keys and values of a manifest, together with the layout of the file it was read from.'''
+    __slots__ = ('layout', '_values', '_sorted_keys', '_parsed')
+
+    def __init__(self):
+        self.layout = []
+        self._values = dict()
+        self._sorted_keys = None
+        self._parsed = dict()
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._values:
+            self._sorted_keys = None
+        self._values[key] = value
+        self._parsed.pop(key, None)
+
+    def __delitem__(self, key):
+        # the line of the key stays in `layout`, but is written without it
+        del self._values[key]
+        self._parsed.pop(key, None)
+        self._sorted_keys = None
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def setdefault(self, key, default):
+        if key not in self._values:
+            self[key] = default
+        return self._values[key]
+
+    def items(self):
+        return self._values.items()
+
+    def get_value(self, key, default=None):
+        '''Return the value of `key` as str, int or bool (parsed once), or `default`.'''
+        try:
+            return self._parsed[key]
+        except KeyError:
+            pass
+        if key not in self._values:
+            return default
+        try:
+            value = parse_value(self._values[key])
+        except ValueError:
+            raise Exception('Cannot parse ' + key + ' = ' + self._values[key] +
+                            ' in manifest (strings must be put in double quotes)')
+        self._parsed[key] = value
+        return value
+
+    def set_value(self, key, value):
+        self[key] = format_value(value)
+        self._parsed[key] = value
+
+    def sorted_keys(self):
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self._values)
+        return self._sorted_keys
+
+    def items_with_prefix(self, prefix):
+        '''Return (key, value) of all keys starting with `prefix`, sorted by key.'''
+        keys = self.sorted_keys()
+        start = bisect.bisect_left(keys, prefix)
+        # all keys starting with `prefix` sort before `prefix` + the highest code point
+        end = bisect.bisect_left(keys, prefix + chr(0x10ffff), start)
+        return [(key, self._values[key]) for key in keys[start:end]]
+
+
 def read_manifest(filename):
-    manifest = dict()
-    manifest_layout = []
+    manifest = Manifest()
+    values = manifest._values # pylint: disable=protected-access
+    append_layout = manifest.layout.append
     with open(filename, "r") as file:
-        for line in file:
-            if line == "":
-                manifest_layout.append((None, None))
-                break
+        lines = file.read().split('\n')
+    if lines[-1] == '':
+        lines.pop()
 
+    for line in lines:
+        if '#' in line:
             pound = line.find("#")
-            if pound != -1:
-                comment = line[pound:].strip()
-                line = line[:pound]
-            else:
-                comment = None
+            comment = line[pound:].strip()
+            line = line[:pound]
+        else:
+            comment = None
 
-            line = line.strip()
-            equal = line.find("=")
-            if equal != -1:
-                key = line[:equal].strip()
-                manifest[key] = line[equal + 1:].strip()
-            else:
-                key = None
+        (key, equal, value) = line.partition("=")
+        if equal:
+            key = key.strip()
+            values[key] = value.strip()
+        else:
+            key = None
 
-            manifest_layout.append((key, comment))
+        append_layout((key, comment))
 
-    return (manifest, manifest_layout)
+    return manifest
 
 
 def exec_sig_manifest(args):
@@ -106,31 +261,36 @@ def exec_sig_manifest(args):
     return 0
 
 
-def output_manifest(filename, manifest, manifest_layout):
-    with open(filename, 'w') as file:
-        written = []
+def format_manifest(manifest):
+    lines = ['# DO NOT MODIFY. THIS FILE WAS AUTO-GENERATED.\n\n']
+    written = set()
+
+    for (key, comment) in manifest.layout:
+        line = ''
+        if key is not None and key in manifest:
+            line += key + ' = ' + manifest[key]
+            written.add(key)
+        if comment is not None:
+            if line != '':
+                line += ' '
+            line += comment
+        lines.append(line)
+        lines.append('\n')
+
+    lines.append('\n')
+    lines.append('# Generated by Graphene\n')
+    lines.append('\n')
 
-        file.write('# DO NOT MODIFY. THIS FILE WAS AUTO-GENERATED.\n\n')
+    for key in manifest.sorted_keys():
+        if key not in written:
+            lines.append("%s = %s\n" % (key, manifest[key]))
 
-        for (key, comment) in manifest_layout:
-            line = ''
-            if key is not None:
-                line += key + ' = ' + manifest[key]
-                written.append(key)
-            if comment is not None:
-                if line != '':
-                    line += ' '
-                line += comment
-            file.write(line)
-            file.write('\n')
+    return ''.join(lines)
 
-        file.write('\n')
-        file.write('# Generated by Graphene\n')
-        file.write('\n')
 
-        for key in sorted(manifest):
-            if key not in written:
-                file.write("%s = %s\n" % (key, manifest[key]))
+def output_manifest(filename, manifest):
+    with open(filename, 'w') as file:
+        file.write(format_manifest(manifest))
 
 
 # Loading Enclave Attributes
@@ -173,7 +333,7 @@ def get_enclave_attributes(manifest):
     for opt in manifest_options:
         key = 'sgx.' + opt
         if key in manifest:
-            if manifest[key] == '1':
+            if parse_int(manifest.get_value(key)) == 1:
                 attributes.add(manifest_options[opt])
             else:
                 attributes.discard(manifest_options[opt])
@@ -199,9 +359,6 @@ def get_enclave_attributes(manifest):
 # Generate Checksums / Measurement
 
 def resolve_uri(uri, check_exist=True):
-    if len(uri) > 1 and uri.startswith('"') and uri.endswith('"'):
-        uri = uri[1:-1]
-
     orig_uri = uri
     if uri.startswith('file:'):
         target = os.path.normpath(uri[len('file:'):])
@@ -213,14 +370,279 @@ def resolve_uri(uri, check_exist=True):
     return target
 
 
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+
 def get_checksum(filename):
-    digest = hashlib.sha256()
     with open(filename, 'rb') as file:
-        digest.update(file.read())
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+: hashes in C, without ever holding the whole file in memory
+            return hashlib.file_digest(file, 'sha256').digest()
+
+        digest = hashlib.sha256()
+        buf = bytearray(CHECKSUM_CHUNK_SIZE)
+        view = memoryview(buf)
+        while True:
+            size = file.readinto(buf)
+            if not size:
+                break
+            digest.update(view[:size])
     return digest.digest()
 
 
-def get_trusted_files(manifest, args, check_exist=True, do_checksum=True):
+def _hash_files(filenames, jobs):
+    if jobs == 1 or len(filenames) <= 1:
+        return [get_checksum(filename) for filename in filenames]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(get_checksum, filenames))
+
+
+def get_checksums(filenames, jobs=None, checksum_cache=None, report=None):
+    '''Compute SHA256 checksums of files in parallel, returned in the order of `filenames`.'''
+    filenames = list(filenames)
+    checksums = []
+    missing = []
+    if checksum_cache is not None:
+        try:
+            for i, filename in enumerate(filenames):
+                (cache_key, checksum) = checksum_cache.lookup(filename)
+                checksums.append(checksum)
+                if checksum is None:
+                    missing.append((i, cache_key))
+        except sqlite3.Error as exc:
+            print('Warning: checksum cache not used (%s)' % exc, file=sys.stderr)
+            checksum_cache = None
+
+    if checksum_cache is None:
+        if report is not None:
+            report.add_hashed('trusted_files', sum(map(os.path.getsize, filenames)))
+        return _hash_files(filenames, jobs)
+
+    if report is not None:
+        report.add_hashed('trusted_files', sum(cache_key[3] for (_, cache_key) in missing))
+    hashed = _hash_files([filenames[i] for (i, _) in missing], jobs)
+    for (i, cache_key), checksum in zip(missing, hashed):
+        checksums[i] = checksum
+        checksum_cache.store(cache_key, checksum)
+    try:
+        checksum_cache.commit()
+    except sqlite3.Error as exc:
+        print('Warning: checksum cache not updated (%s)' % exc, file=sys.stderr)
+
+    return checksums
+
+
+def get_cache_dir():
+    '''Directory holding the persistent caches of the signer.'''
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'graphene')
+
+
+class ChecksumCache:
+    '''Persistent cache of trusted-file checksums, shared by all runs of the signer.'''
+
+    def __init__(self, path=None, max_entries=DEFAULT_CHECKSUM_CACHE_ENTRIES):
+        if path is None:
+            path = os.path.join(get_cache_dir(), 'sgx-sign-checksums.sqlite3')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._clock = int(time.time() * 1000000)
+        self._used = []
+        self._stored = []
+
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS checksums (
+                                path TEXT PRIMARY KEY,
+                                dev INTEGER, ino INTEGER, size INTEGER,
+                                mtime_ns INTEGER, ctime_ns INTEGER,
+                                checksum BLOB, last_used INTEGER)''')
+        self._db.execute('''CREATE INDEX IF NOT EXISTS checksums_last_used
+                            ON checksums (last_used)''')
+        self._db.commit()
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def lookup(self, filename):
+        '''Return (key, checksum); checksum is None on a miss and key is passed to store().'''
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        key = (path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+
+        row = self._db.execute('''SELECT checksum FROM checksums WHERE path = ? AND dev = ?
+                                  AND ino = ? AND size = ? AND mtime_ns = ? AND ctime_ns = ?''',
+                               key).fetchone()
+        if row is None:
+            self.misses += 1
+            return (key, None)
+
+        self.hits += 1
+        self._used.append((self._tick(), path))
+        return (key, bytes(row[0]))
+
+    def store(self, key, checksum):
+        self._stored.append(key + (checksum, self._tick()))
+
+    def commit(self):
+        (used, self._used) = (self._used, [])
+        (stored, self._stored) = (self._stored, [])
+        with self._db:
+            self._db.executemany('UPDATE checksums SET last_used = ? WHERE path = ?', used)
+            self._db.executemany('''INSERT OR REPLACE INTO checksums
+                                    (path, dev, ino, size, mtime_ns, ctime_ns, checksum,
+                                     last_used)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', stored)
+
+    def close(self):
+        try:
+            self.commit()
+            (count,) = self._db.execute('SELECT COUNT(*) FROM checksums').fetchone()
+            if count > self.max_entries:
+                with self._db:
+                    self._db.execute('''DELETE FROM checksums WHERE path IN (
+                                        SELECT path FROM checksums ORDER BY last_used LIMIT ?)''',
+                                     (count - self.max_entries,))
+        except sqlite3.Error as exc:
+            print('Warning: checksum cache not updated (%s)' % exc, file=sys.stderr)
+        finally:
+            self._db.close()
+
+
+def open_checksum_cache(args):
+    '''Open the checksum cache requested on the command line, or return None.'''
+    if not args.get('checksum_cache', True):
+        return None
+    try:
+        return ChecksumCache()
+    except (OSError, sqlite3.Error) as exc:
+        print('Warning: checksum cache disabled (%s)' % exc, file=sys.stderr)
+        return None
+
+
+# Trusted file patterns
+
+def glob_to_regex(pattern):
+    '''Compile a glob pattern matching paths relative to a directory.'''
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^/' + chars[1:]
+            regex.append('[' + chars + ']')
+            i = end + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile(''.join(regex) + r'\Z', re.DOTALL)
+
+
+def is_trusted_file_pattern(uri):
+    '''Whether a trusted-file URI is a glob pattern or a directory (ending in `/`).'''
+    return re.search(r'[*?[]', uri) is not None or uri.endswith('/')
+
+
+def _scan_dir(path):
+    files = []
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # symlinked directories are not followed, so there are no loops
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                files.append(entry.path)
+    return (files, subdirs)
+
+
+def walk_files(root, max_depth=None, jobs=None):
+    '''Return all regular files below `root`, scanning directories in parallel.'''
+    files = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(_scan_dir, root): 0}
+        while pending:
+            (finished, _) = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                depth = pending.pop(future)
+                (dir_files, subdirs) = future.result()
+                files.extend(dir_files)
+                if max_depth is None or depth < max_depth:
+                    for subdir in subdirs:
+                        pending[executor.submit(_scan_dir, subdir)] = depth + 1
+    return files
+
+
+def expand_trusted_file_pattern(uri, jobs=None):
+    '''Return the sorted paths of all regular files matching a trusted-file pattern.'''
+    path = uri[len('file:'):] if uri.startswith('file:') else uri
+    if path.endswith('/'):
+        path += '**'
+
+    # split off the leading directories without wildcards, only below them is scanned
+    components = path.split('/')
+    magic = next(i for i, component in enumerate(components)
+                 if re.search(r'[*?[]', component) is not None)
+    root = '/'.join(components[:magic]) or ('/' if path.startswith('/') else '.')
+    pattern = '/'.join(components[magic:])
+    max_depth = None if '**' in pattern else pattern.count('/')
+
+    if not os.path.isdir(root):
+        return []
+    regex = glob_to_regex(pattern)
+    return sorted(filename for filename in walk_files(root, max_depth, jobs)
+                  if regex.match(os.path.relpath(filename, root)))
+
+
+def expand_trusted_files(manifest, jobs=None, check_exist=True):
+    '''Replace trusted files given as glob patterns or directories by the files they match.'''
+    patterns = [(key, manifest.get_value(key))
+                for (key, _) in manifest.items_with_prefix('sgx.trusted_files.')]
+    patterns = [(key, uri) for (key, uri) in patterns
+                if isinstance(uri, str) and is_trusted_file_pattern(uri)]
+    if not patterns:
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        expansions = list(executor.map(expand_trusted_file_pattern,
+                                       [uri for (_, uri) in patterns], [jobs] * len(patterns)))
+
+    for (key, uri), files in zip(patterns, expansions):
+        if not files and check_exist:
+            raise Exception('No files match ' + uri + ' (' + key + ')')
+        del manifest[key]
+        width = len(str(len(files) - 1))
+        for i, filename in enumerate(files):
+            expanded_key = '%s_%0*d' % (key, width, i)
+            if expanded_key in manifest:
+                raise Exception('repeated key in manifest: ' + expanded_key)
+            manifest.set_value(expanded_key, 'file:' + filename)
+
+
+def get_trusted_files(manifest, args, check_exist=True, do_checksum=True, checksum_cache=None,
+                      report=None):
+    '''Return {key: (uri, path[, checksum])} of the trusted files, expanding patterns first.'''
+    # pylint: disable=too-many-locals
+    expand_trusted_files(manifest, args.get('jobs'), check_exist)
     targets = dict()
 
     if 'exec' in args:
@@ -228,28 +650,39 @@ def get_trusted_files(manifest, args, check_exist=True, do_checksum=True):
                                                      check_exist))
 
     if 'loader.preload' in manifest:
-        preload_str = manifest['loader.preload']
-        if len(preload_str) < 2 or not preload_str.startswith('"') or not preload_str.endswith('"'):
+        preload_str = manifest.get_value('loader.preload')
+        if not isinstance(preload_str, str):
             raise Exception('Cannot parse loader.preload (value must be put in double quotes).')
-        preload_str = preload_str[1:-1]
 
         for i, uri in enumerate(str.split(preload_str, ',')):
             targets['preload' + str(i)] = (uri, resolve_uri(uri, check_exist))
 
-    for (key, val) in manifest.items():
-        if not key.startswith('sgx.trusted_files.'):
-            continue
+    for (key, val) in manifest.items_with_prefix('sgx.trusted_files.'):
         key = key[len('sgx.trusted_files.'):]
         if key in targets:
             raise Exception(
                 'repeated key in manifest: sgx.trusted_files.' + key)
-        targets[key] = (val, resolve_uri(val, check_exist))
+        targets[key] = (val, resolve_uri(manifest.get_value('sgx.trusted_files.' + key),
+                                         check_exist))
 
     if do_checksum:
-        for (key, val) in targets.items():
-            (uri, target) = val
-            checksum = get_checksum(target).hex()
-            targets[key] = (uri, target, checksum)
+        kept = {}
+        if args.get('keep_checksums'):
+            for key in targets:
+                checksum = manifest.get_value('sgx.trusted_checksum.' + key)
+                if checksum is None:
+                    continue
+                if not isinstance(checksum, str) or not re.fullmatch('[0-9a-f]{64}', checksum):
+                    raise Exception('Invalid sgx.trusted_checksum.' + key + ' in manifest')
+                kept[key] = checksum
+
+        to_hash = [key for key in targets if key not in kept]
+        checksums = get_checksums((targets[key][1] for key in to_hash),
+                                  args.get('jobs'), checksum_cache, report)
+        for key, checksum in zip(to_hash, checksums):
+            kept[key] = checksum.hex()
+        for key, (uri, target) in list(targets.items()):
+            targets[key] = (uri, target, kept[key])
 
     return targets
 
@@ -257,15 +690,13 @@ def get_trusted_files(manifest, args, check_exist=True, do_checksum=True):
 def get_trusted_children(manifest, check_exist=True, do_checksum=True):
     targets = dict()
 
-    for (key, val) in manifest.items():
-        if not key.startswith('sgx.trusted_children.'):
-            continue
+    for (key, val) in manifest.items_with_prefix('sgx.trusted_children.'):
         key = key[len('sgx.trusted_children.'):]
         if key in targets:
             raise Exception(
                 'repeated key in manifest: sgx.trusted_children.' + key)
 
-        target = resolve_uri(val, check_exist)
+        target = resolve_uri(manifest.get_value('sgx.trusted_children.' + key), check_exist)
         if not target.endswith('.sig'):
             target += '.sig'
         if do_checksum:
@@ -278,6 +709,69 @@ def get_trusted_children(manifest, check_exist=True, do_checksum=True):
     return targets
 
 
+# Per-chunk Hashes of Large Trusted Files
+
+# Sidecar files with the SHA256 of every TRUSTED_STUB_SIZE chunk of a trusted file (see
+# Pal/src/host/Linux-SGX/enclave_framework.c)
+TRUSTED_CHUNKS_MAGIC = b'GSGXCHNK'
+TRUSTED_CHUNKS_HEADER = struct.Struct('<8sQQ32s')
+
+
+def get_chunk_hashes_dir(args):
+    # absolute, the PAL resolves URIs against its own working directory
+    return os.path.abspath(args['sigfile'][:-len('.sig')] + '.trusted-chunks')
+
+
+def write_chunk_hashes(filename, target, checksum):
+    '''Write the per-chunk hashes of `target` to `filename` and return their own SHA256.'''
+    size = os.path.getsize(target)
+    nchunks = (size + offs.TRUSTED_STUB_SIZE - 1) // offs.TRUSTED_STUB_SIZE
+    chunks = [TRUSTED_CHUNKS_HEADER.pack(TRUSTED_CHUNKS_MAGIC, offs.TRUSTED_STUB_SIZE, size,
+                                         checksum)]
+    buf = bytearray(offs.TRUSTED_STUB_SIZE)
+    view = memoryview(buf)
+    with open(target, 'rb') as file:
+        while True:
+            length = file.readinto(buf)
+            if not length:
+                break
+            chunks.append(hashlib.sha256(view[:length]).digest())
+    if len(chunks) != nchunks + 1:
+        raise Exception('File changed while hashing it: ' + target)
+
+    data = b''.join(chunks)
+    try:
+        with open(filename, 'rb') as file:
+            unchanged = file.read() == data
+    except OSError:
+        unchanged = False
+    # an identical sidecar is not rewritten, so that its mtime stays the same
+    if not unchanged:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as file:
+            file.write(data)
+        os.replace(tmpname, filename)
+    return hashlib.sha256(data).digest()
+
+
+def get_chunk_hashes(trusted_files, directory, min_size, jobs=None):
+    '''Write chunk hashes of trusted files of at least `min_size` bytes into `directory`.'''
+    keys = [key for (key, (_, target, _)) in trusted_files.items()
+            if os.path.getsize(target) >= min_size]
+    filenames = [os.path.join(directory, key) for key in keys]
+    params = (filenames,
+              [trusted_files[key][1] for key in keys],
+              [bytes.fromhex(trusted_files[key][2]) for key in keys])
+    if jobs == 1 or len(keys) <= 1:
+        checksums = list(map(write_chunk_hashes, *params))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            checksums = list(executor.map(write_chunk_hashes, *params))
+    return {key: (filename, checksum.hex())
+            for key, filename, checksum in zip(keys, filenames, checksums)}
+
+
 # Populate Enclave Memory
 
 PAGEINFO_R = 0x1
@@ -287,47 +781,65 @@ PAGEINFO_TCS = 0x100
 PAGEINFO_REG = 0x200
 
 
+# ELF64 definitions (see elf.h), enough to find the loadable segments and the entry point
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+PT_LOAD = 1
+
+ELF64_EHDR = struct.Struct('<16sHHIQQQIHHHHHH')
+ELF64_PHDR = struct.Struct('<IIQQQQQQ')
+
+
+@functools.lru_cache(maxsize=None)
+def _read_elf_info(filename, mtime_ns, size):
+    # pylint: disable=unused-argument,too-many-locals
+    # mtime_ns and size are only part of the cache key, so that a rebuilt file is parsed again
+    if size < ELF64_EHDR.size:
+        return None
+
+    with open(filename, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            with memoryview(mapping) as view:
+                if bytes(view[:len(ELF_MAGIC)]) != ELF_MAGIC:
+                    return None
+                (ident, _, _, _, entry, phoff, _, _, _, phentsize, phnum, _, _,
+                 _) = ELF64_EHDR.unpack_from(view, 0)
+                if ident[4] != ELFCLASS64 or ident[5] != ELFDATA2LSB:
+                    raise ValueError('Unsupported ELF file ' + filename +
+                                     ' (only 64-bit little-endian is supported)')
+                if phentsize < ELF64_PHDR.size or phoff + phnum * phentsize > size:
+                    raise ValueError('Malformed program headers in ELF file ' + filename)
+
+                loadcmds = []
+                for i in range(phnum):
+                    (p_type, p_flags, p_offset, p_vaddr, _, p_filesz, p_memsz,
+                     _) = ELF64_PHDR.unpack_from(view, phoff + i * phentsize)
+                    if p_type != PT_LOAD:
+                        continue
+                    # PF_R/PF_W/PF_X have the same values as the prot bits used below (4/2/1)
+                    loadcmds.append((p_offset, p_vaddr, p_filesz, p_memsz, p_flags & 0x7))
+
+    return (entry, tuple(loadcmds))
+
+
+def get_elf_info(filename):
+    '''Return (entry point, loadcmds) of an ELF file, or None if it is not an ELF file.'''
+    stat = os.stat(filename)
+    return _read_elf_info(os.path.realpath(filename), stat.st_mtime_ns, stat.st_size)
+
+
 def get_loadcmds(filename):
-    loadcmds = []
-    proc = subprocess.Popen(['readelf', '-l', '-W', filename],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    while True:
-        line = proc.stdout.readline()
-        if not line:
-            break
-        line = line.decode()
-        stripped = line.strip()
-        if not stripped.startswith('LOAD'):
-            continue
-        tokens = stripped.split()
-        if len(tokens) < 6:
-            continue
-        if len(tokens) >= 7 and tokens[7] == "E":
-            tokens[6] += tokens[7]
-        prot = 0
-        for token in tokens[6]:
-            if token == "R":
-                prot = prot | 4
-            if token == "W":
-                prot = prot | 2
-            if token == "E":
-                prot = prot | 1
-
-        loadcmds.append((int(tokens[1][2:], 16),  # offset
-                         int(tokens[2][2:], 16),  # addr
-                         int(tokens[4][2:], 16),  # filesize
-                         int(tokens[5][2:], 16),  # memsize
-                         prot))
-    proc.wait()
-    if proc.returncode != 0:
+    elf_info = get_elf_info(filename)
+    if elf_info is None:
         return None
-    return loadcmds
+    return list(elf_info[1])
 
 
 class MemoryArea:
     # pylint: disable=too-few-public-methods,too-many-instance-attributes
     def __init__(self, desc, file=None, content=None, addr=None, size=None,
-                 flags=None, measure=True):
+                 flags=None, measure=True, template=None):
         # pylint: disable=too-many-arguments
         self.desc = desc
         self.file = file
@@ -337,9 +849,13 @@ class MemoryArea:
         self.flags = flags
         self.is_binary = False
         self.measure = measure
+        self.template = template
 
         if file:
-            loadcmds = get_loadcmds(file)
+            if template is not None:
+                loadcmds = list(template.loadcmds)
+            else:
+                loadcmds = get_loadcmds(file)
             if loadcmds:
                 mapaddr = 0xffffffffffffffff
                 mapaddr_end = 0
@@ -380,7 +896,8 @@ def get_memory_areas(attr, args):
         areas.append(MemoryArea('sig_stack', size=offs.ENCLAVE_SIG_STACK_SIZE,
                                 flags=PAGEINFO_R | PAGEINFO_W | PAGEINFO_REG))
 
-    areas.append(MemoryArea('pal', file=args['libpal'], flags=PAGEINFO_REG))
+    areas.append(MemoryArea('pal', file=args['libpal'], flags=PAGEINFO_REG,
+                            template=load_pal_template(args)))
 
     if 'exec' in args:
         areas.append(MemoryArea('exec', file=args['exec'],
@@ -406,15 +923,10 @@ def find_area(areas, desc, allow_none=False):
 
 
 def entry_point(elf_path):
-    env = os.environ
-    env['LC_ALL'] = 'C'
-    out = subprocess.check_output(
-        ['readelf', '-l', '--', elf_path], env=env)
-    for line in out.splitlines():
-        line = line.decode()
-        if line.startswith("Entry point "):
-            return int(line[12:], 0)
-    raise ValueError("Could not find entry point of elf file")
+    elf_info = get_elf_info(elf_path)
+    if elf_info is None:
+        raise ValueError("Could not find entry point of elf file")
+    return elf_info[0]
 
 
 def gen_area_content(attr, areas, enclave_base_addr, enclave_heap_min):
@@ -439,6 +951,10 @@ def gen_area_content(attr, areas, enclave_base_addr, enclave_heap_min):
         struct.pack_into('<Q', tls_data, t * offs.PAGESIZE + offset, value)
 
     enclave_heap_max = pal_area.addr
+    if pal_area.template is not None:
+        pal_entry = pal_area.template.entry
+    else:
+        pal_entry = entry_point(pal_area.file)
 
     # Sanity check that we measure everything except the heap which is zeroed
     # on enclave startup.
@@ -456,8 +972,7 @@ def gen_area_content(attr, areas, enclave_base_addr, enclave_heap_min):
         ssa = enclave_base_addr + ssa_offset
         set_tcs_field(t, offs.TCS_OSSA, '<Q', ssa_offset)
         set_tcs_field(t, offs.TCS_NSSA, '<L', offs.SSAFRAMENUM)
-        set_tcs_field(t, offs.TCS_OENTRY, '<Q',
-                      pal_area.addr + entry_point(pal_area.file))
+        set_tcs_field(t, offs.TCS_OENTRY, '<Q', pal_area.addr + pal_entry)
         set_tcs_field(t, offs.TCS_OGS_BASE, '<Q', tls_area.addr + offs.PAGESIZE * t)
         set_tcs_field(t, offs.TCS_OFS_LIMIT, '<L', 0xfff)
         set_tcs_field(t, offs.TCS_OGS_LIMIT, '<L', 0xfff)
@@ -484,7 +999,8 @@ def gen_area_content(attr, areas, enclave_base_addr, enclave_heap_min):
     tls_area.content = tls_data
 
 
-def populate_memory_areas(attr, areas, enclave_base_addr, enclave_heap_min):
+def layout_memory_areas(attr, areas, enclave_heap_min):
+    '''Assign addresses to `areas` from the top of the enclave down; return the free areas.'''
     populating = attr['enclave_size']
 
     for area in areas:
@@ -513,147 +1029,493 @@ def populate_memory_areas(attr, areas, enclave_base_addr, enclave_heap_min):
                        size=populating - enclave_heap_min, flags=flags,
                        measure=False))
 
+    return free_areas
+
+
+def populate_memory_areas(attr, areas, enclave_base_addr, enclave_heap_min):
+    free_areas = layout_memory_areas(attr, areas, enclave_heap_min)
     gen_area_content(attr, areas, enclave_base_addr, enclave_heap_min)
 
     return areas + free_areas
 
 
-def generate_measurement(attr, areas):
-    # pylint: disable=too-many-statements,too-many-branches,too-many-locals
+# Each record hashed into MRENCLAVE is 64 bytes; EEXTEND is followed by 256 bytes of page content
+ECREATE_RECORD = struct.Struct('<8sLQ44x')
+EADD_RECORD = struct.Struct('<8sQQ40x')
+EEXTEND_CHUNK_SIZE = 256
+# EADD of one page followed by all its EEXTENDs; the content of each chunk is left as zero padding
+MEASURED_PAGE_RECORD = struct.Struct(
+    '<8sQQ40x' + ('8sQ48x%dx' % EEXTEND_CHUNK_SIZE) * (offs.PAGESIZE // EEXTEND_CHUNK_SIZE))
+# (index of 8-byte word, offset from page address) of the addresses in a MEASURED_PAGE_RECORD
+MEASURED_PAGE_ADDRESS_FIELDS = ((1, 0),) + tuple(
+    ((EADD_RECORD.size + i // EEXTEND_CHUNK_SIZE * (64 + EEXTEND_CHUNK_SIZE)) // 8 + 1, i)
+    for i in range(0, offs.PAGESIZE, EEXTEND_CHUNK_SIZE))
+# (offset in MEASURED_PAGE_RECORD, offset in page) of every EEXTEND chunk
+MEASURED_PAGE_CHUNKS = tuple((EADD_RECORD.size + (i // EEXTEND_CHUNK_SIZE + 1) * 64
+                              + i // EEXTEND_CHUNK_SIZE * EEXTEND_CHUNK_SIZE, i)
+                             for i in range(0, offs.PAGESIZE, EEXTEND_CHUNK_SIZE))
+# Number of pages in 16MB, i.e. pages whose addresses differ only in their low 3 bytes
+UNIFORM_BLOCK_PAGES = (1 << 24) // offs.PAGESIZE
+
+
+def measured_page_template(flags):
+    '''MEASURED_PAGE_RECORD of an all-zero page at address 0.'''
+    return MEASURED_PAGE_RECORD.pack(
+        b'EADD', 0, flags, *[b'EEXTEND', 0] * (offs.PAGESIZE // EEXTEND_CHUNK_SIZE))
+
+
+def set_page_addresses(records, addr, record_size, address_fields):
+    '''Fill in the addresses of the records of consecutive pages starting at `addr`.'''
+    npages = len(records) // record_size
+    with memoryview(records).cast('B').cast('Q') as words:
+        for (index, delta) in address_fields:
+            first = addr + delta
+            words[index::record_size // 8] = array.array(
+                'Q', range(first, first + npages * offs.PAGESIZE, offs.PAGESIZE))
+
+
+def build_page_records(records, page_offset, flags, content, content_offset):
+    '''Write the MEASURED_PAGE_RECORDs of the pages from `page_offset` on into `records`.'''
+    # pylint: disable=too-many-locals
+    page_size = offs.PAGESIZE
+    npages = len(records) // MEASURED_PAGE_RECORD.size
+    records[:] = measured_page_template(flags) * npages
+
+    content = memoryview(content)
+    content_end = content_offset + len(content)
+    pos = 0
+    for page_offset in range(page_offset, page_offset + npages * page_size, page_size):
+        if content_offset <= page_offset and page_offset + page_size <= content_end:
+            data = content[page_offset - content_offset:]
+        else:
+            # page partially covered by content: pad it with zeros
+            data = bytearray(page_size)
+            start = max(content_offset, page_offset)
+            end = min(content_end, page_offset + page_size)
+            data[start - page_offset:end - page_offset] = \
+                content[start - content_offset:end - content_offset]
+
+        for (dst, src) in MEASURED_PAGE_CHUNKS:
+            records[pos + dst:pos + dst + EEXTEND_CHUNK_SIZE] = \
+                data[src:src + EEXTEND_CHUNK_SIZE]
+        pos += MEASURED_PAGE_RECORD.size
+
+
+class EnclaveMeasurement:
+    '''Computes MRENCLAVE by replaying the ECREATE/EADD/EEXTEND sequence of the enclave.'''
+    BATCH_PAGES = 64
+
+    def __init__(self, enclave_size):
+        self.digest = hashlib.sha256()
+        self.bytes_hashed = 0
+        self._buf = bytearray(MEASURED_PAGE_RECORD.size * self.BATCH_PAGES)
+        self._view = memoryview(self._buf)
+        self._pos = 0
+        self._block_templates = {}
+        # (index of 8-byte word, offset from page address) of the address in an EADD record
+        self._eadd_address_fields = ((1, 0),)
+
+        self._reserve(ECREATE_RECORD.size)
+        ECREATE_RECORD.pack_into(self._buf, self._pos, b'ECREATE',
+                                 SSAFRAMESIZE // offs.PAGESIZE, enclave_size)
+        self._pos += ECREATE_RECORD.size
+
+    def _flush(self):
+        if self._pos:
+            self.digest.update(self._view[:self._pos])
+            self.bytes_hashed += self._pos
+            self._pos = 0
+
+    def _reserve(self, size):
+        if self._pos + size > len(self._buf):
+            self._flush()
+
+    def _batches(self, size, record_size):
+        '''Split [0, size) into runs of pages whose records fit into the buffer at once.'''
+        page_offset = 0
+        while page_offset < size:
+            self._reserve(record_size)
+            npages = min((size - page_offset) // offs.PAGESIZE,
+                         (len(self._buf) - self._pos) // record_size)
+            yield (page_offset, page_offset + npages * offs.PAGESIZE)
+            page_offset += npages * offs.PAGESIZE
+
+    def _add_uniform_pages(self, addr, size, template, address_fields):
+        '''Emit the records of a run of pages which differ only in the page address.'''
+        if size >= UNIFORM_BLOCK_PAGES * offs.PAGESIZE:
+            self._add_uniform_blocks(addr, size, template, address_fields)
+            return
+
+        record_size = len(template)
+        batch_template = template * (len(self._buf) // record_size)
+        for (batch_start, batch_end) in self._batches(size, record_size):
+            npages = (batch_end - batch_start) // offs.PAGESIZE
+            pos = self._pos
+            with self._view[pos:pos + npages * record_size] as records:
+                records[:] = batch_template[:npages * record_size]
+                set_page_addresses(records, addr + batch_start, record_size, address_fields)
+            self._pos = pos + npages * record_size
+
+    def _add_uniform_blocks(self, addr, size, template, address_fields):
+        # Same as _add_uniform_pages() for long runs: the records of an aligned 16MB block are
+        # prebuilt once, then only the high 5 bytes of the addresses are set per block.
+        # pylint: disable=too-many-locals
+        record_size = len(template)
+        block = self._block_templates.get(template)
+        if block is None:
+            block = bytearray(template * UNIFORM_BLOCK_PAGES)
+            with memoryview(block).cast('Q') as words:
+                for (index, delta) in address_fields:
+                    words[index::record_size // 8] = array.array(
+                        'Q', range(delta, delta + UNIFORM_BLOCK_PAGES * offs.PAGESIZE,
+                                   offs.PAGESIZE))
+            self._block_templates[template] = block
+        block = memoryview(block)
+        records = bytearray(len(block))
+        view = memoryview(records)
+
+        self._flush()
+        end = addr + size
+        while addr < end:
+            first = (addr // offs.PAGESIZE) % UNIFORM_BLOCK_PAGES
+            npages = min(UNIFORM_BLOCK_PAGES - first, (end - addr) // offs.PAGESIZE)
+            length = npages * record_size
+            view[:length] = block[first * record_size:first * record_size + length]
+            high_bytes = (addr >> 24).to_bytes(5, byteorder='little')
+            for (index, _) in address_fields:
+                for i in range(5):
+                    records[index * 8 + 3 + i:length:record_size] = high_bytes[i:i + 1] * npages
+            self.digest.update(view[:length])
+            self.bytes_hashed += length
+            addr += npages * offs.PAGESIZE
+        view.release()
+        block.release()
+
+    def add_pages(self, addr, size, flags, content=b'', content_offset=0, measure=True):
+        '''EADD (and EEXTEND if `measure`) all pages in [addr, addr + size).'''
+        # pylint: disable=too-many-arguments
+        if not measure:
+            self._add_uniform_pages(addr, size, EADD_RECORD.pack(b'EADD', 0, flags),
+                                    self._eadd_address_fields)
+            return
+
+        # only pages overlapping with the content are built one by one
+        if content:
+            first_page = min(rounddown(content_offset), size)
+            end_page = min(roundup(content_offset + len(content)), size)
+        else:
+            first_page = end_page = size
+        if first_page:
+            self._add_uniform_pages(addr, first_page, measured_page_template(flags),
+                                    MEASURED_PAGE_ADDRESS_FIELDS)
+
+        for (batch_start, batch_end) in self._batches(end_page - first_page,
+                                                      MEASURED_PAGE_RECORD.size):
+            pos = self._pos
+            length = (batch_end - batch_start) // offs.PAGESIZE * MEASURED_PAGE_RECORD.size
+            with self._view[pos:pos + length] as records:
+                build_page_records(records, first_page + batch_start, flags, content,
+                                   content_offset)
+                set_page_addresses(records, addr + first_page + batch_start,
+                                   MEASURED_PAGE_RECORD.size, MEASURED_PAGE_ADDRESS_FIELDS)
+            self._pos = pos + length
+
+        if end_page < size:
+            self._add_uniform_pages(addr + end_page, size - end_page,
+                                    measured_page_template(flags), MEASURED_PAGE_ADDRESS_FIELDS)
+
+    def add_prebuilt_pages(self, addr, size, flags, first_page, records):
+        '''Same as add_pages(), with the records of the content pages built in advance.'''
+        # pylint: disable=too-many-arguments
+        end_page = first_page + len(records) // MEASURED_PAGE_RECORD.size * offs.PAGESIZE
+        if first_page:
+            self._add_uniform_pages(addr, first_page, measured_page_template(flags),
+                                    MEASURED_PAGE_ADDRESS_FIELDS)
+
+        self._flush()
+        batch_size = MEASURED_PAGE_RECORD.size * self.BATCH_PAGES
+        with memoryview(records) as view:
+            for start in range(0, len(view), batch_size):
+                batch = view[start:start + batch_size]
+                set_page_addresses(
+                    batch, addr + first_page + start // MEASURED_PAGE_RECORD.size * offs.PAGESIZE,
+                    MEASURED_PAGE_RECORD.size, MEASURED_PAGE_ADDRESS_FIELDS)
+                self.digest.update(batch)
+                self.bytes_hashed += len(batch)
+                batch.release()
+
+        if end_page < size:
+            self._add_uniform_pages(addr + end_page, size - end_page,
+                                    measured_page_template(flags), MEASURED_PAGE_ADDRESS_FIELDS)
+
+    def finalize(self):
+        self._flush()
+        return self.digest.digest()
+
+
+def print_area(addr, size, flags, desc, measured):
+    if flags & PAGEINFO_REG:
+        type_ = 'REG'
+    if flags & PAGEINFO_TCS:
+        type_ = 'TCS'
+    prot = ['-', '-', '-']
+    if flags & PAGEINFO_R:
+        prot[0] = 'R'
+    if flags & PAGEINFO_W:
+        prot[1] = 'W'
+    if flags & PAGEINFO_X:
+        prot[2] = 'X'
+    prot = ''.join(prot)
+
+    desc = '(' + desc + ')'
+    if measured:
+        desc += ' measured'
+
+    if size == offs.PAGESIZE:
+        print("    %016x [%s:%s] %s" % (addr, type_, prot, desc))
+    else:
+        print("    %016x-%016lx [%s:%s] %s" %
+              (addr, addr + size, type_, prot, desc))
 
-    def do_ecreate(digest, size):
-        data = struct.pack("<8sLQ44s", b"ECREATE", SSAFRAMESIZE // offs.PAGESIZE,
-                           size, b"")
-        digest.update(data)
-
-    def do_eadd(digest, offset, flags):
-        data = struct.pack("<8sQQ40s", b"EADD", offset, flags, b"")
-        digest.update(data)
-
-    def do_eextend(digest, offset, content):
-        if len(content) != 256:
-            raise ValueError("Exactly 256 bytes expected")
-
-        data = struct.pack("<8sQ48s", b"EEXTEND", offset, b"")
-        digest.update(data)
-        digest.update(content)
-
-    def include_page(digest, offset, flags, content, measure):
-        if len(content) != offs.PAGESIZE:
-            raise ValueError("Exactly one page expected")
-
-        do_eadd(digest, offset, flags)
-        if measure:
-            for i in range(0, offs.PAGESIZE, 256):
-                do_eextend(digest, offset + i, content[i:i + 256])
-
-    mrenclave = hashlib.sha256()
-    do_ecreate(mrenclave, attr['enclave_size'])
-
-    def print_area(addr, size, flags, desc, measured):
-        if flags & PAGEINFO_REG:
-            type_ = 'REG'
-        if flags & PAGEINFO_TCS:
-            type_ = 'TCS'
-        prot = ['-', '-', '-']
-        if flags & PAGEINFO_R:
-            prot[0] = 'R'
-        if flags & PAGEINFO_W:
-            prot[1] = 'W'
-        if flags & PAGEINFO_X:
-            prot[2] = 'X'
-        prot = ''.join(prot)
 
-        desc = '(' + desc + ')'
-        if measured:
-            desc += ' measured'
+def get_binary_segments(loadcmds, area_flags):
+    '''Yield (offset, addr, filesize, memsize, flags, desc) of every loadable segment.'''
+    for (offset, addr, filesize, memsize, prot) in loadcmds:
+        flags = area_flags
+        if prot & 4:
+            flags = flags | PAGEINFO_R
+        if prot & 2:
+            flags = flags | PAGEINFO_W
+        if prot & 1:
+            flags = flags | PAGEINFO_X
 
-        if size == offs.PAGESIZE:
-            print("    %016x [%s:%s] %s" % (addr, type_, prot, desc))
+        if flags & PAGEINFO_X:
+            desc = 'code'
         else:
-            print("    %016x-%016lx [%s:%s] %s" %
-                  (addr, addr + size, type_, prot, desc))
+            desc = 'data'
+        yield (offset, addr, filesize, memsize, flags, desc)
 
-    def load_file(digest, file, offset, addr, filesize, memsize, desc, flags):
+
+def generate_measurement(attr, areas, report=None, verbose=True):
+    # pylint: disable=too-many-locals
+
+    mrenclave = EnclaveMeasurement(attr['enclave_size'])
+    show_area = print_area if verbose else lambda *_: None
+
+    def load_file(data, offset, addr, filesize, memsize, desc, flags):
         # pylint: disable=too-many-arguments
         f_addr = rounddown(offset)
         m_addr = rounddown(addr)
         m_size = roundup(addr + memsize) - m_addr
 
-        print_area(m_addr, m_size, flags, desc, True)
+        show_area(m_addr, m_size, flags, desc, True)
 
-        for page in range(m_addr, m_addr + m_size, offs.PAGESIZE):
-            start = page - m_addr + f_addr
-            end = start + offs.PAGESIZE
-            start_zero = b""
-            if start < offset:
-                if offset - start >= offs.PAGESIZE:
-                    start_zero = ZERO_PAGE
-                else:
-                    start_zero = bytes(offset - start)
-            end_zero = b""
-            if end > offset + filesize:
-                if end - offset - filesize >= offs.PAGESIZE:
-                    end_zero = ZERO_PAGE
-                else:
-                    end_zero = bytes(end - offset - filesize)
-            start += len(start_zero)
-            end -= len(end_zero)
-            if start < end:
-                file.seek(start)
-                data = file.read(end - start)
-            else:
-                data = b""
-            if len(start_zero + data + end_zero) != offs.PAGESIZE:
-                raise Exception("wrong calculation")
-
-            include_page(digest, page, flags, start_zero + data + end_zero, True)
+        mrenclave.add_pages(m_addr, m_size, flags, data[offset:offset + filesize],
+                            offset - f_addr)
 
     for area in areas:
-        if area.file is not None:
+        if area.template is not None:
+            for (addr, size, flags, desc, first_page, records) in area.template.segments:
+                show_area(area.addr + addr, size, flags, desc, True)
+                mrenclave.add_prebuilt_pages(area.addr + addr, size, flags, first_page, records)
+        elif area.file is not None:
             with open(area.file, 'rb') as file:
-                if area.is_binary:
-                    loadcmds = get_loadcmds(area.file)
-                    if loadcmds:
-                        mapaddr = 0xffffffffffffffff
-                        for (offset, addr, filesize, memsize,
-                             prot) in loadcmds:
-                            if rounddown(addr) < mapaddr:
-                                mapaddr = rounddown(addr)
-                    baseaddr_ = area.addr - mapaddr
-                    for (offset, addr, filesize, memsize, prot) in loadcmds:
-                        flags = area.flags
-                        if prot & 4:
-                            flags = flags | PAGEINFO_R
-                        if prot & 2:
-                            flags = flags | PAGEINFO_W
-                        if prot & 1:
-                            flags = flags | PAGEINFO_X
-
-                        if flags & PAGEINFO_X:
-                            desc = 'code'
-                        else:
-                            desc = 'data'
-                        load_file(mrenclave, file, offset, baseaddr_ + addr,
-                                  filesize, memsize, desc, flags)
+                if os.fstat(file.fileno()).st_size:
+                    mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
                 else:
-                    load_file(mrenclave, file, 0, area.addr,
-                              os.stat(area.file).st_size, area.size,
-                              area.desc, area.flags)
+                    mapping = None  # empty files cannot be mmapped
+                try:
+                    data = memoryview(mapping) if mapping is not None else memoryview(b'')
+                    if area.is_binary:
+                        loadcmds = get_loadcmds(area.file)
+                        mapaddr = min(rounddown(addr) for (_, addr, _, _, _) in loadcmds)
+                        baseaddr_ = area.addr - mapaddr
+                        for (offset, addr, filesize, memsize, flags,
+                             desc) in get_binary_segments(loadcmds, area.flags):
+                            load_file(data, offset, baseaddr_ + addr, filesize, memsize, desc,
+                                      flags)
+                    else:
+                        load_file(data, 0, area.addr, len(data), area.size, area.desc,
+                                  area.flags)
+                    data.release()
+                finally:
+                    if mapping is not None:
+                        mapping.close()
         else:
-            for addr in range(area.addr, area.addr + area.size, offs.PAGESIZE):
-                data = ZERO_PAGE
-                if area.content is not None:
-                    start = addr - area.addr
-                    end = start + offs.PAGESIZE
-                    data = area.content[start:end]
-                    data += b'\0' * (offs.PAGESIZE - len(data)) # pad last page
-                include_page(mrenclave, addr, area.flags, data, area.measure)
+            content = area.content if area.content is not None else b''
+            mrenclave.add_pages(area.addr, area.size, area.flags, content, measure=area.measure)
+
+            show_area(area.addr, area.size, area.flags, area.desc, area.measure)
+
+    digest = mrenclave.finalize()
+    if report is not None:
+        report.add_hashed('measurement', mrenclave.bytes_hashed)
+    return digest
+
+
+# PAL Measurement Templates
 
-            print_area(area.addr, area.size, area.flags, area.desc,
-                       area.measure)
+PAL_TEMPLATE_VERSION = 1
 
-    return mrenclave.digest()
+
+class PalTemplate:
+    '''Measurement records of a PAL binary, independent of the address it is loaded at.'''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, entry, loadcmds, segments):
+        self.entry = entry
+        self.loadcmds = loadcmds
+        self.segments = segments
+
+    @classmethod
+    def build(cls, filename):
+        '''Build the template of the ELF binary `filename`, or return None if it is not ELF.'''
+        # pylint: disable=too-many-locals
+        elf_info = get_elf_info(filename)
+        if elf_info is None:
+            return None
+        (entry, loadcmds) = elf_info
+
+        segments = []
+        mapaddr = min(rounddown(addr) for (_, addr, _, _, _) in loadcmds)
+        with open(filename, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                with memoryview(mapping) as data:
+                    for (offset, addr, filesize, memsize, flags,
+                         desc) in get_binary_segments(loadcmds, PAGEINFO_REG):
+                        m_addr = rounddown(addr)
+                        m_size = roundup(addr + memsize) - m_addr
+                        content_offset = offset - rounddown(offset)
+                        if filesize:
+                            first_page = min(rounddown(content_offset), m_size)
+                            end_page = min(roundup(content_offset + filesize), m_size)
+                        else:
+                            first_page = end_page = m_size
+                        records = bytearray((end_page - first_page) // offs.PAGESIZE
+                                            * MEASURED_PAGE_RECORD.size)
+                        with data[offset:offset + filesize] as content:
+                            build_page_records(records, first_page, flags, content,
+                                               content_offset)
+                        segments.append((m_addr - mapaddr, m_size, flags, desc, first_page,
+                                         records))
+        return cls(entry, loadcmds, segments)
+
+    @classmethod
+    def load(cls, filename):
+        '''Read a template written by save(); raises ValueError if it is not usable.'''
+        with open(filename, 'rb') as file:
+            header = json.loads(file.readline().decode())
+            if (header.get('version') != PAL_TEMPLATE_VERSION or
+                    header.get('pagesize') != offs.PAGESIZE):
+                raise ValueError('Unsupported PAL template ' + filename)
+            segments = []
+            for (addr, size, flags, desc, first_page, records_size) in header['segments']:
+                records = bytearray(records_size)
+                if file.readinto(records) != records_size:
+                    raise ValueError('Truncated PAL template ' + filename)
+                segments.append((addr, size, flags, desc, first_page, records))
+        return cls(header['entry'], tuple(tuple(loadcmd) for loadcmd in header['loadcmds']),
+                   segments)
+
+    def save(self, filename):
+        header = {
+            'version': PAL_TEMPLATE_VERSION,
+            'pagesize': offs.PAGESIZE,
+            'entry': self.entry,
+            'loadcmds': self.loadcmds,
+            'segments': [(addr, size, flags, desc, first_page, len(records))
+                         for (addr, size, flags, desc, first_page, records) in self.segments],
+        }
+        # write to a temporary file first, so that concurrent signers never see a partial file
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as file:
+            file.write(json.dumps(header).encode() + b'\n')
+            for (_, _, _, _, _, records) in self.segments:
+                file.write(records)
+        os.replace(tmp_filename, filename)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_pal_template(filename, checksum):
+    path = os.path.join(get_cache_dir(), 'pal-templates', checksum.hex())
+    try:
+        return PalTemplate.load(path)
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    template = PalTemplate.build(filename)
+    if template is not None:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            template.save(path)
+        except OSError as exc:
+            print('Warning: cannot save PAL template %s (%s)' % (path, exc), file=sys.stderr)
+    return template
+
+
+def load_pal_template(args):
+    '''Return the PalTemplate of the libpal in `args`, or None if templates are disabled.'''
+    if not args.get('pal_template', True):
+        return None
+    checksum_cache = open_checksum_cache(args)
+    try:
+        (checksum,) = get_checksums([args['libpal']], jobs=1, checksum_cache=checksum_cache)
+    finally:
+        if checksum_cache is not None:
+            checksum_cache.close()
+    return _get_pal_template(os.path.realpath(args['libpal']), checksum)
+
+
+# Signing Keys
+
+class OpensslSigningKey:
+    '''RSA signing key used through the `openssl` command line tool.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        modulus_out = subprocess.check_output(
+            ['openssl', 'rsa', '-modulus', '-in', filename, '-noout'])
+        modulus = bytes.fromhex(modulus_out[8:8+offs.SE_KEY_SIZE*2].decode())
+        self.modulus = bytes(reversed(modulus))
+
+    def sign(self, data):
+        '''Return the big-endian RSA-SHA256 (PKCS#1 v1.5) signature of `data`.'''
+        proc = subprocess.Popen(
+            ['openssl', 'sha256', '-binary', '-sign', self.filename],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        signature, _ = proc.communicate(data)
+        if proc.returncode != 0:
+            raise Exception('Failed to sign with key ' + self.filename)
+        return signature
+
+
+class CryptographySigningKey:
+    '''RSA signing key loaded once and used in-process through the `cryptography` library.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as file:
+            self._key = crypto_serialization.load_pem_private_key(
+                file.read(), password=None, backend=crypto_default_backend())
+        modulus = self._key.public_key().public_numbers().n
+        self.modulus = modulus.to_bytes(offs.SE_KEY_SIZE, byteorder='little')
+
+    def sign(self, data):
+        '''Return the big-endian RSA-SHA256 (PKCS#1 v1.5) signature of `data`.'''
+        return self._key.sign(bytes(data), crypto_padding.PKCS1v15(), crypto_hashes.SHA256())
+
+
+@functools.lru_cache(maxsize=None)
+def _load_signing_key(filename, mtime_ns):
+    # pylint: disable=unused-argument
+    if crypto_serialization is not None:
+        return CryptographySigningKey(filename)
+    return OpensslSigningKey(filename)
+
+
+def load_signing_key(filename):
+    '''Load the key used to sign SIGSTRUCTs, at most once per process.'''
+    return _load_signing_key(os.path.realpath(filename), os.stat(filename).st_mtime_ns)
 
 
 def generate_sigstruct(attr, args, mrenclave):
@@ -690,18 +1552,9 @@ def generate_sigstruct(attr, args, mrenclave):
         else:
             struct.pack_into(field[1], sign_buffer, field[0], *field[2:])
 
-    proc = subprocess.Popen(
-        ['openssl', 'rsa', '-modulus', '-in', args['key'], '-noout'],
-        stdout=subprocess.PIPE)
-    modulus_out, _ = proc.communicate()
-    modulus = bytes.fromhex(modulus_out[8:8+offs.SE_KEY_SIZE*2].decode())
-    modulus = bytes(reversed(modulus))
-
-    proc = subprocess.Popen(
-        ['openssl', 'sha256', '-binary', '-sign', args['key']],
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    signature, _ = proc.communicate(sign_buffer)
-    signature = signature[::-1]
+    signing_key = load_signing_key(args['key'])
+    modulus = signing_key.modulus
+    signature = signing_key.sign(sign_buffer)[::-1]
 
     modulus_int = int.from_bytes(modulus, byteorder='little')
     signature_int = int.from_bytes(signature, byteorder='little')
@@ -731,23 +1584,108 @@ def generate_sigstruct(attr, args, mrenclave):
     return buffer
 
 
+# Signing Reports
+
+class SignReport:
+    '''Wall time of the phases of signing and the number of bytes hashed, for --report.'''
+
+    def __init__(self):
+        self.phases = {}
+        self.bytes_hashed = {}
+        self.info = {}
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def add_hashed(self, what, size):
+        self.bytes_hashed[what] = self.bytes_hashed.get(what, 0) + size
+
+    def to_json(self):
+        report = dict(self.info)
+        report['phases'] = {name: round(seconds, 6) for name, seconds in self.phases.items()}
+        report['total_time'] = round(time.perf_counter() - self._start, 6)
+        report['bytes_hashed'] = dict(self.bytes_hashed,
+                                      total=sum(self.bytes_hashed.values()))
+        return json.dumps(report, sort_keys=True)
+
+
+# Reproducible Signing
+
+FINGERPRINT_VERSION = 1
+
+
+def parse_date(value):
+    # date.fromisoformat() is 3.7+, GSC images still ship 3.6
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def get_sign_date(args):
+    '''Date stamped into SIGSTRUCT: --date, else $SOURCE_DATE_EPOCH (in UTC), else today.'''
+    if args.get('date') is not None:
+        return parse_date(args['date'])
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch:
+        return datetime.datetime.fromtimestamp(int(epoch), datetime.timezone.utc).date()
+    return datetime.date.today()
+
+
+def get_input_fingerprint(args, attr, trusted_files, trusted_children, checksum_cache=None):
+    '''Hash everything the outputs of signing depend on into one hex string.'''
+    with open(args['manifest'], 'rb') as file:
+        manifest_checksum = hashlib.sha256(file.read()).hexdigest()
+    (libpal_checksum, signer_checksum, offsets_checksum) = get_checksums(
+        [args['libpal'], __file__, offs.__file__], checksum_cache=checksum_cache)
+
+    inputs = {
+        'version': FINGERPRINT_VERSION,
+        'signer': [signer_checksum.hex(), offsets_checksum.hex()],
+        'manifest': manifest_checksum,
+        'libpal': libpal_checksum.hex(),
+        'key': hashlib.sha256(load_signing_key(args['key']).modulus).hexdigest(),
+        'date': [attr['year'], attr['month'], attr['day']],
+        'trusted_files': sorted((key, uri, checksum)
+                                for key, (uri, _, checksum) in trusted_files.items()),
+        'trusted_children': sorted((key, uri, mrenclave)
+                                   for key, (uri, _, mrenclave) in trusted_children.items()),
+        'pal_template': bool(args.get('pal_template', True)),
+        'chunk_hashes': args.get('chunk_hashes'),
+    }
+    if args.get('chunk_hashes') is not None:
+        inputs['chunk_hashes_dir'] = get_chunk_hashes_dir(args)
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def read_fingerprint(filename):
+    try:
+        with open(filename, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
 # Main Program
 
 argparser = argparse.ArgumentParser(
     epilog='With sign mode (without -depend), libpal and key are also required.')
 argparser.add_argument('--output', '-output', metavar='OUTPUT',
-                       type=str, required=True,
+                       type=str, required=False,
                        help='Output .manifest.sgx file '
                             '(manifest augmented with autogenerated fields)')
 argparser.add_argument('--libpal', '-libpal', metavar='LIBPAL',
-                       type=str, required=True,
+                       type=str, required=False,
                        help='Input libpal file '
                             '(required as part of the enclave measurement)')
 argparser.add_argument('--key', '-key', metavar='KEY',
                        type=str, required=False,
                        help='specify signing key(.pem) file')
 argparser.add_argument('--manifest', '-manifest', metavar='MANIFEST',
-                       type=str, required=True,
+                       type=str, required=False,
                        help='Input .manifest file '
                             '(user-prepared manifest template)')
 argparser.add_argument('--exec', '-exec', metavar='EXEC',
@@ -757,20 +1695,123 @@ argparser.add_argument('--exec', '-exec', metavar='EXEC',
 argparser.add_argument('--depend', '-depend',
                        action='store_true', required=False,
                        help='Generate dependency for Makefile')
+argparser.add_argument('--watch', '-watch',
+                       action='store_true', required=False,
+                       help='Generate dependencies as with --depend, then keep them (and the '
+                            'checksums of trusted files) up to date until interrupted')
+argparser.add_argument('--jobs', '-jobs', '-j', metavar='N',
+                       type=int, required=False, default=os.cpu_count(),
+                       help='Number of threads used to compute checksums of trusted files '
+                            '(default: number of CPUs)')
+argparser.add_argument('--no-checksum-cache', '-no-checksum-cache',
+                       action='store_true', required=False,
+                       help='Do not use the persistent cache of trusted-file checksums '
+                            '(stored under $XDG_CACHE_HOME/graphene)')
+argparser.add_argument('--keep-checksums', '-keep-checksums',
+                       action='store_true', required=False,
+                       help='Use the sgx.trusted_checksum.<key> entries already present in the '
+                            'manifest instead of hashing these trusted files (e.g. checksums '
+                            'computed by GSC from cached image layers)')
+argparser.add_argument('--no-pal-template', '-no-pal-template',
+                       action='store_true', required=False,
+                       help='Measure libpal from the ELF file instead of the cached measurement '
+                            'template of the PAL (stored under $XDG_CACHE_HOME/graphene)')
+argparser.add_argument('--chunk-hashes', '-chunk-hashes', metavar='MIN_SIZE',
+                       type=str, required=False,
+                       help='For trusted files of at least MIN_SIZE bytes (e.g. "64M"), write '
+                            'the SHA256 of every chunk next to the .sig file, so that the enclave '
+                            'verifies chunks as they are read instead of the whole file on open')
+argparser.add_argument('--quiet', '-quiet', '-q',
+                       action='store_true', required=False,
+                       help='Do not print the attributes, trusted files and memory layout')
+argparser.add_argument('--report', '-report', metavar='FORMAT',
+                       choices=['json'], required=False,
+                       help='After signing, print a report with the measurement, the wall time '
+                            'of every phase and the number of bytes hashed as one line of JSON')
+argparser.add_argument('--date', '-date', metavar='YYYY-MM-DD',
+                       type=str, required=False,
+                       help='Date stamped into the .sig file (default: $SOURCE_DATE_EPOCH if '
+                            'set, otherwise today), for reproducible signing')
+argparser.add_argument('--fingerprint', '-fingerprint',
+                       action='store_true', required=False,
+                       help='Do not sign, print a hash of all inputs of signing instead (usable '
+                            'as the key of an output cache)')
+argparser.add_argument('--skip-unchanged', '-skip-unchanged',
+                       action='store_true', required=False,
+                       help='Record the fingerprint of the inputs next to the .sig file and skip '
+                            'signing if it did not change since the last run')
+argparser.add_argument('--plan', '-plan',
+                       action='store_true', required=False,
+                       help='Do not sign, print the layout of the enclave as JSON instead, with '
+                            'the minimum enclave size and the heap left by sgx.enclave_size '
+                            '(--output is optional)')
+argparser.add_argument('--heap', '-heap', metavar='SIZE',
+                       type=str, required=False,
+                       help='With --plan, suggest the smallest enclave size leaving at least '
+                            'SIZE bytes (e.g. "1G") of heap')
+argparser.add_argument('--batch', '-batch', metavar='MANIFEST_LIST',
+                       type=str, required=False,
+                       help='Sign many manifests in one process: each line of MANIFEST_LIST holds '
+                            'the options for one manifest (e.g. "--manifest app.manifest '
+                            '--output app.manifest.sgx --exec app"), options given on the '
+                            'command line apply to all of them')
 
 
 def parse_args(args):
-    args = argparser.parse_args(args)
+    return namespace_to_args(argparser.parse_args(args))
+
+
+def namespace_to_args(args):
+    # pylint: disable=too-many-branches
+    if args.output is None and args.plan and args.manifest is not None:
+        # only used to name the .sig file (and the chunk hashes next to it)
+        args.output = args.manifest + '.sgx'
+    if args.output is None or args.manifest is None:
+        argparser.error("the following arguments are required: --output, --manifest")
+        return None
+
     args_dict = {
         'output': args.output,
         'libpal': args.libpal,
         'key': args.key,
         'manifest': args.manifest,
+        'jobs': args.jobs,
+        'checksum_cache': not args.no_checksum_cache,
+        'keep_checksums': args.keep_checksums,
+        'pal_template': not args.no_pal_template,
+        'quiet': args.quiet,
+        'report': args.report,
+        'date': args.date,
+        'fingerprint': args.fingerprint,
+        'skip_unchanged': args.skip_unchanged,
     }
+    if args.jobs is not None and args.jobs < 1:
+        argparser.error("--jobs must be at least 1")
+        return None
+    if args.chunk_hashes is not None:
+        try:
+            args_dict['chunk_hashes'] = parse_size(args.chunk_hashes)
+        except ValueError:
+            argparser.error("invalid --chunk-hashes size: " + args.chunk_hashes)
+            return None
     if args.exec is not None:
         args_dict['exec'] = args.exec
-    if args.depend:
+    if args.date is not None:
+        try:
+            parse_date(args.date)
+        except ValueError:
+            argparser.error("invalid --date (expected YYYY-MM-DD): " + args.date)
+            return None
+    if args.heap is not None:
+        try:
+            args_dict['heap'] = parse_size(args.heap)
+        except ValueError:
+            argparser.error("invalid --heap size: " + args.heap)
+            return None
+    if args.depend or args.watch:
         args_dict['depend'] = True
+    elif args.plan:
+        args_dict['plan'] = True
     else:
         # key is required and not found in manifest
         if args.key is None:
@@ -780,122 +1821,428 @@ def parse_args(args):
     return args_dict
 
 
-def main_sign(args):
-    # pylint: disable=too-many-statements,too-many-branches,too-many-locals
-    manifest, manifest_layout = read_manifest(args['manifest'])
-
-    if exec_sig_manifest(args) != 0:
-        return 1
-
-    # Get attributes from manifest
+def get_attributes(manifest):
+    '''Read the enclave attributes from the manifest, adding defaults for missing ones.'''
     attr = dict()
 
-    parse_int = functools.partial(int, base=0)
-
     for key, default, parse, attr_key in [
             ('enclave_size', DEFAULT_ENCLAVE_SIZE, parse_size, 'enclave_size'),
             ('thread_num', str(DEFAULT_THREAD_NUM), parse_int, 'thread_num'),
             ('isvprodid', '0', parse_int, 'isv_prod_id'),
             ('isvsvn', '0', parse_int, 'isv_svn'),
     ]:
-        attr[attr_key] = parse(manifest.setdefault('sgx.' + key, default))
+        manifest.setdefault('sgx.' + key, default)
+        attr[attr_key] = parse(manifest.get_value('sgx.' + key))
 
     (attr['flags'], attr['xfrms'], attr['misc_select']) = get_enclave_attributes(manifest)
+    return attr
 
-    today = datetime.date.today()
-    attr['year'] = today.year
-    attr['month'] = today.month
-    attr['day'] = today.day
-
-    print("Attributes:")
-    print("    size:        %d" % attr['enclave_size'])
-    print("    thread_num:  %d" % attr['thread_num'])
-    print("    isv_prod_id: %d" % attr['isv_prod_id'])
-    print("    isv_svn:     %d" % attr['isv_svn'])
-    print("    attr.flags:  %016x" % int.from_bytes(attr['flags'], byteorder='big'))
-    print("    attr.xfrm:   %016x" % int.from_bytes(attr['xfrms'], byteorder='big'))
-    print("    misc_select: %08x" % int.from_bytes(attr['misc_select'], byteorder='big'))
-    print("    date:        %d-%02d-%02d" % (attr['year'], attr['month'], attr['day']))
-
-    if manifest.get('sgx.remote_attestation', '0') == '1':
-        spid = manifest.get('sgx.ra_client_spid', '')
-        linkable = manifest.get('sgx.ra_client_linkable', '0')
-        print("SGX remote attestation:")
-        if not spid:
-            print("    DCAP/ECDSA")
-        else:
-            print("    EPID (spid = %s, linkable = %s)" % (spid, linkable))
-
-    # Get trusted checksums and measurements
-    print("Trusted files:")
-    for key, val in get_trusted_files(manifest, args).items():
-        (uri, _, checksum) = val
-        print("    %s %s" % (checksum, uri))
-        manifest['sgx.trusted_checksum.' + key] = '"' + checksum + '"'
-
-    print("Trusted children:")
-    for key, val in get_trusted_children(manifest).items():
-        (uri, _, mrenclave) = val
-        print("    %s %s" % (mrenclave, uri))
-        manifest['sgx.trusted_mrenclave.' + key] = '"' + mrenclave + '"'
-
-    # Try populate memory areas
-    memory_areas = get_memory_areas(attr, args)
 
+def get_enclave_base(manifest, attr, memory_areas):
+    '''Return (enclave_base_addr, enclave_heap_min), deducing sgx.static_address if not set.'''
     if manifest.get('sgx.static_address', None) is None:
         # If static_address is not specified explicitly, deduce from executable: if it has at
         # least one specific address (typically 0x400000 in code segment), then it is static aka
         # non-PIE executable
-        manifest['sgx.static_address'] = '0'
+        manifest.set_value('sgx.static_address', 0)
         if any([a.addr is not None for a in memory_areas]):
-            manifest['sgx.static_address'] = '1'
+            manifest.set_value('sgx.static_address', 1)
 
-    if manifest['sgx.static_address'] == '1':
+    if parse_int(manifest.get_value('sgx.static_address')) == 1:
         # executable is static, i.e. it is non-PIE: enclave base address must cover code segment
         # loaded at 0x400000, and heap cannot start at zero (modern OSes do not allow this)
-        enclave_base_addr = offs.DEFAULT_ENCLAVE_BASE
-        enclave_heap_min = offs.MMAP_MIN_ADDR
-    else:
-        # executable is not static, i.e. it is PIE: enclave base address can be arbitrary (we
-        # choose it same as enclave_size), and heap can start immediately at this base address
-        enclave_base_addr = attr['enclave_size']
-        enclave_heap_min = 0
+        return (offs.DEFAULT_ENCLAVE_BASE, offs.MMAP_MIN_ADDR)
 
-    if manifest.get('sgx.enable_stats', None) is None:
-        manifest['sgx.enable_stats'] = '0'
+    # executable is not static, i.e. it is PIE: enclave base address can be arbitrary (we
+    # choose it same as enclave_size), and heap can start immediately at this base address
+    return (attr['enclave_size'], 0)
 
-    output_manifest(args['output'], manifest, manifest_layout)
 
-    with open(args['output'], 'rb') as file:
-        manifest_data = file.read()
-    manifest_data += b'\0' # in-memory manifest needs NULL-termination
+def main_sign(args):
+    # pylint: disable=too-many-statements,too-many-branches,too-many-locals
+    report = SignReport() if args.get('report') else None
+    phase = report.phase if report is not None else lambda _: contextlib.suppress()
+    log = print if not (args.get('quiet') or args.get('fingerprint')) else lambda *_: None
+
+    with phase('manifest'):
+        manifest = read_manifest(args['manifest'])
+
+        if exec_sig_manifest(args) != 0:
+            return 1
+
+        # Get attributes from manifest
+        attr = get_attributes(manifest)
+
+    date = get_sign_date(args)
+    attr['year'] = date.year
+    attr['month'] = date.month
+    attr['day'] = date.day
+
+    log("Attributes:")
+    log("    size:        %d" % attr['enclave_size'])
+    log("    thread_num:  %d" % attr['thread_num'])
+    log("    isv_prod_id: %d" % attr['isv_prod_id'])
+    log("    isv_svn:     %d" % attr['isv_svn'])
+    log("    attr.flags:  %016x" % int.from_bytes(attr['flags'], byteorder='big'))
+    log("    attr.xfrm:   %016x" % int.from_bytes(attr['xfrms'], byteorder='big'))
+    log("    misc_select: %08x" % int.from_bytes(attr['misc_select'], byteorder='big'))
+    log("    date:        %d-%02d-%02d" % (attr['year'], attr['month'], attr['day']))
+
+    if parse_int(manifest.get_value('sgx.remote_attestation', 0)) == 1:
+        spid = manifest.get_value('sgx.ra_client_spid', '')
+        linkable = manifest.get_value('sgx.ra_client_linkable', 0)
+        log("SGX remote attestation:")
+        if not spid:
+            log("    DCAP/ECDSA")
+        else:
+            log("    EPID (spid = %s, linkable = %s)" % (spid, linkable))
 
-    memory_areas = [
-        MemoryArea('manifest', content=manifest_data, size=len(manifest_data),
-                   flags=PAGEINFO_R | PAGEINFO_REG)
-        ] + memory_areas
-    memory_areas = populate_memory_areas(attr, memory_areas, enclave_base_addr, enclave_heap_min)
+    # Get trusted checksums and measurements
+    log("Trusted files:")
+    fingerprint = None
+    with phase('checksums'):
+        checksum_cache = open_checksum_cache(args)
+        try:
+            trusted_files = get_trusted_files(manifest, args, checksum_cache=checksum_cache,
+                                              report=report)
+            trusted_children = get_trusted_children(manifest)
+            if args.get('fingerprint') or args.get('skip_unchanged'):
+                fingerprint = get_input_fingerprint(args, attr, trusted_files, trusted_children,
+                                                    checksum_cache)
+        finally:
+            if checksum_cache is not None:
+                checksum_cache.close()
+        for key, val in trusted_files.items():
+            (uri, _, checksum) = val
+            log("    %s %s" % (checksum, uri))
+            manifest.set_value('sgx.trusted_checksum.' + key, checksum)
+        if checksum_cache is not None:
+            log("    (checksum cache: %d hits, %d misses)" % (checksum_cache.hits,
+                                                           checksum_cache.misses))
+
+        log("Trusted children:")
+        for key, val in trusted_children.items():
+            (uri, _, mrenclave) = val
+            log("    %s %s" % (mrenclave, uri))
+            manifest.set_value('sgx.trusted_mrenclave.' + key, mrenclave)
+
+    if args.get('fingerprint'):
+        print(fingerprint)
+        return 0
+
+    fingerprint_file = args['sigfile'] + '.inputs'
+    if (args.get('skip_unchanged') and read_fingerprint(fingerprint_file) == fingerprint
+            and os.path.exists(args['output']) and os.path.exists(args['sigfile'])):
+        log("Inputs unchanged since last signing (%s), skipping" % fingerprint)
+        if report is not None:
+            report.info.update({
+                'manifest': args['manifest'],
+                'output': args['output'],
+                'sigfile': args['sigfile'],
+                'skipped': True,
+            })
+            print(report.to_json())
+        return 0
+    # the outputs are about to change, so an old fingerprint no longer describes them
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(fingerprint_file)
+
+    if args.get('chunk_hashes') is not None:
+        with phase('checksums'):
+            chunk_hashes = get_chunk_hashes(trusted_files, get_chunk_hashes_dir(args),
+                                            args['chunk_hashes'], args.get('jobs'))
+        log("Trusted chunk hashes:")
+        for key, (filename, checksum) in sorted(chunk_hashes.items()):
+            log("    %s %s" % (checksum, filename))
+            manifest.set_value('sgx.trusted_chunks.' + key, 'file:' + filename)
+            manifest.set_value('sgx.trusted_chunks_checksum.' + key, checksum)
+
+    # Try populate memory areas
+    with phase('elf'):
+        memory_areas = get_memory_areas(attr, args)
+
+    with phase('layout'):
+        (enclave_base_addr, enclave_heap_min) = get_enclave_base(manifest, attr, memory_areas)
+
+        if manifest.get('sgx.enable_stats', None) is None:
+            manifest.set_value('sgx.enable_stats', 0)
+
+        output_manifest(args['output'], manifest)
+
+        with open(args['output'], 'rb') as file:
+            manifest_data = file.read()
+        manifest_data += b'\0' # in-memory manifest needs NULL-termination
+
+        memory_areas = [
+            MemoryArea('manifest', content=manifest_data, size=len(manifest_data),
+                       flags=PAGEINFO_R | PAGEINFO_REG)
+            ] + memory_areas
+        memory_areas = populate_memory_areas(attr, memory_areas, enclave_base_addr,
+                                             enclave_heap_min)
 
-    print("Memory:")
     # Generate measurement
-    mrenclave = generate_measurement(attr, memory_areas)
-    print("Measurement:")
-    print("    %s" % mrenclave.hex())
+    with phase('measurement'):
+        log("Memory:")
+        mrenclave = generate_measurement(attr, memory_areas, report,
+                                         verbose=not args.get('quiet'))
+    log("Measurement:")
+    log("    %s" % mrenclave.hex())
 
     # Generate sigstruct
-    with open(args['sigfile'], 'wb') as file:
-        file.write(generate_sigstruct(attr, args, mrenclave))
+    with phase('sign'):
+        with open(args['sigfile'], 'wb') as file:
+            file.write(generate_sigstruct(attr, args, mrenclave))
+
+    if fingerprint is not None:
+        with open(fingerprint_file, 'w') as file:
+            file.write(fingerprint + '\n')
+
+    if report is not None:
+        report.info.update({
+            'manifest': args['manifest'],
+            'output': args['output'],
+            'sigfile': args['sigfile'],
+            'mrenclave': mrenclave.hex(),
+            'enclave_size': attr['enclave_size'],
+            'thread_num': attr['thread_num'],
+            'trusted_files': len(trusted_files),
+        })
+        if checksum_cache is not None:
+            report.info['checksum_cache'] = {'hits': checksum_cache.hits,
+                                             'misses': checksum_cache.misses}
+        print(report.to_json())
     return 0
 
 
-def make_depend(args):
-    manifest_file = args['manifest']
-    output = args['output']
+# Layout Planning
 
-    (manifest, _) = read_manifest(manifest_file)
+# Stands in for checksums and measurements, which have the same length in the manifest
+PLACEHOLDER_CHECKSUM = '0' * 64
+
+
+def format_size(size):
+    for (suffix, scale) in (('G', 1 << 30), ('M', 1 << 20), ('K', 1 << 10)):
+        if size >= scale and size % scale == 0:
+            return '%d%s' % (size // scale, suffix)
+    return str(size)
+
+
+def next_power_of_two(value):
+    return 1 << max(value - 1, 0).bit_length()
+
+
+def plan_layout(args):
+    '''Lay out the enclave of `args` without hashing anything and return the plan as a dict.'''
+    # pylint: disable=too-many-locals
+    manifest = read_manifest(args['manifest'])
     if exec_sig_manifest(args) != 0:
-        return 1
+        return None
+
+    attr = get_attributes(manifest)
+    trusted_files = get_trusted_files(manifest, args, do_checksum=False)
+    for key in trusted_files:
+        manifest.set_value('sgx.trusted_checksum.' + key, PLACEHOLDER_CHECKSUM)
+    if args.get('chunk_hashes') is not None:
+        directory = get_chunk_hashes_dir(args)
+        for key, (_, target) in trusted_files.items():
+            if os.path.getsize(target) >= args['chunk_hashes']:
+                manifest.set_value('sgx.trusted_chunks.' + key,
+                                   'file:' + os.path.join(directory, key))
+                manifest.set_value('sgx.trusted_chunks_checksum.' + key, PLACEHOLDER_CHECKSUM)
+    for key in get_trusted_children(manifest, do_checksum=False):
+        manifest.set_value('sgx.trusted_mrenclave.' + key, PLACEHOLDER_CHECKSUM)
+
+    memory_areas = get_memory_areas(attr, args)
+    (enclave_base_addr, enclave_heap_min) = get_enclave_base(manifest, attr, memory_areas)
+    if manifest.get('sgx.enable_stats', None) is None:
+        manifest.set_value('sgx.enable_stats', 0)
+
+    manifest_size = len(format_manifest(manifest).encode()) + 1
+    memory_areas = [
+        MemoryArea('manifest', size=manifest_size, flags=PAGEINFO_R | PAGEINFO_REG)
+        ] + memory_areas
+
+    # areas without a fixed address are stacked below the top of the enclave, and must stay
+    # above the fixed ones and the start of the heap
+    fixed_areas = [area for area in memory_areas if area.addr is not None]
+    lowest = max([enclave_heap_min] + [area.addr + area.size for area in fixed_areas])
+    min_size = lowest + sum(area.size for area in memory_areas if area.addr is None)
+    # free memory around fixed areas (e.g. below a non-PIE executable) is also heap
+    free_below = lowest - enclave_heap_min - sum(
+        max(0, min(area.addr + area.size, lowest) - max(area.addr, enclave_heap_min))
+        for area in fixed_areas)
+    heap = args.get('heap') or 0
+
+    plan = {
+        'manifest': args['manifest'],
+        'enclave_size': attr['enclave_size'],
+        'thread_num': attr['thread_num'],
+        'static_address': parse_int(manifest.get_value('sgx.static_address')) == 1,
+        'enclave_base': enclave_base_addr,
+        'heap_min': enclave_heap_min,
+        'min_enclave_size': min_size,
+        'min_enclave_size_pow2': next_power_of_two(min_size),
+        'heap_headroom': None,
+        'requested_heap': heap,
+        'suggested_enclave_size': format_size(
+            next_power_of_two(min_size + max(0, heap - free_below))),
+        'areas': None,
+    }
+
+    if min_size <= attr['enclave_size']:
+        free_areas = layout_memory_areas(attr, memory_areas, enclave_heap_min)
+        plan['heap_headroom'] = sum(area.size for area in free_areas)
+        plan['areas'] = [{
+            'desc': area.desc,
+            'addr': area.addr,
+            'size': area.size,
+            'measured': area.measure,
+        } for area in sorted(memory_areas + free_areas, key=lambda area: area.addr)]
+
+    return plan
+
+
+def main_plan(batch):
+    plans = []
+    for args in batch:
+        plan = plan_layout(args)
+        if plan is None:
+            return 1
+        plans.append(plan)
+    json.dump(plans if len(plans) > 1 else plans[0], sys.stdout, indent=4)
+    print()
+    return 0
+
+
+# Batch Signing
+
+def _sign_captured(args):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            ret = main_sign(args)
+        except Exception: # pylint: disable=broad-except
+            traceback.print_exc(file=output)
+            ret = 1
+    return (ret, output.getvalue())
+
+
+def get_batch_dependencies(batch):
+    '''For every manifest in `batch`, find the manifests whose .sig it uses as trusted child.'''
+    sigfiles = {os.path.realpath(args['sigfile']): i for i, args in enumerate(batch)}
+    dependencies = []
+    for args in batch:
+        manifest = scan_manifest_dependencies(args['manifest'])
+        children = get_trusted_children(manifest, check_exist=False, do_checksum=False)
+        dependencies.append({sigfiles[os.path.realpath(target)]
+                             for (_, target) in children.values()
+                             if os.path.realpath(target) in sigfiles})
+    return dependencies
+
+
+def sign_many(batch, jobs=None):
+    '''Sign many manifests in one go, sharing the signing key, parsed ELF files and caches.'''
+    # pylint: disable=too-many-branches
+    for args in batch:
+        if exec_sig_manifest(args) != 0:
+            return 1
+    dependencies = get_batch_dependencies(batch)
+
+    # load everything shared between the manifests before forking the workers
+    for key in {args['key'] for args in batch}:
+        load_signing_key(key)
+    for args in {args['libpal']: args for args in batch}.values():
+        if load_pal_template(args) is None:
+            get_elf_info(args['libpal'])
+
+    executor = None
+    worker_args = batch
+    if jobs != 1 and len(batch) > 1:
+        budget = jobs or os.cpu_count() or 1
+        workers = min(budget, len(batch))
+        worker_args = [dict(args, jobs=max(1, budget // workers)) for args in batch]
+
+        kwargs = {}
+        if sys.version_info >= (3, 7):
+            # fork is the default on Linux before 3.14, but mp_context only exists since 3.7
+            kwargs['mp_context'] = multiprocessing.get_context('fork')
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, **kwargs)
+
+    def submit(i):
+        if executor is not None:
+            return executor.submit(_sign_captured, worker_args[i])
+        future = concurrent.futures.Future()
+        future.set_result(_sign_captured(batch[i]))
+        return future
+
+    pending = set(range(len(batch)))
+    running = {}
+    succeeded = set()
+    failed = set()
+    try:
+        while pending or running:
+            for i in sorted(pending):
+                if dependencies[i] & failed:
+                    print("Skipping %s: a trusted child failed to sign" % batch[i]['manifest'],
+                          file=sys.stderr)
+                    pending.remove(i)
+                    failed.add(i)
+                elif dependencies[i] <= succeeded:
+                    pending.remove(i)
+                    running[submit(i)] = i
+
+            if not running:
+                if pending:
+                    print("Cannot sign %s: trusted children form a cycle" %
+                          ', '.join(batch[i]['manifest'] for i in sorted(pending)),
+                          file=sys.stderr)
+                    failed.update(pending)
+                break
+
+            (finished, _) = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                (ret, output) = future.result()
+                if not batch[i].get('quiet'):
+                    print("%s:" % batch[i]['manifest'])
+                print(output, end='')
+                if ret == 0:
+                    succeeded.add(i)
+                else:
+                    print("Failed to sign %s" % batch[i]['manifest'], file=sys.stderr)
+                    failed.add(i)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return 1 if failed else 0
+
 
+# Dependency Files
+
+# Manifest keys naming files that the signature depends on
+DEPEND_KEY_PREFIXES = ('sgx.trusted_files.', 'sgx.trusted_children.', 'loader.preload')
+
+
+def scan_manifest_dependencies(filename):
+    '''Read only the keys of a manifest which name files that the signature depends on.'''
+    manifest = Manifest()
+    with open(filename, 'r') as file:
+        for line in file:
+            line = line.lstrip()
+            if not line.startswith(DEPEND_KEY_PREFIXES):
+                continue
+            pound = line.find('#')
+            if pound != -1:
+                line = line[:pound]
+            equal = line.find('=')
+            if equal != -1:
+                manifest[line[:equal].strip()] = line[equal + 1:].strip()
+    return manifest
+
+
+def get_dependencies(manifest, args):
     dependencies = set()
     for filename in get_trusted_files(manifest, args, check_exist=False,
                                       do_checksum=False).values():
@@ -905,24 +2252,198 @@ def make_depend(args):
         dependencies.add(filename[1])
     dependencies.add(args['libpal'])
     dependencies.add(args['key'])
+    dependencies.discard(None)
+    return sorted(dependencies)
+
+
+def make_depend(args):
+    manifest_file = args['manifest']
+    output = args['output']
 
+    if exec_sig_manifest(args) != 0:
+        return 1
+    manifest = scan_manifest_dependencies(manifest_file)
+
+    manifest_sgx = output
+    if manifest_sgx.endswith('.d'):
+        manifest_sgx = manifest_sgx[:-len('.d')]
+    lines = ['%s %s:' % (manifest_sgx, args['sigfile'])]
+    for filename in get_dependencies(manifest, args):
+        lines.append(' \\\n\t%s' % filename)
+    lines.append('\n')
+
+    # always rewritten, so that make sees it newer than the manifest
     with open(output, 'w') as file:
-        manifest_sgx = output
-        if manifest_sgx.endswith('.d'):
-            manifest_sgx = manifest_sgx[:-len('.d')]
-        file.write('%s %s:' % (manifest_sgx, args['sigfile']))
-        for filename in dependencies:
-            file.write(' \\\n\t%s' % filename)
-        file.write('\n')
+        file.write(''.join(lines))
 
     return 0
 
 
+# Watching Manifests
+
+# inotify definitions (see <sys/inotify.h>)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# Events arriving within this many seconds of each other are handled together
+WATCH_SETTLE_TIME = 0.2
+
+
+class Inotify:
+    '''Minimal ctypes wrapper around the Linux inotify API, watching directories.'''
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno()
+        self._dirs = {}
+
+    @staticmethod
+    def _raise_errno(filename=None):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), filename)
+
+    def add_watch(self, directory, mask=WATCH_MASK):
+        watch = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if watch < 0:
+            self._raise_errno(directory)
+        self._dirs[watch] = directory
+
+    def read_events(self, timeout=None):
+        '''Wait up to `timeout` seconds for events, return a list of (path, mask).'''
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        pos = 0
+        while pos < len(data):
+            (watch, mask, _, name_len) = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = data[pos:pos + name_len].rstrip(b'\0')
+            pos += name_len
+            if watch in self._dirs:
+                events.append((os.path.join(self._dirs[watch], os.fsdecode(name)), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch_manifests(batch):
+    '''Keep the dependency files of the manifests in `batch` up to date until interrupted.'''
+    # pylint: disable=too-many-locals
+    inotify = Inotify()
+    checksum_cache = open_checksum_cache(batch[0] if batch else {})
+    watched_dirs = set()
+    manifests = {}
+    trusted_files = {}
+
+    def refresh(i):
+        args = batch[i]
+        if make_depend(args) != 0:
+            return
+        manifest = scan_manifest_dependencies(args['manifest'])
+        files = [target for (_, target) in get_trusted_files(manifest, args, check_exist=False,
+                                                             do_checksum=False).values()]
+        manifests[os.path.realpath(args['manifest'])] = i
+        # forget the trusted files the manifest no longer lists
+        for path in list(trusted_files):
+            trusted_files[path].discard(i)
+            if not trusted_files[path]:
+                del trusted_files[path]
+        for filename in files:
+            trusted_files.setdefault(os.path.realpath(filename), set()).add(i)
+        rehash(files)
+        for filename in [args['manifest']] + get_dependencies(manifest, args):
+            directory = os.path.dirname(os.path.realpath(filename))
+            if directory not in watched_dirs and os.path.isdir(directory):
+                inotify.add_watch(directory)
+                watched_dirs.add(directory)
+
+    def rehash(files):
+        files = [filename for filename in files if os.path.isfile(filename)]
+        if checksum_cache is not None and files:
+            get_checksums(files, batch[0].get('jobs'), checksum_cache)
+
+    try:
+        for i in range(len(batch)):
+            refresh(i)
+        print("Watching %d manifests (%d directories), press Ctrl-C to stop" %
+              (len(batch), len(watched_dirs)))
+
+        while True:
+            events = inotify.read_events()
+            while True:
+                more = inotify.read_events(WATCH_SETTLE_TIME)
+                if not more:
+                    break
+                events += more
+
+            changed = {os.path.realpath(path) for (path, _) in events}
+            to_refresh = sorted({manifests[path] for path in changed if path in manifests})
+            for i in to_refresh:
+                refresh(i)
+                print("Updated %s" % batch[i]['output'])
+            to_rehash = [path for path in changed
+                         if path in trusted_files and not trusted_files[path] <= set(to_refresh)]
+            if to_rehash:
+                rehash(to_rehash)
+                print("Rehashed %d trusted files" % len(to_rehash))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inotify.close()
+        if checksum_cache is not None:
+            checksum_cache.close()
+
+    return 0
+
+
+def read_batch(namespace):
+    '''Parse the MANIFEST_LIST file given with --batch into a list of argument dicts.'''
+    batch = []
+    with open(namespace.batch, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            line_namespace = argparser.parse_args(shlex.split(line),
+                                                  namespace=copy.copy(namespace))
+            batch.append(namespace_to_args(line_namespace))
+    return batch
+
+
 def main(args=None):
-    args = parse_args(args)
+    namespace = argparser.parse_args(args)
+    if namespace.batch is not None:
+        batch = read_batch(namespace)
+        if namespace.plan:
+            return main_plan(batch)
+        if namespace.watch:
+            return watch_manifests(batch)
+        if namespace.depend:
+            for args_ in batch:
+                if make_depend(args_) != 0:
+                    return 1
+            return 0
+        return sign_many(batch, jobs=namespace.jobs)
+
+    args = namespace_to_args(namespace)
     if args is None:
         return 1
 
+    if namespace.watch:
+        return watch_manifests([args])
     if args.get('depend'):
         return make_depend(args)
+    if args.get('plan'):
+        return main_plan([args])
     return main_sign(args)
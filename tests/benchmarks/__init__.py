@@ -74,6 +74,15 @@ class Exec:
                 ARCH_LIBDIR='/lib/x86_64-linux-gnu',
                 **self.template_vars))
 
+        self.sign()
+
+        signer_path = self.graphene_path / 'Pal/src/host/Linux-SGX/signer'
+        subprocess.run([os.fspath(signer_path / 'pal-sgx-get-token'),
+            '--sig', os.fspath(self.manifest_path.with_suffix('.sig')),
+            '--output', os.fspath(self.manifest_path.with_suffix('.token')),
+        ], check=True, stdout=subprocess.PIPE)
+
+    def sign(self, *args):
         signer_path = self.graphene_path / 'Pal/src/host/Linux-SGX/signer'
 
         subprocess.run([os.fspath(signer_path / 'pal-sgx-sign'),
@@ -82,11 +91,7 @@ class Exec:
             '--output', os.fspath(self.manifest_sgx_path),
             '--key', os.fspath(signer_path / 'enclave-key.pem'),
             '--libpal', os.fspath(self.graphene_path / 'Runtime/libpal-Linux-SGX.so'),
-        ], check=True, stdout=subprocess.PIPE)
-
-        subprocess.run([os.fspath(signer_path / 'pal-sgx-get-token'),
-            '--sig', os.fspath(self.manifest_path.with_suffix('.sig')),
-            '--output', os.fspath(self.manifest_path.with_suffix('.token')),
+            *args,
         ], check=True, stdout=subprocess.PIPE)
 
     def add_setup(self, func):
@@ -0,0 +1,79 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import importlib
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+
+from . import Exec
+
+# pylint: disable=invalid-name
+
+class SignHelloWorld:
+    # pylint: disable=no-self-use
+
+    helloworld = Exec('helloworld', manifest_template='basic.manifest.template')
+    setup = helloworld.setup
+
+    def time_sign(self):
+        self.helloworld.sign()
+
+
+class SignHelloWorldUnchanged:
+    # pylint: disable=no-self-use
+
+    helloworld = Exec('helloworld', manifest_template='basic.manifest.template')
+
+    def setup(self):
+        self.helloworld.setup()
+        # records the fingerprint of the inputs, so that the benchmark measures skipping
+        self.helloworld.sign('--skip-unchanged')
+
+    def time_sign_skip_unchanged(self):
+        self.helloworld.sign('--skip-unchanged')
+
+
+def import_sgx_sign():
+    # same search path as Pal/src/host/Linux-SGX/signer/pal-sgx-sign
+    graphene_path = pathlib.Path(os.environ['ASV_BUILD_DIR'])
+    sys.path.insert(0, os.fspath(graphene_path / 'Pal/src/host/Linux-SGX'))
+    sys.path.insert(0, os.fspath(graphene_path / 'python'))
+    return importlib.import_module('graphenelibos.sgx_sign')
+
+
+class ManifestTrustedFiles:
+    # pylint: disable=attribute-defined-outside-init
+    params = [100000]
+    param_names = ['trusted_files']
+
+    def setup(self, trusted_files):
+        self.sgx_sign = import_sgx_sign()
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp())
+        self.manifest_path = self.tmpdir / 'large.manifest'
+        self.output_path = self.tmpdir / 'large.manifest.sgx'
+
+        # looks like the manifests generated by GSC's finalize_manifests.py
+        with open(self.manifest_path, 'w') as file:
+            file.write('# manifest with many trusted files\n\n')
+            file.write('loader.preload = "file:/graphene/Runtime/libsysdb.so"\n')
+            file.write('sgx.enclave_size = "4G"\n')
+            file.write('sgx.thread_num = 16\n\n')
+            for i in range(trusted_files):
+                file.write('sgx.trusted_files.file{0} = "file:/usr/lib/dir{1}/file{0}.so"\n'
+                    .format(i, i % 100))
+
+        self.manifest = self.sgx_sign.read_manifest(os.fspath(self.manifest_path))
+
+    def teardown(self, _trusted_files):
+        shutil.rmtree(self.tmpdir)
+
+    def time_read_manifest(self, _trusted_files):
+        self.sgx_sign.read_manifest(os.fspath(self.manifest_path))
+
+    def time_get_trusted_files(self, _trusted_files):
+        self.sgx_sign.get_trusted_files(self.manifest, {}, check_exist=False, do_checksum=False)
+
+    def time_output_manifest(self, _trusted_files):
+        self.sgx_sign.output_manifest(os.fspath(self.output_path), self.manifest)